@@ -0,0 +1,50 @@
+'''Benchmarks batch merges (dronestore.batch) against merging pair by pair,
+on diverged versions like those of test/test_batch.py. Run from the
+repository root:
+
+    python -m bench.bench_batch [count]
+
+'''
+
+import sys
+import timeit
+
+sys.path.insert(0, 'test')
+
+from test_batch import Account, pairs
+from dronestore import batch
+
+
+def bench(fn, repeat=3):
+  '''Returns the best time (seconds) to run `fn`.'''
+  return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def pairwise(locals, remotes):
+  numpy, batch.numpy = batch.numpy, None
+  try:
+    return batch.merge_batch(Account, locals, remotes)
+  finally:
+    batch.numpy = numpy
+
+
+def main(count=20000):
+  locals, remotes = pairs(count)
+  merged = batch.merge_batch(Account, locals, remotes)
+  converged = [m.version if m else l for m, l in zip(merged, locals)]
+
+  print 'batch merge of %d versions' % count
+  print '  %-10s %8s %12s %12s %8s' % \
+    ('locals', 'changed', 'pairwise', 'vectorized', 'speedup')
+
+  for name, items in [('diverged', locals), ('converged', converged)]:
+    vectorized = lambda: batch.merge_batch(Account, items, remotes)
+    changed = len(filter(None, vectorized()))
+    t1 = bench(lambda: pairwise(items, remotes))
+    t2 = bench(vectorized)
+    print '  %-10s %8d %9.1f ms %9.1f ms %7.2fx' % \
+      (name, changed, t1 * 1000, t2 * 1000, t1 / t2)
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:]))
@@ -0,0 +1,73 @@
+'''Benchmarks compiled query evaluation against the original (probing)
+evaluation, on versions like those of test/test_query.py. Run from the
+repository root:
+
+    python -m bench.bench_query [count]
+
+'''
+
+import sys
+import timeit
+import hashlib
+import nanotime
+
+from dronestore.model import Version
+from dronestore.query import Query, DatastoreQuery
+from dronestore.util import serial
+
+
+def versions(count):
+  '''Returns `count` versions shaped like test_query.versions().'''
+  words = ['herp', 'derp', 'lerp']
+  now = nanotime.now().nanoseconds()
+  vs = []
+  for i in xrange(0, count):
+    sr = serial.SerialRepresentation()
+    sr['key'] = '/ABCD:%d' % i
+    sr['hash'] = hashlib.sha1('%s%d' % (words[i % 3], i)).hexdigest()
+    sr['parent'] = Version.BLANK_HASH
+    sr['created'] = now + i
+    sr['committed'] = now + i
+    sr['attributes'] = {'str' : {'value' : words[i % 3]} }
+    sr['type'] = 'Hurr'
+    vs.append(Version(sr))
+  return vs
+
+
+def queries(vs):
+  middle = vs[len(vs) / 2].committed
+  return [
+    ('str = derp', Query('/ABCD').filter('str', '=', 'derp')),
+    ('committed >= middle', Query('/ABCD').filter('committed', '>=', middle)),
+    ('str != lerp, -committed', \
+      Query('/ABCD').filter('str', '!=', 'lerp').order('-committed')),
+    ('+str, -key, limit 10', Query('/ABCD', limit=10).order('str').order('-key')),
+  ]
+
+
+def bench(fn, repeat=3):
+  '''Returns the best time (seconds) to run `fn`.'''
+  return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def main(count=100000):
+  vs = versions(count)
+  shapes = [('Version', vs), ('dict', [v.data() for v in vs])]
+
+  print 'query evaluation on %d versions' % count
+  print '  %-28s %-8s %12s %12s %8s' % \
+    ('query', 'shape', 'probing', 'compiled', 'speedup')
+
+  for name, query in queries(vs):
+    for shape, items in shapes:
+      naive = lambda: list(DatastoreQuery.__call__(query, items))
+      compiled = lambda: list(query(items))
+      assert naive() == compiled()
+
+      t1, t2 = bench(naive), bench(compiled)
+      print '  %-28s %-8s %9.1f ms %9.1f ms %7.2fx' % \
+        (name, shape, t1 * 1000, t2 * 1000, t1 / t2)
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:]))
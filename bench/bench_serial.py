@@ -0,0 +1,86 @@
+'''Benchmarks serial.clean against the original recursive implementation, on
+nested RandomGen objects. Run from the repository root:
+
+    python -m bench.bench_serial [count]
+
+'''
+
+import sys
+import random
+import timeit
+import datetime
+import nanotime
+
+from dronestore.util import serial
+from dronestore.util.serial import SerialRepresentation
+from test.util import RandomGen
+
+
+def recursive_clean(value):
+  '''The original serial.clean: an isinstance chain, applied recursively.'''
+
+  if isinstance(value, dict):
+    value = dict([(recursive_clean(k), recursive_clean(v)) \
+      for k, v in value.items()])
+  elif isinstance(value, list) or isinstance(value, tuple):
+    value = [recursive_clean(v) for v in value]
+  elif isinstance(value, int) or isinstance(value, long):
+    pass
+  elif isinstance(value, float):
+    pass
+  elif isinstance(value, str):
+    pass
+  elif isinstance(value, unicode):
+    pass
+  elif isinstance(value, bool):
+    pass
+  elif isinstance(value, nanotime.nanotime):
+    value = value.nanoseconds()
+  elif isinstance(value, datetime.datetime):
+    pass
+  elif value is None:
+    pass
+  else: # catch all... turn it into a string!
+    value = str(value)
+  return value
+
+
+def random_objects(count, seed=0):
+  '''Returns `count` nested RandomGen dicts.'''
+  random.seed(seed)
+  objects = []
+  for i in xrange(0, count):
+    RandomGen.DEPTH = 0 # RandomGen never fully unwinds its depth.
+    objects.append(RandomGen.randomDict())
+  return objects
+
+
+def bench(fn, objects, repeat=5):
+  '''Returns the best time (seconds) to apply `fn` to all `objects`.'''
+  def run():
+    for obj in objects:
+      fn(obj)
+  return min(timeit.repeat(run, number=1, repeat=repeat))
+
+
+def main(count=1000):
+  objects = random_objects(count)
+  for obj in objects:
+    assert serial.clean(obj) == recursive_clean(obj)
+
+  results = [
+    ('clean (recursive)', bench(recursive_clean, objects)),
+    ('clean (dispatch)', bench(serial.clean, objects)),
+    ('SerialRepresentation', bench(SerialRepresentation, objects)),
+    ('SerialRepresentation (trusted)', \
+      bench(lambda o: SerialRepresentation(o, trusted=True), objects)),
+  ]
+
+  print 'serial.clean on %d RandomGen objects' % count
+  for name, seconds in results:
+    print '  %-32s %9.3f ms' % (name, seconds * 1000)
+  print '  speedup: %.2fx' % (results[0][1] / results[1][1])
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:]))
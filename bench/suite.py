@@ -0,0 +1,357 @@
+'''The benchmark suite of the core hot paths. Run from the repository root:
+
+    python -m bench.suite [options] [benchmark ...]
+
+Each benchmark runs over a grid of fixtures: models `--widths` attributes
+wide, holding `--values` (flat: short RandomGen strings; nested: RandomGen
+dicts), in collections of `--sizes` objects. Results are the best time per
+object (per operation) out of `--repeat` runs.
+
+Results can be saved (`--output results.json`), and compared against saved
+ones (`--baseline results.json`): benchmarks slower than the baseline by
+more than `--threshold` are regressions, and make the run exit with 1.
+Results are only comparable when taken on the same machine.
+
+    python -m bench.suite -o before.json
+    ... (upgrade)
+    python -m bench.suite -b before.json
+
+'''
+
+import gc
+import sys
+import json
+import random
+import platform
+import datetime
+import optparse
+
+from timeit import default_timer
+
+import dronestore
+import datastore.core
+
+from test.util import RandomGen
+from dronestore import Model, Version, Repo, Query
+from dronestore import StringAttribute, DictAttribute
+from dronestore.util import serial
+
+
+# fixtures
+
+_models = {}
+
+def model(width, values):
+  '''Returns the model with `width` attributes of kind `values`.'''
+  name = 'Bench%s%d' % (values.capitalize(), width)
+  if name not in _models:
+    attrs = {}
+    for i in xrange(0, width):
+      if values == 'flat':
+        attrs['a%d' % i] = StringAttribute()
+      else:
+        attrs['a%d' % i] = DictAttribute(value_type=object)
+    _models[name] = type(name, (Model,), attrs)
+  return _models[name]
+
+
+def value(values, rand):
+  '''Returns a random value of kind `values`.'''
+  random.seed(rand.random()) # RandomGen draws from the random module.
+  if values == 'flat':
+    return RandomGen.randomString()
+
+  depth = RandomGen.MAX_DEPTH
+  RandomGen.DEPTH, RandomGen.MAX_DEPTH = 0, 3
+  try:
+    return RandomGen.randomDict()
+  finally:
+    RandomGen.MAX_DEPTH = depth
+
+
+class Fixture(object):
+  '''`size` committed instances of model(`width`, `values`), and remote
+  versions diverged from them (a different attribute changed).'''
+
+  def __init__(self, width, values, size, seed=0):
+    self.params = {'width': width, 'values': values, 'size': size}
+    self.model = model(width, values)
+    self.size = size
+
+    rand = random.Random(seed)
+    self.instances = []
+    self.remotes = []
+    self.changes = [] # a new value of a0, for each instance
+    for i in xrange(0, size):
+      instance = self.model('K%d' % i)
+      for name in instance.attributes():
+        setattr(instance, name, value(values, rand))
+      instance.commit()
+
+      remote = self.model(instance.version)
+      setattr(remote, 'a%d' % (width - 1), value(values, rand))
+      remote.commit()
+      instance.a0 = value(values, rand)
+      instance.commit()
+
+      self.instances.append(instance)
+      self.remotes.append(remote.version)
+      self.changes.append(value(values, rand))
+
+    self.versions = [instance.version for instance in self.instances]
+    self.datas = [version.data() for version in self.versions]
+
+  def repo(self):
+    '''Returns a Repo holding the instances.'''
+    repo = Repo('/bench', datastore.DictDatastore())
+    repo.put_many(self.instances)
+    return repo
+
+
+# benchmarks: each returns a function running the operation once per object
+# of the fixture. they are called anew (untimed) before every run.
+
+def bench_commit(fixture):
+  instances, changes = fixture.instances, fixture.changes
+  def run():
+    for i, instance in enumerate(instances):
+      instance.a0, changes[i] = changes[i], instance.a0 # swap every run.
+      instance.commit()
+  return run
+
+
+def bench_computedHash(fixture):
+  instances = fixture.instances
+  def run():
+    for instance in instances:
+      instance.computedHash()
+  return run
+
+
+def bench_clean(fixture):
+  datas = fixture.datas
+  def run():
+    for data in datas:
+      serial.clean(data)
+  return run
+
+
+def bench_version(fixture):
+  datas = fixture.datas
+  def run():
+    for data in datas:
+      Version(serial.SerialRepresentation(data))
+  return run
+
+
+def bench_version_from_data(fixture):
+  datas = fixture.datas
+  def run():
+    for data in datas:
+      Version.from_data(data, decoder=None)
+  return run
+
+
+def bench_repo_put(fixture):
+  repo = Repo('/bench', datastore.DictDatastore())
+  instances = fixture.instances
+  def run():
+    for instance in instances:
+      repo.put(instance)
+  return run
+
+
+def bench_repo_get(fixture):
+  repo = fixture.repo()
+  keys = [instance.key for instance in fixture.instances]
+  def run():
+    for key in keys:
+      repo.get(key)
+  return run
+
+
+def bench_repo_merge(fixture):
+  repo = fixture.repo()
+  remotes = fixture.remotes
+  def run():
+    for remote in remotes:
+      repo.merge(remote)
+  return run
+
+
+def bench_query_instances(fixture):
+  repo = fixture.repo()
+  query = Query(fixture.model)
+  def run():
+    list(repo.query(query))
+  return run
+
+
+def bench_query_filter_order(fixture):
+  versions = fixture.versions
+  middle = sorted([v.committed for v in versions])[len(versions) / 2]
+  query = Query(fixture.model).filter('committed', '>=', middle) \
+    .order('-key')
+  def run():
+    list(query(versions))
+  return run
+
+
+BENCHMARKS = [
+  ('model.commit', bench_commit),
+  ('model.computedHash', bench_computedHash),
+  ('serial.clean', bench_clean),
+  ('version', bench_version),
+  ('version.from_data', bench_version_from_data),
+  ('repo.put', bench_repo_put),
+  ('repo.get', bench_repo_get),
+  ('repo.merge', bench_repo_merge),
+  ('query.instances', bench_query_instances),
+  ('query.filter_order', bench_query_filter_order),
+]
+
+
+# running
+
+def timed(make, repeat):
+  '''Returns the times (seconds) of `repeat` runs of a fresh `make()`.'''
+  times = []
+  for i in xrange(0, repeat):
+    run = make()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+      start = default_timer()
+      run()
+      times.append(default_timer() - start)
+    finally:
+      if enabled:
+        gc.enable()
+  return times
+
+
+def resultKey(result):
+  '''Identifies `result` across runs, e.g. repo.get[size=100,...].'''
+  params = ','.join(['%s=%s' % p for p in sorted(result['params'].items())])
+  return '%s[%s]' % (result['name'], params)
+
+
+def run(names, widths, values, sizes, repeat=5, out=sys.stdout):
+  '''Runs the benchmarks `names` on the grid of fixtures. Returns the
+  results, as dicts.'''
+  results = []
+  for width in widths:
+    for kind in values:
+      for size in sizes:
+        fixture = Fixture(width, kind, size)
+        for name, bench in BENCHMARKS:
+          if name not in names:
+            continue
+
+          times = timed(lambda: bench(fixture), repeat)
+          result = {
+            'name': name,
+            'params': fixture.params,
+            'seconds': min(times) / size, # per operation
+            'times': times,
+          }
+          results.append(result)
+          print >> out, '  %-56s %10.2f us/op' % \
+            (resultKey(result), result['seconds'] * 1e6)
+  return results
+
+
+def document(results):
+  '''Returns the results, with a description of where they were taken.'''
+  return {
+    'meta': {
+      'date': datetime.datetime.utcnow().isoformat(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'machine': platform.node(),
+      'dronestore': dronestore.__version__,
+    },
+    'results': results,
+  }
+
+
+def compare(results, baseline, threshold):
+  '''Returns (key, baseline seconds, seconds, change) of the results also in
+  `baseline`, and the keys of regressions (change above `threshold`).'''
+  before = dict([(resultKey(r), r['seconds']) for r in baseline['results']])
+  rows = []
+  regressions = []
+  for result in results:
+    key = resultKey(result)
+    if key not in before:
+      continue
+    change = result['seconds'] / before[key] - 1
+    rows.append((key, before[key], result['seconds'], change))
+    if change > threshold:
+      regressions.append(key)
+  return rows, regressions
+
+
+def _list(cast):
+  return lambda option, opt, value, parser: \
+    setattr(parser.values, option.dest, map(cast, value.split(',')))
+
+
+def main(argv=None):
+  names = [name for name, bench in BENCHMARKS]
+  parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]',
+    description='Benchmarks: %s.' % ', '.join(names))
+  parser.add_option('--widths', type='string', action='callback',
+    callback=_list(int), default=[4, 32], help='attributes per model')
+  parser.add_option('--values', type='string', action='callback',
+    callback=_list(str), default=['flat', 'nested'],
+    help='attribute values: flat and/or nested')
+  parser.add_option('--sizes', type='string', action='callback',
+    callback=_list(int), default=[100, 1000], help='objects per collection')
+  parser.add_option('-r', '--repeat', type='int', default=5,
+    help='runs of each benchmark (the best counts)')
+  parser.add_option('-q', '--quick', action='store_true',
+    help='a small grid: --widths 4 --sizes 100 --repeat 3')
+  parser.add_option('-o', '--output', help='save the results as json')
+  parser.add_option('-b', '--baseline', help='compare with saved results')
+  parser.add_option('-t', '--threshold', type='float', default=0.1,
+    help='slowdown counted as a regression (default 0.1, i.e. 10%)')
+  options, args = parser.parse_args(argv)
+
+  for name in args:
+    if name not in names:
+      parser.error('unknown benchmark: %s' % name)
+  for kind in options.values:
+    if kind not in ('flat', 'nested'):
+      parser.error('unknown values: %s' % kind)
+  if options.quick:
+    options.widths, options.sizes, options.repeat = [4], [100], 3
+
+  results = run(args or names, options.widths, options.values, \
+    options.sizes, options.repeat)
+
+  if options.output:
+    with open(options.output, 'w') as f:
+      json.dump(document(results), f, indent=2, sort_keys=True)
+
+  if options.baseline:
+    with open(options.baseline) as f:
+      baseline = json.load(f)
+    rows, regressions = compare(results, baseline, options.threshold)
+
+    print
+    print 'compared with %s (%s):' % (options.baseline, \
+      baseline['meta']['date'])
+    for key, before, after, change in rows:
+      flag = ' REGRESSION' if key in regressions else ''
+      print '  %-56s %8.2f -> %8.2f us/op %+7.1f%%%s' % \
+        (key, before * 1e6, after * 1e6, change * 100, flag)
+    if regressions:
+      print '%d regression(s) above %d%%' % \
+        (len(regressions), options.threshold * 100)
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
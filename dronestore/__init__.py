@@ -9,6 +9,7 @@ __version__ = '0.2.8'
 from model import Key
 from model import Version
 from model import Model
+from model import InstanceView
 
 # attributes
 from attribute import Attribute
@@ -40,6 +41,15 @@ Drone = Repo
 # query
 from query import Query
 
+# codecs
+from codec import JSONCodec
+from codec import BSONCodec
+from codec import BinaryCodec
+
+# caching and history
+from cache import VersionCache
+from history import HistoryStore
+
 # basic datastores
 from datastore.core import Datastore
 from datastore.core import DictDatastore
@@ -0,0 +1,269 @@
+'''
+A non-blocking facade for Repos whose datastores block (e.g. on the network).
+
+AsyncRepo runs Repo operations on an executor and returns futures right
+away::
+
+    arepo = AsyncRepo(repo, workers=16)
+    future = arepo.get(Key('/PersonM:A'))
+    ...
+    person = future.result()
+
+Operations on the same key run one at a time, in submission order, so
+concurrent merges of a key never interleave (and a get sees the puts
+submitted before it). Operations on different keys run concurrently, up to
+the number of workers. With `maxPending`, submitting blocks while that many
+operations are in flight.
+
+By default, operations run on a bounded pool of threads (ThreadExecutor).
+Any executor with a `submit(fn, *args)` method returning futures (such as a
+concurrent.futures executor, or one driven by an event loop) can be used
+instead.
+'''
+
+import sys
+import Queue
+import threading
+
+from itertools import islice
+
+
+class Future(object):
+  '''The result of an operation that may not have finished yet.'''
+
+  def __init__(self):
+    self._done = threading.Event()
+    self._lock = threading.Lock()
+    self._callbacks = []
+    self._result = None
+    self._exc_info = None
+
+  def done(self):
+    return self._done.is_set()
+
+  def result(self, timeout=None):
+    '''Waits (at most `timeout` seconds) for the result, and returns it.
+    Raises the exception of the operation, if it failed.'''
+    if not self._done.wait(timeout):
+      raise RuntimeError('operation not done after %s seconds' % timeout)
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def exception(self, timeout=None):
+    '''Waits for the operation, and returns its exception (or None).'''
+    if not self._done.wait(timeout):
+      raise RuntimeError('operation not done after %s seconds' % timeout)
+    return self._exc_info and self._exc_info[1]
+
+  def add_done_callback(self, fn):
+    '''Calls `fn(future)` once done (right away, if it already is).'''
+    with self._lock:
+      if not self._done.is_set():
+        self._callbacks.append(fn)
+        return
+    fn(self)
+
+  def set_result(self, result):
+    self._result = result
+    self._finish()
+
+  def set_exception(self, exc_info):
+    '''Fails the operation, with `exc_info` as returned by sys.exc_info().'''
+    self._exc_info = exc_info
+    self._finish()
+
+  def _finish(self):
+    with self._lock:
+      self._done.set()
+      callbacks, self._callbacks = self._callbacks, []
+    for fn in callbacks:
+      fn(self)
+
+
+class ThreadExecutor(object):
+  '''Runs submitted calls on a fixed number of `workers` threads.'''
+
+  def __init__(self, workers=8):
+    self._queue = Queue.Queue()
+    self._threads = []
+    for i in xrange(0, workers):
+      thread = threading.Thread(target=self._work)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def _work(self):
+    while True:
+      task = self._queue.get()
+      if task is None:
+        return # shutdown.
+
+      future, fn, args, kwargs = task
+      try:
+        result = fn(*args, **kwargs)
+      except:
+        future.set_exception(sys.exc_info())
+      else:
+        future.set_result(result)
+
+  def submit(self, fn, *args, **kwargs):
+    '''Schedules `fn(*args, **kwargs)`. Returns its Future.'''
+    future = Future()
+    self._queue.put((future, fn, args, kwargs))
+    return future
+
+  def shutdown(self, wait=True):
+    '''Stops the workers once the calls already submitted are done.'''
+    for thread in self._threads:
+      self._queue.put(None)
+    if wait:
+      for thread in self._threads:
+        thread.join()
+
+
+class AsyncRepo(object):
+  '''Runs the operations of `repo` on `executor` (default: a ThreadExecutor
+  of `workers` threads), serialized per key. All methods return Futures.'''
+
+  def __init__(self, repo, executor=None, workers=8, maxPending=None):
+    self.repo = repo
+    self._ownsExecutor = executor is None
+    self._executor = executor or ThreadExecutor(workers)
+    self._pending = None
+    if maxPending is not None:
+      self._pending = threading.BoundedSemaphore(maxPending)
+
+    self._lock = threading.Lock()
+    self._tails = {} # key -> future of the last operation submitted on it
+
+  def _submit(self, keys, fn, *args):
+    '''Runs `fn(*args)` once the operations previously submitted on `keys`
+    are done. Returns its Future.'''
+    if self._pending is not None:
+      self._pending.acquire()
+
+    future = Future()
+    keys = set(keys)
+    with self._lock:
+      previous = set([self._tails[k] for k in keys if k in self._tails])
+      for key in keys:
+        self._tails[key] = future
+
+    waiting = [len(previous) + 1]
+    def ready(_):
+      with self._lock:
+        waiting[0] -= 1
+        if waiting[0]:
+          return
+      self._executor.submit(fn, *args).add_done_callback(finished)
+
+    def finished(inner):
+      with self._lock:
+        for key in keys:
+          if self._tails.get(key) is future:
+            del self._tails[key]
+      if self._pending is not None:
+        self._pending.release()
+
+      exception = inner.exception()
+      if exception is None:
+        future.set_result(inner.result())
+      elif hasattr(inner, '_exc_info'):
+        future.set_exception(inner._exc_info)
+      else:
+        future.set_exception((type(exception), exception, None))
+
+    for other in previous:
+      other.add_done_callback(ready)
+    ready(None)
+    return future
+
+  @staticmethod
+  def _keyOf(versionOrEntity):
+    return str(versionOrEntity.key)
+
+  def get(self, key):
+    return self._submit([str(key)], self.repo.get, key)
+
+  def get_many(self, keys):
+    return self._submit(map(str, keys), self.repo.get_many, keys)
+
+  def contains(self, key):
+    return self._submit([str(key)], self.repo.contains, key)
+
+  def put(self, versionOrEntity):
+    return self._submit([self._keyOf(versionOrEntity)], self.repo.put, \
+      versionOrEntity)
+
+  def put_many(self, versionsOrEntities):
+    versionsOrEntities = list(versionsOrEntities)
+    return self._submit(map(self._keyOf, versionsOrEntities), \
+      self.repo.put_many, versionsOrEntities)
+
+  def merge(self, versionOrEntity):
+    return self._submit([self._keyOf(versionOrEntity)], self.repo.merge, \
+      versionOrEntity)
+
+  def merge_many(self, versionsOrEntities):
+    versionsOrEntities = list(versionsOrEntities)
+    return self._submit(map(self._keyOf, versionsOrEntities), \
+      self.repo.merge_many, versionsOrEntities)
+
+  def delete(self, key):
+    return self._submit([str(key)], self.repo.delete, key)
+
+  def delete_many(self, keys):
+    return self._submit(map(str, keys), self.repo.delete_many, keys)
+
+  def query(self, query, views=False):
+    '''Returns a Future of the list of results of `query`.'''
+    return self._submit([], lambda: list(self.repo.query(query, views)))
+
+  def iterate(self, query, batchSize=100, views=False):
+    '''Returns an AsyncCursor over the results of `query`.'''
+    return AsyncCursor(self, query, batchSize, views)
+
+  def shutdown(self, wait=True):
+    '''Shuts down the executor, if this AsyncRepo created it.'''
+    if self._ownsExecutor:
+      self._executor.shutdown(wait)
+
+
+class AsyncCursor(object):
+  '''Iterates over the results of a query in batches of `batchSize`, read by
+  the executor of an AsyncRepo. `next()` returns a Future of the next batch
+  (an empty list once exhausted), and prefetches the one after it.
+
+  Iterating over the cursor itself yields the results, waiting as needed.
+  '''
+
+  def __init__(self, asyncRepo, query, batchSize=100, views=False):
+    self._asyncRepo = asyncRepo
+    self._query = query
+    self._views = views
+    self.batchSize = batchSize
+    self._iterator = None
+    self._next = self._prefetch()
+
+  def _prefetch(self):
+    # fetches of a cursor are serialized on the cursor itself.
+    return self._asyncRepo._submit([self], self._fetch)
+
+  def _fetch(self):
+    if self._iterator is None:
+      self._iterator = iter(self._asyncRepo.repo.query(self._query, self._views))
+    return list(islice(self._iterator, self.batchSize))
+
+  def next(self):
+    '''Returns a Future of the next batch of results.'''
+    future, self._next = self._next, self._prefetch()
+    return future
+
+  def __iter__(self):
+    while True:
+      batch = self.next().result()
+      if not batch:
+        return
+      for result in batch:
+        yield result
@@ -1,5 +1,6 @@
 
 import datetime
+import hashlib
 import nanotime
 
 import merge
@@ -12,13 +13,19 @@ class Attribute(object):
   An Attribute primarily defines a name, an associated data type, and a
   particular merge strategy.
 
-  Attributes can have other options, including defining a default value, and
-  validation for the data they hold.
+  Attributes can have other options, including defining a default value,
+  validation for the data they hold, and whether Repos should index their
+  values (see dronestore.index).
   '''
   data_type = str
   default_strategy = merge.LatestObjectStrategy
 
-  def __init__(self, name=None, default=None, required=False, strategy=None):
+  # whether values may be changed in place (bypassing __set__). The digests of
+  # such attributes cannot be cached.
+  mutable = False
+
+  def __init__(self, name=None, default=None, required=False, strategy=None,
+               indexed=False):
 
     if not strategy:
       strategy = self.default_strategy
@@ -33,6 +40,7 @@ class Attribute(object):
     self.name = name
     self.default = default
     self.required = required
+    self.indexed = indexed
     self.mergeStrategy = strategy
 
 
@@ -56,8 +64,41 @@ class Attribute(object):
       return None
 
   def setRawData(self, instance, rawData):
+    # copy, so that later changes do not leak into the source (e.g. a Version)
+    rawData = dict(rawData)
+    if 'value' in rawData:
+      rawData['value'] = self._track(instance, rawData['value'])
     setattr(instance, self._attr_name(), rawData)
+    self._changed(instance)
+
+  def _changed(self, instance):
+    '''Marks `instance` dirty and drops its cached digest of this attribute.'''
     instance._isDirty = True
+    digests = getattr(instance, '_digests', None)
+    if digests:
+      digests.pop(self.name, None)
+
+  def _track(self, instance, raw):
+    '''Hook to bind a raw value before storing it in `instance`.'''
+    return raw
+
+  def digest(self, instance):
+    '''Returns the sha1 digest of this attribute's raw data in `instance`.
+
+    Digests are cached in the instance until the attribute is set again, so
+    hashing a model only pays for the attributes that changed.
+    '''
+    digests = instance._digests
+    try:
+      return digests[self.name]
+    except KeyError:
+      pass
+
+    buf = '%s=%s,' % (self.name, self.rawData(instance))
+    digest = hashlib.sha1(buf).digest()
+    if not self.mutable:
+      digests[self.name] = digest
+    return digest
 
   def __get__(self, instance, model_class):
     '''Descriptor to aid model instantiation.'''
@@ -88,9 +129,9 @@ class Attribute(object):
       if value is not None and oldval is not None and oldval == value:
         return
 
-    rawData['value'] = self.dumps(value)
-    instance._isDirty = True
+    rawData['value'] = self._track(instance, self.dumps(value))
     self.mergeStrategy.setAttribute(instance, rawData, default=default)
+    self._changed(instance)
 
   def default_value(self):
     '''The default value for a particular attribute.'''
@@ -321,8 +362,151 @@ class DateTimeAttribute(TimeAttribute):
 
 
 
+def _tracked(value, owner):
+  '''Returns a tracked copy of `value` if it is a list or dict.'''
+  if isinstance(value, dict):
+    return TrackedDict(value, owner)
+  if isinstance(value, (list, tuple)):
+    return TrackedList(value, owner)
+  return value
+
+
+class TrackedList(list):
+  '''A list that calls `owner` whenever it (or a nested list or dict within
+  it) is changed in place. Copies and pickles are plain lists.
+  '''
+  __slots__ = ('_owner',)
+
+  def __init__(self, iterable=(), owner=None):
+    self._owner = owner
+    list.__init__(self, [_tracked(v, owner) for v in iterable])
+
+  def _changed(self):
+    if self._owner:
+      self._owner()
+
+  def __reduce_ex__(self, protocol):
+    return list, (list(self),)
+
+  def __setitem__(self, index, value):
+    if isinstance(index, slice):
+      value = [_tracked(v, self._owner) for v in value]
+    else:
+      value = _tracked(value, self._owner)
+    list.__setitem__(self, index, value)
+    self._changed()
+
+  def __delitem__(self, index):
+    list.__delitem__(self, index)
+    self._changed()
+
+  def __setslice__(self, i, j, sequence):
+    list.__setslice__(self, i, j, [_tracked(v, self._owner) for v in sequence])
+    self._changed()
+
+  def __delslice__(self, i, j):
+    list.__delslice__(self, i, j)
+    self._changed()
+
+  def __iadd__(self, sequence):
+    self.extend(sequence)
+    return self
+
+  def __imul__(self, count):
+    list.__imul__(self, count)
+    self._changed()
+    return self
+
+  def append(self, value):
+    list.append(self, _tracked(value, self._owner))
+    self._changed()
+
+  def extend(self, sequence):
+    list.extend(self, [_tracked(v, self._owner) for v in sequence])
+    self._changed()
+
+  def insert(self, index, value):
+    list.insert(self, index, _tracked(value, self._owner))
+    self._changed()
+
+  def pop(self, *args):
+    value = list.pop(self, *args)
+    self._changed()
+    return value
+
+  def remove(self, value):
+    list.remove(self, value)
+    self._changed()
+
+  def reverse(self):
+    list.reverse(self)
+    self._changed()
+
+  def sort(self, *args, **kwds):
+    list.sort(self, *args, **kwds)
+    self._changed()
+
+
+class TrackedDict(dict):
+  '''A dict that calls `owner` whenever it (or a nested list or dict within
+  it) is changed in place. Copies and pickles are plain dicts.
+  '''
+  __slots__ = ('_owner',)
+
+  def __init__(self, mapping=(), owner=None):
+    self._owner = owner
+    dict.__init__(self)
+    for key, value in dict(mapping).iteritems():
+      dict.__setitem__(self, key, _tracked(value, owner))
+
+  def _changed(self):
+    if self._owner:
+      self._owner()
+
+  def __reduce_ex__(self, protocol):
+    return dict, (dict(self),)
+
+  def __setitem__(self, key, value):
+    dict.__setitem__(self, key, _tracked(value, self._owner))
+    self._changed()
+
+  def __delitem__(self, key):
+    dict.__delitem__(self, key)
+    self._changed()
+
+  def clear(self):
+    dict.clear(self)
+    self._changed()
+
+  def pop(self, *args):
+    value = dict.pop(self, *args)
+    self._changed()
+    return value
+
+  def popitem(self):
+    item = dict.popitem(self)
+    self._changed()
+    return item
+
+  def setdefault(self, key, default=None):
+    if key in self:
+      return self[key]
+    self[key] = default
+    return self[key]
+
+  def update(self, *args, **kwds):
+    for key, value in dict(*args, **kwds).iteritems():
+      dict.__setitem__(self, key, _tracked(value, self._owner))
+    self._changed()
+
+
+
 class ListAttribute(Attribute):
-  '''Attribute to store lists.'''
+  '''Attribute to store lists.
+
+  Values are stored as tracked containers, so changing them in place (e.g.
+  `instance.tags.append('a')`) marks the instance dirty, like assignment.
+  '''
   data_type = list
   data_value_type = str
 
@@ -331,6 +515,17 @@ class ListAttribute(Attribute):
     if value_type:
       self.data_value_type = value_type
 
+  def _track(self, instance, raw):
+    '''Stores a tracked copy of `raw`, bound to `instance`.'''
+    if raw is None:
+      return raw
+    return _tracked(raw, lambda: self._mutated(instance))
+
+  def _mutated(self, instance):
+    '''Called when the value in `instance` is changed in place.'''
+    self.mergeStrategy.setAttribute(instance, self.rawData(instance))
+    self._changed(instance)
+
   def validate(self, value):
     value = super(ListAttribute, self).validate(value)
     if value is None:
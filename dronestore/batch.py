@@ -0,0 +1,162 @@
+'''
+Batch merges: merging many versions of one Model type at once, e.g. when
+reconciling whole collections::
+
+    merged = merge_batch(PersonM, localVersions, remoteVersions)
+
+With NumPy, a batch is laid out as columns (committed timestamps, attribute
+`updated` timestamps and values), and the decisions of LatestObjectStrategy,
+LatestStrategy and MaxStrategy are evaluated for the whole batch at once.
+Only the instances whose result changed are materialized and committed.
+
+Models with other strategies, or environments without NumPy, fall back to
+merge.merge, pair by pair. Both give the same results.
+'''
+
+import merge
+
+from merge import LatestObjectStrategy, LatestStrategy, MaxStrategy
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# exact types: subclasses may decide differently.
+VECTORIZED_STRATEGIES = (LatestObjectStrategy, LatestStrategy, MaxStrategy)
+
+
+def vectorizable(model):
+  '''Returns whether batches of `model` can be merged column-wise.'''
+  if numpy is None:
+    return False
+  for name, strategy, accessor in model._mergePlan:
+    if type(strategy) not in VECTORIZED_STRATEGIES:
+      return False
+  return True
+
+
+def _version(versionOrInstance):
+  return getattr(versionOrInstance, 'version', versionOrInstance)
+
+
+def merge_batch(model, locals, remotes):
+  '''Merges each of `remotes` into the corresponding version of `locals`
+  (committed Versions or instances of `model`). Returns, for each pair, the
+  merged instance of `model`, or None if the local version is unchanged.'''
+  locals = map(_version, locals)
+  remotes = map(_version, remotes)
+  if len(locals) != len(remotes):
+    raise ValueError('Batch sizes differ: %d != %d' % \
+      (len(locals), len(remotes)))
+
+  for version in locals:
+    if version.isBlank:
+      raise ValueError('Cannot merge uncommitted instance.')
+
+  if not vectorizable(model):
+    return map(lambda l, r: _merge_pair(model, l, r), locals, remotes)
+  return _merge_columns(model, locals, remotes)
+
+
+def _merge_pair(model, local, remote):
+  instance = model(local)
+  merge.merge(instance, remote)
+  if instance.version.hash == local.hash:
+    return None
+  return instance
+
+
+def _objects(items):
+  '''Returns a 1-d object array of `items` (without unpacking them).'''
+  column = numpy.empty(len(items), dtype=object)
+  column[:] = items
+  return column
+
+
+def _truthy(payloads):
+  return numpy.array(map(bool, payloads), dtype=bool)
+
+
+def _stamped(payloads):
+  return numpy.fromiter((bool(p) and 'updated' in p for p in payloads), \
+    dtype=bool, count=len(payloads))
+
+
+def _fields(field, remotes, hasRemote, locals, hasLocal):
+  '''Returns the columns of `field` of the `remotes` and `locals` payloads
+  (where `hasRemote` and `hasLocal`; the other rows are placeholders, never
+  decided on). Values only make numeric columns if they are all ints, or
+  all floats: NumPy would compare a mix of them as floats, unlike Python.
+  Others make object columns, compared as Python does.'''
+  rows = [zip(remotes, hasRemote.tolist()), zip(locals, hasLocal.tolist())]
+  types = set([type(p[field]) for column in rows for p, h in column if h])
+  if types == set([int]) or types == set([float]):
+    placeholder = types.pop()()
+    return [numpy.array([p[field] if h else placeholder for p, h in column]) \
+      for column in rows]
+  return [_objects([p[field] if h else None for p, h in column]) \
+    for column in rows]
+
+
+def _decisions(strategy, newer, attr_local, attr_remote):
+  '''Returns the rows where `strategy` takes the remote data, as
+  strategy.mergeData would decide them.'''
+  remote = _truthy(attr_remote)
+
+  if type(strategy) is LatestObjectStrategy:
+    return newer & remote
+
+  if type(strategy) is LatestStrategy:
+    remote = _stamped(attr_remote)
+    local = _stamped(attr_local)
+    updated_remote, updated_local = \
+      _fields('updated', attr_remote, remote, attr_local, local)
+    return remote & (~local | (updated_remote > updated_local))
+
+  # MaxStrategy
+  local = _truthy(attr_local)
+  value_remote, value_local = \
+    _fields('value', attr_remote, remote, attr_local, local)
+  return remote & (~local | (value_remote > value_local))
+
+
+def _merge_columns(model, locals, remotes):
+  count = len(locals)
+  committed_local = numpy.array([v._committed for v in locals], \
+    dtype=numpy.int64)
+  committed_remote = numpy.array([v._committed for v in remotes], \
+    dtype=numpy.int64)
+  newer = committed_remote > committed_local
+
+  changed = numpy.zeros(count, dtype=bool)
+  taken = []
+  for name, strategy, accessor in model._mergePlan:
+    attr_local = map(accessor, locals)
+    attr_remote = map(accessor, remotes)
+
+    # only rows whose payloads differ need a decision.
+    rows = numpy.flatnonzero(_objects(attr_local) != _objects(attr_remote))
+    if not len(rows):
+      continue
+
+    indices = rows.tolist()
+    take = _decisions(strategy, newer[rows], \
+      [attr_local[i] for i in indices], [attr_remote[i] for i in indices])
+    if take.any():
+      mask = numpy.zeros(count, dtype=bool)
+      mask[rows[take]] = True
+      taken.append((strategy.attribute, mask, attr_remote))
+      changed |= mask
+
+  merged = [None] * count
+  for i in numpy.flatnonzero(changed):
+    instance = model(locals[i])
+    for attr, take, attr_remote in taken:
+      if take[i]:
+        attr.setRawData(instance, attr_remote[i])
+    instance.commit()
+    if instance.version.hash != locals[i].hash:
+      merged[i] = instance
+  return merged
@@ -0,0 +1,201 @@
+'''
+A read-through cache of decoded versions (or materialized instances), for
+Repos serving the same hot keys over and over::
+
+    repo = Repo('/repo', store, cache=VersionCache(size=10000, ttl=60))
+
+Entries are keyed by version hash. By default (`validate=True`), every get
+still reads the stored value, but only to compare its hash: on a hit, the
+decoding and instantiation are skipped, and a stale entry can never be
+returned. With `validate=False`, the store is not read at all on a hit, and
+freshness relies on the repo's own writes invalidating the cache. Only use it
+when no one else writes to the datastore.
+
+In 'model' mode, the cache holds materialized Model instances and Repo.get
+returns them shared. An instance changed by its holder (dirty, or committed
+to a different version) is never returned again; it is rebuilt instead.
+'''
+
+import time
+import threading
+
+from util import serial
+
+
+def data_size(data):
+  '''Returns the (approximate) size in bytes of stored version `data`.'''
+  if isinstance(data, basestring):
+    return len(data)
+  return len(serial.json_dumps(data))
+
+
+class _LRUDict(object):
+  '''A dict that remembers the order in which keys were set, with only what
+  VersionCache needs (collections.OrderedDict is not in Python 2.6).'''
+
+  def __init__(self):
+    self._links = {} # key -> [previous, next, key, value]
+    self._root = []
+    self.clear()
+
+  def __len__(self):
+    return len(self._links)
+
+  def __contains__(self, key):
+    return key in self._links
+
+  def __setitem__(self, key, value):
+    link = self._links.get(key)
+    if link is not None:
+      link[3] = value
+      return
+
+    root = self._root
+    last = root[0]
+    link = self._links[key] = [last, root, key, value]
+    last[1] = root[0] = link
+
+  def pop(self, key, default=None):
+    link = self._links.pop(key, None)
+    if link is None:
+      return default
+    previous, next = link[0], link[1]
+    previous[1] = next
+    next[0] = previous
+    return link[3]
+
+  def popitem(self, last=True):
+    '''Removes and returns the last (or first) (key, value) set.'''
+    if not self._links:
+      raise KeyError('dictionary is empty')
+    key = self._root[0][2] if last else self._root[1][2]
+    return key, self.pop(key)
+
+  def clear(self):
+    self._links.clear()
+    self._root[:] = [self._root, self._root, None, None]
+
+
+
+class VersionCache(object):
+  '''An LRU cache of versions, keyed by hash, bounded by number of entries
+  (`size`), age (`ttl`, in seconds) and total stored bytes (`maxbytes`).'''
+
+  MODES = ['version', 'model']
+
+  def __init__(self, size=1000, ttl=None, maxbytes=None, mode='version',
+               validate=True, sizeof=data_size):
+    if mode not in self.MODES:
+      raise ValueError('cache mode must be one of %s' % self.MODES)
+
+    self.size = size
+    self.ttl = ttl
+    self.maxbytes = maxbytes
+    self.mode = mode
+    self.validate = validate
+    self.sizeof = sizeof
+
+    self._lock = threading.Lock()
+    self._entries = _LRUDict() # hash -> (value, size, expiration, key)
+    self._hashes = {} # key -> hash of its cached entry
+    self._bytes = 0
+    self._stats = dict.fromkeys(['hits', 'misses', 'stale', 'evictions', \
+      'expirations', 'invalidations'], 0)
+
+  def __len__(self):
+    return len(self._entries)
+
+  def stats(self):
+    '''Returns a dict of counters, plus the current entries and bytes.'''
+    with self._lock:
+      stats = dict(self._stats)
+      stats['entries'] = len(self._entries)
+      stats['bytes'] = self._bytes
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+    return stats
+
+  def hashOf(self, key):
+    '''Returns the hash of the cached version of `key`, if any.'''
+    return self._hashes.get(str(key))
+
+  def get(self, hash):
+    '''Returns the value cached for `hash`, or None.'''
+    with self._lock:
+      entry = self._entries.pop(hash, None)
+      if entry is None:
+        self._stats['misses'] += 1
+        return None
+
+      value, size, expiration, key = entry
+      if expiration is not None and expiration < time.time():
+        self._dropped(hash, entry)
+        self._stats['expirations'] += 1
+        self._stats['misses'] += 1
+        return None
+
+      if self.mode == 'model' and \
+         (value.isDirty() or value.version.hash != hash):
+        self._dropped(hash, entry)
+        self._stats['stale'] += 1
+        self._stats['misses'] += 1
+        return None
+
+      self._entries[hash] = entry # most recently used.
+      self._stats['hits'] += 1
+      return value
+
+  def put(self, key, hash, value, data):
+    '''Caches `value` (a Version or Model) of `key` under `hash`. `data` is
+    the stored value, used to compute the entry size.'''
+    size = self.sizeof(data) if self.maxbytes is not None else 0
+    if self.maxbytes is not None and size > self.maxbytes:
+      return # would evict everything else.
+
+    expiration = time.time() + self.ttl if self.ttl is not None else None
+
+    key = str(key)
+    with self._lock:
+      old = self._entries.pop(hash, None)
+      if old is not None:
+        self._dropped(hash, old)
+
+      # a key has (at most) one cached version.
+      previous = self._hashes.get(key)
+      if previous is not None and previous in self._entries:
+        self._dropped(previous, self._entries.pop(previous))
+
+      self._entries[hash] = (value, size, expiration, key)
+      self._hashes[key] = hash
+      self._bytes += size
+      self._evict()
+
+  def _dropped(self, hash, entry):
+    '''Accounts for `entry` (of `hash`), just removed from the entries.'''
+    self._bytes -= entry[1]
+    if self._hashes.get(entry[3]) == hash:
+      del self._hashes[entry[3]]
+
+  def _evict(self):
+    '''Evicts least recently used entries until within bounds.'''
+    while len(self._entries) > self.size or \
+        (self.maxbytes is not None and self._bytes > self.maxbytes):
+      hash, entry = self._entries.popitem(last=False)
+      self._dropped(hash, entry)
+      self._stats['evictions'] += 1
+
+  def invalidate(self, key):
+    '''Drops the cached version of `key`, if any.'''
+    with self._lock:
+      hash = self._hashes.get(str(key))
+      entry = self._entries.pop(hash, None) if hash else None
+      if entry is not None:
+        self._dropped(hash, entry)
+        self._stats['invalidations'] += 1
+
+  def clear(self):
+    '''Drops all entries. Statistics are kept.'''
+    with self._lock:
+      self._entries.clear()
+      self._hashes.clear()
+      self._bytes = 0
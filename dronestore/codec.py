@@ -0,0 +1,351 @@
+'''
+Codecs convert version data to and from strings of bytes, so that Repos can
+store versions in datastores that hold strings (files, network services...).
+
+Three codecs are provided:
+
+  JSONCodec   -- human readable. Strings decode as str, tuples as lists.
+  BSONCodec   -- BSON documents. Datetimes are truncated to milliseconds.
+  BinaryCodec -- compact and exact. Hashes are stored as 20 raw bytes, times as
+                 64 bit integers, and attribute payloads are decoded lazily.
+
+Usage::
+
+    repo = Repo('/repo', store, codec=BinaryCodec())
+
+'''
+
+import struct
+import datetime
+import binascii
+
+from .model import Version
+from .util import serial
+
+try:
+  import bson
+except ImportError:
+  bson = None
+
+
+class CodecError(ValueError):
+  pass
+
+
+
+class VersionCodec(object):
+  '''A VersionCodec encodes version data (see Version.data) into a string,
+  and decodes it back.'''
+
+  def encode(self, data):
+    '''Returns version `data` encoded as a string.'''
+    raise NotImplementedError
+
+  def decode(self, blob):
+    '''Returns the version data encoded in `blob`.'''
+    raise NotImplementedError
+
+  def decode_header(self, blob):
+    '''Returns the version data encoded in `blob`, without its attributes.'''
+    data = self.decode(blob)
+    del data['attributes']
+    return data
+
+  def version(self, blob):
+    '''Returns the Version encoded in `blob`.'''
+    return Version.from_data(self.decode(blob), decoder=None)
+
+
+
+class JSONCodec(VersionCodec):
+  '''Encodes versions as JSON.'''
+
+  def encode(self, data):
+    return serial.json_dumps(data)
+
+  def decode(self, blob):
+    return serial.json_loads(blob)
+
+
+
+class BSONCodec(VersionCodec):
+  '''Encodes versions as BSON documents. Requires the `bson` package.'''
+
+  def __init__(self):
+    if bson is None:
+      raise ImportError('BSONCodec requires the bson package.')
+
+  def encode(self, data):
+    return bson.dumps(data)
+
+  def decode(self, blob):
+    return self._strkeys(bson.loads(blob))
+
+  @classmethod
+  def _strkeys(cls, value):
+    '''bson decodes all keys as unicode. Restore them to strs.'''
+    if isinstance(value, dict):
+      return dict([(str(k), cls._strkeys(v)) for k, v in value.iteritems()])
+    if isinstance(value, list):
+      return [cls._strkeys(v) for v in value]
+    return value
+
+
+
+
+# binary value encoding: a one byte tag, followed by the value.
+_uint16 = struct.Struct('>H')
+_uint32 = struct.Struct('>I')
+_int64 = struct.Struct('>q')
+_float64 = struct.Struct('>d')
+_datetime = struct.Struct('>HBBBBBI')
+
+_INT64_MIN, _INT64_MAX = -0x8000000000000000, 0x7fffffffffffffff
+
+
+def _encode_string(value, chunks):
+  chunks.append(_uint32.pack(len(value)))
+  chunks.append(value)
+
+def _encode_int(value, chunks):
+  if _INT64_MIN <= value <= _INT64_MAX:
+    chunks.append('i')
+    chunks.append(_int64.pack(value))
+  else:
+    chunks.append('I')
+    _encode_string(str(value), chunks)
+
+def _encode_long(value, chunks):
+  chunks.append('L')
+  _encode_string(str(value), chunks)
+
+def _encode_float(value, chunks):
+  chunks.append('d')
+  chunks.append(_float64.pack(value))
+
+def _encode_str(value, chunks):
+  chunks.append('s')
+  _encode_string(value, chunks)
+
+def _encode_unicode(value, chunks):
+  chunks.append('u')
+  _encode_string(value.encode('utf-8'), chunks)
+
+def _encode_bool(value, chunks):
+  chunks.append('T' if value else 'F')
+
+def _encode_none(value, chunks):
+  chunks.append('N')
+
+def _encode_datetime(value, chunks):
+  if value.tzinfo is not None:
+    raise CodecError('cannot encode timezone-aware datetime %s' % value)
+  chunks.append('t')
+  chunks.append(_datetime.pack(value.year, value.month, value.day, \
+    value.hour, value.minute, value.second, value.microsecond))
+
+def _encode_list(value, chunks):
+  chunks.append('l')
+  chunks.append(_uint32.pack(len(value)))
+  for item in value:
+    _encode_value(item, chunks)
+
+def _encode_dict(value, chunks):
+  chunks.append('m')
+  chunks.append(_uint32.pack(len(value)))
+  for key, item in sorted(value.iteritems()): # canonical order
+    _encode_value(key, chunks)
+    _encode_value(item, chunks)
+
+_encoders = {
+  int: _encode_int,
+  long: _encode_long,
+  float: _encode_float,
+  str: _encode_str,
+  unicode: _encode_unicode,
+  bool: _encode_bool,
+  type(None): _encode_none,
+  datetime.datetime: _encode_datetime,
+  list: _encode_list,
+  tuple: _encode_list,
+  dict: _encode_dict,
+}
+
+def _encode_value(value, chunks):
+  try:
+    encoder = _encoders[type(value)]
+  except KeyError:
+    value = serial.clean(value)
+    encoder = _encoders[type(value)]
+  encoder(value, chunks)
+
+
+def _decode_string(blob, offset):
+  length, = _uint32.unpack_from(blob, offset)
+  offset += 4
+  return blob[offset:offset + length], offset + length
+
+def _decode_value(blob, offset):
+  '''Returns the value encoded at `offset` in `blob`, and the next offset.'''
+  tag = blob[offset]
+  offset += 1
+
+  if tag == 's':
+    return _decode_string(blob, offset)
+  elif tag == 'i':
+    return _int64.unpack_from(blob, offset)[0], offset + 8
+  elif tag == 'm':
+    count, = _uint32.unpack_from(blob, offset)
+    offset += 4
+    value = {}
+    for i in xrange(0, count):
+      key, offset = _decode_value(blob, offset)
+      value[key], offset = _decode_value(blob, offset)
+    return value, offset
+  elif tag == 'l':
+    count, = _uint32.unpack_from(blob, offset)
+    offset += 4
+    value = []
+    for i in xrange(0, count):
+      item, offset = _decode_value(blob, offset)
+      value.append(item)
+    return value, offset
+  elif tag == 'N':
+    return None, offset
+  elif tag == 'T':
+    return True, offset
+  elif tag == 'F':
+    return False, offset
+  elif tag == 'd':
+    return _float64.unpack_from(blob, offset)[0], offset + 8
+  elif tag == 'u':
+    value, offset = _decode_string(blob, offset)
+    return value.decode('utf-8'), offset
+  elif tag == 'I':
+    value, offset = _decode_string(blob, offset)
+    return int(value), offset
+  elif tag == 'L':
+    value, offset = _decode_string(blob, offset)
+    return long(value), offset
+  elif tag == 't':
+    fields = _datetime.unpack_from(blob, offset)
+    return datetime.datetime(*fields), offset + _datetime.size
+
+  raise CodecError('unknown value tag %r at offset %d' % (tag, offset - 1))
+
+
+def encode_value(value):
+  '''Returns (clean) `value` in the binary value encoding. Dict items are
+  encoded in key order, so equal values of the same types encode the same.'''
+  chunks = []
+  _encode_value(value, chunks)
+  return ''.join(chunks)
+
+def decode_value(blob):
+  '''Returns the value of `blob`, in the binary value encoding.'''
+  return _decode_value(blob, 0)[0]
+
+
+
+class BinaryCodec(VersionCodec):
+  '''Encodes versions in a compact binary format:
+
+    magic     4 bytes  'DSV\\x01'
+    hash     20 bytes  raw sha1
+    parent   20 bytes  raw sha1
+    created   8 bytes  nanoseconds
+    committed 8 bytes  nanoseconds
+    key       4 byte length + utf-8
+    type      2 byte length + utf-8
+    count     4 bytes  number of attributes
+    count x   (2 byte length + name, 4 byte length + encoded payload)
+
+  The fixed-width header can be decoded without touching the attributes, and
+  `version` returns Versions that only decode the attributes accessed.
+  '''
+
+  MAGIC = 'DSV\x01'
+  _header = struct.Struct('>4s20s20sQQ')
+
+  def encode(self, data):
+    try:
+      hash = binascii.unhexlify(data['hash'])
+      parent = binascii.unhexlify(data['parent'])
+    except TypeError:
+      raise CodecError('version hashes must be hex sha1 digests')
+
+    if len(hash) != 20 or len(parent) != 20:
+      raise CodecError('version hashes must be hex sha1 digests')
+
+    key = data['key']
+    dstype = data['type']
+    if isinstance(key, unicode):
+      key = key.encode('utf-8')
+    if isinstance(dstype, unicode):
+      dstype = dstype.encode('utf-8')
+
+    chunks = [self._header.pack(self.MAGIC, hash, parent, \
+      data['created'], data['committed'])]
+    _encode_string(key, chunks)
+    chunks.append(_uint16.pack(len(dstype)))
+    chunks.append(dstype)
+
+    attributes = data['attributes']
+    chunks.append(_uint32.pack(len(attributes)))
+    for name, payload in attributes.iteritems():
+      chunks.append(_uint16.pack(len(name)))
+      chunks.append(name)
+      _encode_string(encode_value(payload), chunks)
+
+    return ''.join(chunks)
+
+  def _decode_header(self, blob):
+    '''Returns the header data and the offset of the attributes.'''
+    if not blob.startswith(self.MAGIC):
+      raise CodecError('not a binary-encoded version')
+
+    magic, hash, parent, created, committed = self._header.unpack_from(blob)
+    offset = self._header.size
+    key, offset = _decode_string(blob, offset)
+    length, = _uint16.unpack_from(blob, offset)
+    offset += 2
+    dstype = blob[offset:offset + length]
+    offset += length
+
+    data = {
+      'key': key,
+      'hash': binascii.hexlify(hash),
+      'parent': binascii.hexlify(parent),
+      'created': created,
+      'committed': committed,
+      'type': dstype,
+    }
+    return data, offset
+
+  def _encoded_attributes(self, blob, offset):
+    '''Returns a dict of attribute names to encoded payloads.'''
+    count, = _uint32.unpack_from(blob, offset)
+    offset += 4
+    attributes = {}
+    for i in xrange(0, count):
+      length, = _uint16.unpack_from(blob, offset)
+      offset += 2
+      name = blob[offset:offset + length]
+      offset += length
+      attributes[name], offset = _decode_string(blob, offset)
+    return attributes
+
+  def decode_header(self, blob):
+    return self._decode_header(blob)[0]
+
+  def decode(self, blob):
+    data, offset = self._decode_header(blob)
+    attributes = self._encoded_attributes(blob, offset)
+    data['attributes'] = dict([(n, decode_value(p)) \
+      for n, p in attributes.iteritems()])
+    return data
+
+  def version(self, blob):
+    data, offset = self._decode_header(blob)
+    data['attributes'] = self._encoded_attributes(blob, offset)
+    return Version.from_data(data, decoder=decode_value)
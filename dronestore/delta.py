@@ -0,0 +1,94 @@
+'''
+Version deltas: a version described relative to a base version the receiver
+already has, shipping only the attributes that changed.
+
+A delta holds the version's header fields, the hash of its base, the digest
+of every attribute, and the raw data of the attributes whose digest differs
+from the base's::
+
+    {'key': ..., 'hash': ..., 'parent': ..., 'created': ..., 'committed': ...,
+     'type': ..., 'base': <base hash or None>,
+     'digests': {name : digest}, 'changed': {name : rawData}}
+
+A delta without a base carries every attribute (a full transfer). Applying a
+delta to a base with a different hash raises DeltaError; the sender should
+then fall back to a full transfer.
+'''
+
+import hashlib
+
+from model import Version
+
+
+class DeltaError(ValueError):
+  pass
+
+
+HEADER_FIELDS = ['key', 'hash', 'parent', 'created', 'committed', 'type']
+
+
+def attributeDigest(name, payload):
+  '''Returns the hex sha1 digest of an attribute payload (raw data).'''
+  return hashlib.sha1('%s=%s,' % (name, payload)).hexdigest()
+
+
+def digests(version):
+  '''Returns the {name : digest} of the attributes of `version`.'''
+  return dict([(n, attributeDigest(n, version.attribute(n))) \
+    for n in version.attributeNames()])
+
+
+def make_delta(version, baseHash=None, baseDigests=None):
+  '''Returns the delta of `version` relative to the base version of hash
+  `baseHash`, whose attribute digests are `baseDigests`. Without a base, the
+  delta carries all attributes.'''
+  attributes = dict([(n, version.attribute(n)) \
+    for n in version.attributeNames()])
+  delta = version.header()
+  delta['digests'] = dict([(n, attributeDigest(n, p)) \
+    for n, p in attributes.iteritems()])
+
+  if baseHash is None or baseDigests is None:
+    baseHash, baseDigests = None, {}
+
+  delta['base'] = baseHash
+  delta['changed'] = dict([(n, p) for n, p in attributes.iteritems() \
+    if baseDigests.get(n) != delta['digests'][n]])
+  return delta
+
+
+def delta_from(version, base):
+  '''Returns the delta of `version` relative to Version `base` (or None).'''
+  if base is None:
+    return make_delta(version)
+  return make_delta(version, base.hash, digests(base))
+
+
+def apply_delta(delta, base=None):
+  '''Returns the Version described by `delta`, taking unchanged attributes
+  from `base` (a Version). Raises DeltaError if `base` is not the base of the
+  delta, or does not have the expected attributes.'''
+  changed = delta['changed']
+  if len(changed) < len(delta['digests']):
+    if base is None or base.hash != delta['base']:
+      raise DeltaError('delta of %s requires base %s' % \
+        (delta['key'], delta['base']))
+
+  attributes = {}
+  for name, digest in delta['digests'].iteritems():
+    if name in changed:
+      attributes[name] = changed[name]
+      continue
+
+    try:
+      payload = base.attribute(name)
+    except KeyError:
+      raise DeltaError('base of %s lacks attribute %s' % (delta['key'], name))
+    if attributeDigest(name, payload) != digest:
+      raise DeltaError('base of %s differs in attribute %s' % \
+        (delta['key'], name))
+    attributes[name] = payload
+
+  data = dict([(f, delta[f]) for f in HEADER_FIELDS])
+  data['attributes'] = attributes
+  return Version.from_data(data)
@@ -1,2 +1,2 @@
 
-from bottledronestore import DronestoreBottlePlugin, Plugin
+from bottledronestore import DronestoreBottlePlugin, Plugin, Session
@@ -9,6 +9,12 @@ searches for route callbacks that require a `repo` keyword argument
 (configurable) and skips routes that do not. This removes any overhead for
 routes that don't need a repo connection.
 
+With `session=True`, each request gets its own Session over the repo instead:
+repeated gets of a key are answered from memory, and puts, merges and deletes
+are deferred until the request ends, then written in batches. If the callback
+raises or returns an HTTPError (e.g. with abort), or raises anything else
+than an HTTPResponse (e.g. a redirect), they are discarded.
+
 Usage Example::
 
     import bottle
@@ -33,25 +39,176 @@ __license__ = 'MIT'
 
 import inspect
 try:
-  from bottle import PluginError
+  from bottle import PluginError, HTTPResponse, HTTPError
 except:
   class PluginError(Exception):
     pass
+  class HTTPResponse(Exception):
+    pass
+  class HTTPError(HTTPResponse):
+    pass
+
+from dronestore.model import Key, Model
+from dronestore.attribute import KeyAttribute
+
+
+class Session(object):
+  '''A unit of work over `repo`, e.g. for the duration of a web request.
+
+  The session keeps an identity map: each key is read from the repo once
+  (found or not), and later gets return the same instance. Puts, merges and
+  deletes are deferred until `flush`, and coalesced: repeated puts of a key
+  store the last one, and a put or delete supersedes the earlier writes of
+  its key. All deletes are written in one batch (delete_many), followed by
+  all puts (put_many), then all merges (merge_many). Gets see the deferred
+  puts and deletes, but not the deferred merges.
+  '''
+
+  def __init__(self, repo):
+    self.repo = repo
+    self._instances = {} # key -> instance (or None, if not found)
+    self._puts = {} # key -> version or entity
+    self._putKeys = [] # in order of first put
+    self._merges = [] # versions
+    self._deletes = [] # keys
+
+  def __len__(self):
+    '''Returns the number of deferred writes.'''
+    return len(self._puts) + len(self._merges) + len(self._deletes)
+
+  # reads
+
+  def get(self, key):
+    '''Retrieves the entity addressed by `key`, through the identity map.'''
+    key = self.repo._cleanKey(key)
+    if key not in self._instances:
+      self._instances[key] = self.repo.get(key)
+    return self._instances[key]
+
+  def get_many(self, keys):
+    '''Retrieves the entities addressed by `keys`. Those not in the identity
+    map are fetched in one batch.'''
+    keys = map(self.repo._cleanKey, keys)
+    missing = [k for k in set(keys) if k not in self._instances]
+    if missing:
+      self._instances.update(zip(missing, self.repo.get_many(missing)))
+    return [self._instances[key] for key in keys]
+
+  def prefetch(self, instances, *names):
+    '''Loads the entities referenced by the KeyAttributes `names` (default:
+    all of them) of `instances`, in one batch.'''
+    keys = []
+    for instance in instances:
+      if instance is None:
+        continue
+      attributes = instance.attributes()
+      for name in names or attributes.keys():
+        if isinstance(attributes[name], KeyAttribute):
+          key = getattr(instance, name)
+          if key:
+            keys.append(Key(key))
+    self.get_many(keys)
+
+  def contains(self, key):
+    key = self.repo._cleanKey(key)
+    if key in self._instances:
+      return self._instances[key] is not None
+    return self.repo.contains(key)
+
+  def query(self, query, views=False):
+    '''Queries the repo (the identity map and deferred writes are skipped).'''
+    return self.repo.query(query, views)
+
+  # deferred writes
+
+  def put(self, versionOrEntity):
+    '''Stores the current version of `versionOrEntity` when flushed: that of
+    an entity is read then, so its later commits are stored too.'''
+    version = self.repo._cleanVersion(versionOrEntity)
+    key = version.key
+    if key not in self._puts:
+      self._putKeys.append(key)
+    self._puts[key] = versionOrEntity
+
+    # a put supersedes earlier merges and deletes of its key.
+    self._merges = [v for v in self._merges if v.key != key]
+    if key in self._deletes:
+      self._deletes.remove(key)
+    if isinstance(versionOrEntity, Model):
+      self._instances[key] = versionOrEntity
+    else:
+      self._instances[key] = Model.from_version(version)
+    return versionOrEntity
+
+  def put_many(self, versionsOrEntities):
+    versionsOrEntities = list(versionsOrEntities)
+    for versionOrEntity in versionsOrEntities:
+      self.put(versionOrEntity)
+    return versionsOrEntities
+
+  def merge(self, newVersionOrEntity):
+    '''Merges `newVersionOrEntity` into the stored instance when flushed.'''
+    self._merges.append(self.repo._cleanVersion(newVersionOrEntity))
+
+  def merge_many(self, newVersionsOrEntities):
+    for newVersionOrEntity in newVersionsOrEntities:
+      self.merge(newVersionOrEntity)
+
+  def delete(self, key):
+    '''Deletes the entity addressed by `key` when flushed.'''
+    key = self.repo._cleanKey(key)
+    if key in self._puts:
+      del self._puts[key]
+      self._putKeys.remove(key)
+
+    # a delete supersedes earlier puts and merges of its key.
+    self._merges = [v for v in self._merges if v.key != key]
+    if key not in self._deletes:
+      self._deletes.append(key)
+    self._instances[key] = None
+
+  def delete_many(self, keys):
+    for key in keys:
+      self.delete(key)
+
+  def flush(self):
+    '''Writes the deferred deletes, puts, then merges, each in one batch.'''
+    deletes = self._deletes
+    puts = [self.repo._cleanVersion(self._puts[k]) for k in self._putKeys]
+    merges = self._merges
+    self.discard()
+
+    if deletes:
+      self.repo.delete_many(deletes)
+    if puts:
+      self.repo.put_many(puts)
+    if merges:
+      for instance in self.repo.merge_many(merges):
+        self._instances[instance.key] = instance
+
+  def discard(self):
+    '''Drops the deferred writes.'''
+    self._puts = {}
+    self._putKeys = []
+    self._merges = []
+    self._deletes = []
 
 
 class DronestoreBottlePlugin(object):
   ''' This plugin passes a dronestore repo handle to route callbacks
       that accept a `repo` keyword argument. If a callback does not expect
       such a parameter, no repo is passed. You can override the repo
-      settings on a per-route basis. '''
+      settings on a per-route basis. With `session`, each request is passed
+      its own Session over the repo instead. '''
 
   name = 'dronestore'
   api = 2
 
-  def __init__(self, repo=None, drone=None, keyword='repo'):
+  def __init__(self, repo=None, drone=None, keyword='repo', session=False):
     repo = repo or drone # deprecate drone
     self.repo = repo
     self.keyword = keyword
+    self.session = session
 
   # deprecate drone
   @property
@@ -90,9 +247,31 @@ class DronestoreBottlePlugin(object):
       if self.keyword not in args:
         return callback
 
+    if not self.session:
+      def wrapper(*args, **kwargs):
+        kwargs[self.keyword] = repo
+        return callback(*args, **kwargs)
+      return wrapper
+
     def wrapper(*args, **kwargs):
-      kwargs[self.keyword] = repo
-      return callback(*args, **kwargs)
+      session = kwargs[self.keyword] = Session(repo)
+      try:
+        result = callback(*args, **kwargs)
+      except HTTPError: # a subclass of HTTPResponse.
+        session.discard()
+        raise
+      except HTTPResponse:
+        session.flush()
+        raise
+      except:
+        session.discard()
+        raise
+
+      if isinstance(result, HTTPError):
+        session.discard()
+      else:
+        session.flush()
+      return result
 
     # Replace the route callback with the wrapped one.
     return wrapper
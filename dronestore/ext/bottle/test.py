@@ -1,9 +1,53 @@
 
 import unittest
 import dronestore
+import datastore
 import bottle
 
-from bottledronestore import Plugin
+from dronestore import Key, StringAttribute, KeyAttribute
+from dronestore.merge import LatestStrategy
+from bottledronestore import Plugin, Session
+
+
+class Author(dronestore.Model):
+  name = StringAttribute(strategy=LatestStrategy)
+
+class Post(dronestore.Model):
+  title = StringAttribute(strategy=LatestStrategy)
+  body = StringAttribute(strategy=LatestStrategy)
+  author = KeyAttribute(type=Author)
+
+
+class CountingDatastore(datastore.DictDatastore):
+  '''DictDatastore with bulk operations, counting round trips.'''
+
+  def __init__(self):
+    super(CountingDatastore, self).__init__()
+    self.round_trips = 0
+
+  def get(self, key):
+    self.round_trips += 1
+    return super(CountingDatastore, self).get(key)
+
+  def put(self, key, value):
+    self.round_trips += 1
+    super(CountingDatastore, self).put(key, value)
+
+  def get_many(self, keys):
+    self.round_trips += 1
+    return map(super(CountingDatastore, self).get, keys)
+
+  def put_many(self, items):
+    self.round_trips += 1
+    for key, value in items:
+      super(CountingDatastore, self).put(key, value)
+
+
+def committed(instance, **values):
+  for name, value in values.items():
+    setattr(instance, name, value)
+  instance.commit()
+  return instance
 
 class DronestorePluginTest(unittest.TestCase):
   def setUp(self):
@@ -43,6 +87,140 @@ class DronestorePluginTest(unittest.TestCase):
         self.assertFalse('repo' in kw)
     self.app({'PATH_INFO':'/2', 'REQUEST_METHOD':'GET'}, lambda x, y: None)
 
+  def test_session(self):
+    store = CountingDatastore()
+    repo = dronestore.Repo('/Repo', store)
+    authors = [committed(Author('A%d' % i), name='a%d' % i) \
+      for i in range(0, 50)]
+    repo.put_many(authors)
+    posts = [committed(Post('P%d' % i), title='p%d' % i, \
+      author=authors[i].key) for i in range(0, 50)]
+    repo.put_many(posts)
+    self.plugin = self.app.install(Plugin(repo, session=True))
+
+    @self.app.get('/')
+    def page(repo):
+      self.assertTrue(isinstance(repo, Session))
+      store.round_trips = 0
+      found = repo.get_many([p.key for p in posts])
+      repo.prefetch(found)
+      self.assertEqual(store.round_trips, 2)
+
+      # references and repeated gets come from the identity map.
+      names = [repo.get(Key(post.author)).name for post in found]
+      self.assertEqual(names, ['a%d' % i for i in range(0, 50)])
+      self.assertTrue(repo.get(posts[3].key) is found[3])
+      self.assertEqual(repo.get(Key('/Post:missing')), None)
+      self.assertEqual(repo.get(Key('/Post:missing')), None)
+      self.assertFalse(repo.contains(Key('/Post:missing')))
+      self.assertEqual(store.round_trips, 3)
+
+      # writes wait for the end of the request, coalesced.
+      for post in found[:10]:
+        repo.put(committed(post, body='first'))
+        repo.put(committed(post, body='second'))
+      remote = committed(Author(authors[0].version), name='remote')
+      repo.merge(remote)
+      repo.merge(committed(Author('A99'), name='new'))
+      self.assertEqual(len(repo), 12)
+      self.assertEqual(repo.get(posts[0].key).body, 'second')
+      self.assertEqual(store.round_trips, 3)
+
+    self.app({'PATH_INFO':'/', 'REQUEST_METHOD':'GET'}, lambda x, y: None)
+    # one put_many; merge_many reads and writes in a batch each.
+    self.assertEqual(store.round_trips, 6)
+    self.assertEqual(repo.get(posts[0].key).body, 'second')
+    self.assertEqual(repo.get(posts[10].key).body, None)
+    self.assertEqual(repo.get(authors[0].key).name, 'remote')
+    self.assertEqual(repo.get(Key('/Author:A99')).name, 'new')
+
+  def test_session_errors(self):
+    repo = dronestore.Repo('/Repo')
+    self.plugin = self.app.install(Plugin(repo, session=True))
+
+    @self.app.get('/fail')
+    def fail(repo):
+      repo.put(committed(Author('A'), name='a'))
+      raise ValueError('failed')
+
+    @self.app.get('/redirect')
+    def redirect(repo):
+      repo.put(committed(Author('B'), name='b'))
+      bottle.redirect('/')
+
+    @self.app.get('/abort')
+    def abort(repo):
+      repo.put(committed(Author('D'), name='d'))
+      repo.delete(Key('/Author:B'))
+      bottle.abort(404, 'not found')
+
+    environ = {'PATH_INFO':'/fail', 'REQUEST_METHOD':'GET'}
+    self.assertRaises(ValueError, self.app, environ, lambda x, y: None)
+    self.assertFalse(repo.contains(Key('/Author:A')))
+    environ = {'PATH_INFO':'/redirect', 'REQUEST_METHOD':'GET'}
+    self.app(environ, lambda x, y: None)
+    self.assertTrue(repo.contains(Key('/Author:B')))
+    environ = {'PATH_INFO':'/abort', 'REQUEST_METHOD':'GET'}
+    self.app(environ, lambda x, y: None)
+    self.assertFalse(repo.contains(Key('/Author:D')))
+    self.assertTrue(repo.contains(Key('/Author:B')))
+
+    session = Session(repo)
+    session.put(committed(Author('C'), name='c'))
+    session.merge(committed(Author('C'), name='other'))
+    session.put(committed(Author('C'), name='last'))
+    self.assertEqual(len(session), 1)
+    session.flush()
+    self.assertEqual(len(session), 0)
+    self.assertEqual(repo.get(Key('/Author:C')).name, 'last')
+
+  def test_session_delete(self):
+    repo = dronestore.Repo('/Repo')
+    repo.put_many([committed(Author(n), name=n) for n in 'ABC'])
+    a, b, c = Key('/Author:A'), Key('/Author:B'), Key('/Author:C')
+
+    # a delete supersedes earlier writes of its key, and a put a delete.
+    session = Session(repo)
+    session.get(a)
+    session.put(committed(Author('A'), name='new'))
+    session.merge(committed(Author('A'), name='merged'))
+    session.delete(a)
+    session.delete_many([b, c])
+    session.put(committed(Author('C'), name='back'))
+    self.assertEqual(session.get(a), None)
+    self.assertFalse(session.contains(b))
+    self.assertEqual(session.get(c).name, 'back')
+    self.assertEqual(len(session), 3)
+    self.assertTrue(repo.contains(a))
+
+    # a merge after a delete stores a new entity.
+    session.merge(committed(Author('B'), name='merged'))
+    session.flush()
+    self.assertFalse(repo.contains(a))
+    self.assertEqual(repo.get(b).name, 'merged')
+    self.assertEqual(repo.get(c).name, 'back')
+
+  def test_session_commit_after_put(self):
+    repo = dronestore.Repo('/Repo')
+    session = Session(repo)
+
+    # the put entity is stored as of the flush, as the session reads it.
+    a = session.put(committed(Author('A'), name='one'))
+    committed(a, name='two')
+    self.assertEqual(session.get(a.key).name, 'two')
+    session.flush()
+    self.assertEqual(repo.get(a.key).name, 'two')
+    self.assertEqual(repo.get(a.key).version.hash, a.version.hash)
+
+    # uncommitted changes at flush time are not stored, nor dropped.
+    session.put(a)
+    a.name = 'three'
+    self.assertRaises(ValueError, session.flush)
+    self.assertEqual(len(session), 1)
+    a.commit()
+    session.flush()
+    self.assertEqual(repo.get(a.key).name, 'three')
+
 
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
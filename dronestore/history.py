@@ -0,0 +1,214 @@
+'''
+Version history, for audit and three-way merges (see `ancestor`).
+
+A HistoryStore keeps every committed version it is given, by hash, in a
+datastore. Attribute payloads are stored once per distinct content: each
+payload is addressed by the sha1 of its (canonical) binary encoding, and a
+version record only lists the addresses of its payloads. Storing a new
+version thus costs a small header plus the payloads that actually changed.
+
+Give a Repo a history to record every version it writes::
+
+    repo = Repo('/repo', store, history=HistoryStore(historyStore))
+
+Version hashes depend only on contents, so a version can reappear (e.g.
+after reverting a change), with another parent. A record keeps the contents
+once, and the (parent, created, committed) of each appearance. Walking back
+from an appearance follows its own parent, to the latest appearance of that
+committed before it, so the versions in between are not skipped.
+'''
+
+import hashlib
+
+from itertools import islice
+
+from model import Key, Version
+from codec import encode_value
+from datastore.core.query import Query as DatastoreQuery
+
+
+def address(payload):
+  '''Returns the content address of an attribute payload.'''
+  return hashlib.sha1(encode_value(payload)).hexdigest()
+
+
+class HistoryStore(object):
+  '''Stores versions by hash in `store` (a Datastore), under `namespace`,
+  deduplicating attribute payloads by content address.'''
+
+  def __init__(self, store, namespace='/history'):
+    self._store = store
+    self._versions = Key(namespace).child('version')
+    self._payloads = Key(namespace).child('payload')
+
+  def _versionKey(self, hash):
+    return self._versions.instance(hash)
+
+  def _payloadKey(self, addr):
+    return self._payloads.instance(addr)
+
+  def contains(self, hash):
+    '''Returns whether the version of `hash` is in the history.'''
+    return self._store.contains(self._versionKey(hash))
+
+  @classmethod
+  def _appearance(cls, version):
+    header = version.header()
+    return [header['parent'], header['created'], header['committed']]
+
+  def put(self, version):
+    '''Records `version` (and its new payloads). Returns whether the version,
+    or this appearance of it, was new.'''
+    if version.isBlank:
+      return False
+
+    key = self._versionKey(version.hash)
+    appearance = self._appearance(version)
+    record = self._store.get(key)
+    if record is not None:
+      if appearance in record['parents']:
+        return False
+      record = dict(record)
+      record['parents'] = sorted(record['parents'] + [appearance], \
+        key=lambda a: a[2])
+      self._store.put(key, record)
+      return True
+
+    record = version.header()
+    record['parents'] = [appearance]
+    record['attributes'] = {}
+    for name in version.attributeNames():
+      payload = version.attribute(name)
+      addr = record['attributes'][name] = address(payload)
+      payloadKey = self._payloadKey(addr)
+      if not self._store.contains(payloadKey):
+        self._store.put(payloadKey, {'address': addr, 'payload': payload})
+
+    # the record goes last: a recorded version always has its payloads.
+    self._store.put(key, record)
+    return True
+
+  def put_many(self, versions):
+    '''Records all `versions`. Returns how many were new.'''
+    return len(filter(None, map(self.put, versions)))
+
+  def _version(self, record, appearance=None):
+    '''Returns the version of `record`, as of `appearance` (default: the
+    first one).'''
+    data = dict(record)
+    del data['parents']
+    if appearance is not None:
+      data['parent'], data['created'], data['committed'] = appearance
+
+    data['attributes'] = {}
+    for name, addr in record['attributes'].iteritems():
+      payload = self._store.get(self._payloadKey(addr))['payload']
+      data['attributes'][name] = payload
+    return Version.from_data(data, decoder=None)
+
+  def get(self, hash):
+    '''Returns the version of `hash` (as first recorded), or None if it is
+    not in the history.'''
+    record = self._store.get(self._versionKey(hash))
+    if record is None:
+      return None
+    return self._version(record)
+
+  def _walk(self, hash, appearance=None, before=None):
+    '''Yields the (record, appearance) of `hash` and of its ancestors, as far
+    as the history goes. Starts from `appearance` if recorded, else from the
+    latest one committed `before` (default: the latest one). Only the
+    version records are read, not the payloads.'''
+    seen = set()
+    while hash != Version.BLANK_HASH:
+      record = self._store.get(self._versionKey(hash))
+      if record is None:
+        break
+
+      parents = record['parents']
+      if appearance not in parents:
+        earlier = parents
+        if before is not None:
+          earlier = [a for a in parents if a[2] < before] or parents[:1]
+        appearance = earlier[-1]
+      if (hash, appearance[2]) in seen:
+        break
+
+      seen.add((hash, appearance[2]))
+      yield record, appearance
+      hash, before, appearance = appearance[0], appearance[2], None
+
+  def history(self, versionOrHash, limit=None):
+    '''Yields the versions from `versionOrHash` back through its parents, as
+    far as the history goes (at most `limit` versions). From a hash, starts
+    at its latest appearance.'''
+    if isinstance(versionOrHash, Version):
+      walk = self._walk(versionOrHash.hash, self._appearance(versionOrHash))
+    else:
+      walk = self._walk(versionOrHash)
+
+    for record, appearance in islice(walk, limit):
+      yield self._version(record, appearance)
+
+  def _lineage(self, version):
+    '''Yields the (hash, record, appearance) of `version` (or a hash) and of
+    its ancestors. `version` itself need not be recorded.'''
+    if not isinstance(version, Version):
+      walk = self._walk(version)
+    else:
+      yield version.hash, None, None
+      walk = self._walk(version.parent, before=version.header()['committed'])
+
+    for record, appearance in walk:
+      yield record['hash'], record, appearance
+
+  def ancestor(self, a, b):
+    '''Returns the latest common ancestor of versions (or hashes) `a` and
+    `b`, or None if the history does not have one. The ancestor may be `a`
+    or `b` themselves.'''
+    lineage = set([hash for hash, _, _ in self._lineage(a)])
+    for hash, record, appearance in self._lineage(b):
+      if hash in lineage:
+        for version in (a, b):
+          if isinstance(version, Version) and version.hash == hash:
+            return version
+        return self._version(record, appearance)
+    return None
+
+  def _records(self):
+    return self._store.query(DatastoreQuery(self._versions))
+
+  def _payloadRecords(self):
+    return self._store.query(DatastoreQuery(self._payloads))
+
+  def gc(self, roots):
+    '''Deletes the versions not reachable (through parents) from the version
+    hashes `roots`, and the payloads no remaining version refers to. Returns
+    (versions deleted, payloads deleted).'''
+    records = dict([(r['hash'], r) for r in self._records()])
+
+    # mark
+    reachable = set()
+    stack = list(roots)
+    while stack:
+      hash = stack.pop()
+      if hash in reachable or hash not in records:
+        continue
+      reachable.add(hash)
+      stack.extend([parent for parent, _, _ in records[hash]['parents']])
+
+    addresses = set()
+    for hash in reachable:
+      addresses.update(records[hash]['attributes'].itervalues())
+
+    # sweep. versions first, so no recorded version loses its payloads.
+    versions = [h for h in records if h not in reachable]
+    for hash in versions:
+      self._store.delete(self._versionKey(hash))
+
+    payloads = [p['address'] for p in self._payloadRecords() \
+      if p['address'] not in addresses]
+    for addr in payloads:
+      self._store.delete(self._payloadKey(addr))
+
+    return len(versions), len(payloads)
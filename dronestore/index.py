@@ -0,0 +1,186 @@
+'''
+Secondary indexes over attribute values, so that Repos can answer queries
+without scanning every version. Attributes opt in with `indexed=True`::
+
+    class Person(Model):
+      age = IntegerAttribute(indexed=True)
+
+Indexes live in memory. The index of a collection (key path) is built from
+the datastore the first time a query needs it, and is then maintained by the
+Repo's writes. Writes made to the datastore by other means are not seen.
+'''
+
+import bisect
+
+from model import Model, UnregisteredModelError
+
+
+NoneType = type(None)
+
+
+class AttributeIndex(object):
+  '''A sorted index of (value, key) pairs, for one attribute.'''
+
+  def __init__(self, name):
+    self.name = name
+    self._values = [] # sorted values
+    self._keys = []   # keys, sorted by (value, key)
+    self._byKey = {}  # key -> value
+    self._types = {}  # value type -> count
+
+  def __len__(self):
+    return len(self._keys)
+
+  def __contains__(self, key):
+    return key in self._byKey
+
+  def _position(self, key, value):
+    lo = bisect.bisect_left(self._values, value)
+    hi = bisect.bisect_right(self._values, value)
+    return bisect.bisect_left(self._keys, key, lo, hi)
+
+  def insert(self, key, value):
+    '''Indexes `key` (a string) under `value`, replacing any previous entry.'''
+    if key in self._byKey:
+      if self._byKey[key] == value:
+        return
+      self.remove(key)
+
+    index = self._position(key, value)
+    self._values.insert(index, value)
+    self._keys.insert(index, key)
+    self._byKey[key] = value
+    self._types[type(value)] = self._types.get(type(value), 0) + 1
+
+  def remove(self, key):
+    '''Removes `key` from the index.'''
+    try:
+      value = self._byKey.pop(key)
+    except KeyError:
+      return
+
+    index = self._position(key, value)
+    del self._values[index]
+    del self._keys[index]
+
+    vtype = type(value)
+    self._types[vtype] -= 1
+    if not self._types[vtype]:
+      del self._types[vtype]
+
+  def compatible(self, value):
+    '''Returns whether comparing indexed values to `value` gives the same
+    results as a Filter would. Filters convert values to the class of their
+    own value, so every indexed value must be of that class already.'''
+    cls = value.__class__
+    for vtype in self._types:
+      if vtype is not NoneType and not issubclass(vtype, cls):
+        return False
+    return True
+
+  def keys(self, op=None, value=None):
+    '''Returns the keys whose values satisfy `op value` (see Filter), ordered
+    by value. Returns all keys if no `op` is given.'''
+    values = self._values
+    lo, hi = 0, len(values)
+
+    if op == '=':
+      lo = bisect.bisect_left(values, value)
+      hi = bisect.bisect_right(values, value)
+    elif op == '<':
+      hi = bisect.bisect_left(values, value)
+    elif op == '<=':
+      hi = bisect.bisect_right(values, value)
+    elif op == '>':
+      lo = bisect.bisect_right(values, value)
+    elif op == '>=':
+      lo = bisect.bisect_left(values, value)
+    elif op is not None:
+      raise ValueError('index cannot satisfy operator %s' % op)
+
+    return self._keys[lo:hi]
+
+
+
+class IndexSet(object):
+  '''The attribute indexes of a Repo, grouped by collection (key path).'''
+
+  # operators an index can answer. '!=' matches nearly everything anyway.
+  INDEX_OPERATORS = ['=', '<', '<=', '>', '>=']
+
+  def __init__(self):
+    self._collections = {} # collection -> {attr name : AttributeIndex}
+
+  @classmethod
+  def indexedAttributes(cls, dstype):
+    '''Returns the names of the indexed attributes of model type `dstype`.'''
+    try:
+      model = Model.modelNamed(dstype)
+    except UnregisteredModelError:
+      return []
+    return [name for name, attr in model._sortedAttributes if attr.indexed]
+
+  def isBuilt(self, collection):
+    return str(collection) in self._collections
+
+  def build(self, collection, dstype, versions):
+    '''(Re)builds the indexes of `collection`, for models of type `dstype`,
+    from all the `versions` currently stored in it.'''
+    indexes = dict([(n, AttributeIndex(n)) \
+      for n in self.indexedAttributes(dstype)])
+    self._collections[str(collection)] = indexes
+    for version in versions:
+      self.put(version)
+
+  def _indexes(self, key):
+    return self._collections.get(str(key.path))
+
+  def put(self, version):
+    '''Updates the indexes with (the stored) `version`.'''
+    key = version.key
+    indexes = self._indexes(key)
+    if not indexes:
+      return # not indexed, or not built yet.
+
+    key = str(key)
+    for name, index in indexes.iteritems():
+      try:
+        value = version.attributeValue(name)
+      except KeyError:
+        value = None
+      index.insert(key, value)
+
+  def delete(self, key):
+    '''Removes `key` from the indexes.'''
+    indexes = self._indexes(key)
+    if indexes:
+      for index in indexes.itervalues():
+        index.remove(str(key))
+
+  def plan(self, query):
+    '''Returns how to answer `query` with the indexes, as a tuple of
+    (candidate keys, whether they are in the query's order), or None if the
+    indexes cannot help. Candidates still need the query's filters applied.
+    '''
+    indexes = self._collections.get(str(query.key))
+    if not indexes:
+      return None
+
+    # prefer equality filters, as they are the most selective.
+    usable = [f for f in query.filters if f.field in indexes \
+      and f.op in self.INDEX_OPERATORS and indexes[f.field].compatible(f.value)]
+    usable.sort(key=lambda f: f.op != '=')
+
+    order = query.orders[0] if len(query.orders) == 1 else None
+    if usable:
+      field, keys = usable[0].field, indexes[usable[0].field].keys( \
+        usable[0].op, usable[0].value)
+    elif order and order.field in indexes:
+      field, keys = order.field, indexes[order.field].keys()
+    else:
+      return None
+
+    if order and order.field == field and order.isDescending():
+      keys.reverse()
+    ordered = not query.orders or (order and order.field == field)
+    return keys, bool(ordered)
@@ -1,25 +1,74 @@
 
 import nanotime
 
-def merge(instance, version):
+import metrics
+
+_mergesData = {} # strategy class -> whether merge calls its mergeData
+
+
+def mergesData(cls):
+  '''Returns whether merge calls the mergeData of strategy class `cls`. It
+  does, unless `cls` overrides `merge` below the class defining its
+  `mergeData`: a subclass overriding only `merge` must not be bypassed.'''
+  try:
+    return _mergesData[cls]
+  except KeyError:
+    pass
+
+  def definer(name):
+    for klass in cls.__mro__:
+      if name in klass.__dict__:
+        return klass
+
+  mergeClass, mergeDataClass = definer('merge'), definer('mergeData')
+  uses = mergeClass is mergeDataClass or \
+    not issubclass(mergeClass, mergeDataClass)
+  _mergesData[cls] = uses
+  return uses
+
+
+def merge(instance, version, ancestor=None):
+  '''Merges `version` into `instance`, attribute by attribute, according to
+  their merge strategies. Given the common `ancestor` of both versions,
+  strategies that use it (USES_ANCESTOR) only consider the attributes that
+  changed since.'''
   if instance.isDirty():
     raise ValueError('Cannot merge dirty instance.')
 
   if not instance.isCommitted():
     raise ValueError('Cannot merge uncommitted instance.')
 
-  mergeData = {}
-  for attr in instance.attributes().values():
-    rawData = attr.mergeStrategy.merge(instance.version, version)
-    if rawData: # none value means no change, i.e. keep the local attribute.
-      mergeData[attr.name] = rawData
-
-  if not mergeData:
+  local = instance.version
+  changes = []
+  for name, strategy, accessor in instance._mergePlan:
+    attr_local = accessor(local)
+    attr_remote = accessor(version)
+    if attr_remote == attr_local:
+      if metrics.enabled:
+        metrics.count('merge.identical')
+      continue # identical payloads, nothing to decide.
+
+    if ancestor is not None and strategy.USES_ANCESTOR:
+      rawData = strategy.merge3(local, version, ancestor)
+    elif mergesData(type(strategy)):
+      rawData = strategy.mergeData(local, version, attr_local, attr_remote)
+    else:
+      rawData = strategy.merge(local, version)
+
+    # none value means no change, i.e. keep the local attribute. neither do
+    # we rewrite an attribute with the data it already has.
+    if rawData and rawData != attr_local:
+      changes.append((strategy.attribute, rawData))
+      if metrics.enabled:
+        metrics.count('merge.%s.remote' % strategy.__class__.__name__)
+    elif metrics.enabled:
+      metrics.count('merge.%s.local' % strategy.__class__.__name__)
+
+  if not changes:
     return # nothing changed.
 
   # merging checks out, actually make the changes.
-  for attrname, rawData in mergeData.iteritems():
-    attr = instance.attributes()[attrname]
+  for attr, rawData in changes:
     attr.setRawData(instance, rawData)
 
   instance.commit()
@@ -42,6 +91,10 @@ class MergeStrategy(object):
 
   REQUIRES_STATE = False
 
+  # Strategies that can use the common ancestor of the versions being merged
+  # set USES_ANCESTOR to True, and implement merge3.
+  USES_ANCESTOR = False
+
 
   def __init__(self, attribute):
     self.attribute = attribute
@@ -51,6 +104,29 @@ class MergeStrategy(object):
     raise NotImplementedError('No implementation for %s.merge()', \
       self.__class__.__name__)
 
+  def mergeData(self, local_version, remote_version, attr_local, attr_remote):
+    '''merges this attribute in two different versions, given its data in
+    each (or None), as already looked up by merge.merge. Strategies override
+    this to avoid looking the data up again; by default, it calls merge.
+    Subclasses overriding only merge are merged with merge (see mergesData).
+    '''
+    return self.merge(local_version, remote_version)
+
+  def merge3(self, local_version, remote_version, ancestor_version):
+    '''merges this attribute in two different versions, given their common
+    ancestor. By default, an attribute the remote did not change since the
+    ancestor is kept, one only the remote changed is taken, and one both
+    changed is merged as usual.'''
+    attr_remote = self._attribute_data(remote_version)
+    attr_ancestor = self._attribute_data(ancestor_version)
+    if attr_remote == attr_ancestor:
+      return None # remote did not change it.
+
+    if self._attribute_data(local_version) == attr_ancestor:
+      return attr_remote # only remote changed it.
+
+    return self.merge(local_version, remote_version)
+
   def setAttribute(self, instance, rawData, default=False):
     '''Called whenever this particular attribute is set to a new value.'''
     pass
@@ -68,14 +144,22 @@ class LatestObjectStrategy(MergeStrategy):
   '''LatestObjectStrategy merges attributes based solely on objects' timestamp.
   In essence, the most recently written object wins.
 
-  This Strategy stores no additional state.
+  This Strategy stores no additional state. Given a common ancestor, only the
+  attributes changed on both sides are decided by timestamp.
   '''
 
+  USES_ANCESTOR = True
+
   def merge(self, local_version, remote_version):
     if remote_version.committed > local_version.committed:
       return remote_version.attribute(self.attribute.name)
     return None
 
+  def mergeData(self, local_version, remote_version, attr_local, attr_remote):
+    if remote_version.committed > local_version.committed:
+      return attr_remote
+    return None
+
 
 
 
@@ -91,11 +175,13 @@ class LatestStrategy(MergeStrategy):
   '''
 
   REQUIRES_STATE = True
+  USES_ANCESTOR = True
 
   def merge(self, local_version, remote_version):
+    return self.mergeData(local_version, remote_version, \
+      self._attribute_data(local_version), self._attribute_data(remote_version))
 
-    attr_local = self._attribute_data(local_version)
-    attr_remote = self._attribute_data(remote_version)
+  def mergeData(self, local_version, remote_version, attr_local, attr_remote):
 
     # if no timestamp found in remote. we're done!
     if not attr_remote or 'updated' not in attr_remote:
@@ -130,9 +216,10 @@ class MaxStrategy(MergeStrategy):
   '''
 
   def merge(self, local_version, remote_version):
+    return self.mergeData(local_version, remote_version, \
+      self._attribute_data(local_version), self._attribute_data(remote_version))
 
-    attr_local = self._attribute_data(local_version)
-    attr_remote = self._attribute_data(remote_version)
+  def mergeData(self, local_version, remote_version, attr_local, attr_remote):
 
     if not attr_remote:
       return None
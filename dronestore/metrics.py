@@ -0,0 +1,363 @@
+'''
+Instrumentation: counters, latency histograms and tracing spans::
+
+    from dronestore import metrics
+    metrics.enable()
+    ...
+    metrics.registry.snapshot()
+    # {'counters': {'merge.LatestStrategy.remote': 12, ...},
+    #  'histograms': {'repo.get': {'count': 40, 'mean': 2.1e-05, ...}, ...}}
+
+Disabled (the default), instrumented code runs unchanged: enabling wraps
+the instrumented functions and methods (see `instrument`) with timers, and
+disabling restores them. Hooks inside loops (merge decisions) only check
+`enabled`.
+
+Each call of an instrumented function is timed (in seconds) into the
+histogram of its name. Only the outermost of nested calls of the same name
+is timed, e.g. of the recursive calls of serial.clean. Calls that raise also
+count in counter '<name>.errors'.
+
+Instrumented by default:
+
+- Repo get, get_many, put, put_many, merge, merge_many, query (planning
+  only: results are read lazily), delete and delete_many: 'repo.<method>'
+- Model commit, computedHash and from_version: 'model.<method>'
+- merge.merge: 'merge.merge'
+- serial.clean: 'serial.clean'
+- InstanceIterator.next, once per query result: 'query.instance'
+
+Merges count the decision of each strategy, in counters
+'merge.<strategy>.local' (local value kept) and 'merge.<strategy>.remote'
+(remote value taken), and attributes with identical values in both versions
+in 'merge.identical'. Datastore I/O is timed with instrumentDatastore.
+
+With tracing, timed calls are also recorded as Spans, linked to the span
+they ran in. The registry keeps the most recent ones, and passes each to its
+listeners (e.g. to export them).
+'''
+
+import sys
+import time
+import bisect
+import threading
+import collections
+
+
+enabled = False
+tracing = False
+
+
+# latency histogram buckets (upper bounds, in seconds): 1us to ~18 minutes.
+LATENCY_BUCKETS = tuple([1e-6 * 2 ** i for i in xrange(0, 31)])
+
+
+class Counter(object):
+  '''A number that only goes up.'''
+
+  def __init__(self):
+    self.value = 0
+    self._lock = threading.Lock()
+
+  def inc(self, n=1):
+    with self._lock:
+      self.value += n
+
+
+class Histogram(object):
+  '''Counts observed values in `buckets` (sorted upper bounds).'''
+
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    self.bounds = list(buckets)
+    self.counts = [0] * (len(self.bounds) + 1) # the last one is unbounded.
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+    self._lock = threading.Lock()
+
+  def observe(self, value):
+    i = bisect.bisect_left(self.bounds, value)
+    with self._lock:
+      self.counts[i] += 1
+      self.count += 1
+      self.total += value
+      if self.min is None or value < self.min:
+        self.min = value
+      if self.max is None or value > self.max:
+        self.max = value
+
+  @property
+  def mean(self):
+    return self.total / self.count if self.count else None
+
+  def percentile(self, p):
+    '''Returns an estimate of the `p`th percentile (0 to 100): the upper
+    bound of the bucket it falls in (within the observed min and max).'''
+    if not self.count:
+      return None
+
+    rank = p / 100.0 * self.count
+    seen = 0
+    for i, count in enumerate(self.counts):
+      seen += count
+      if count and seen >= rank:
+        bound = self.bounds[i] if i < len(self.bounds) else self.max
+        return max(self.min, min(bound, self.max))
+    return self.max
+
+  def snapshot(self):
+    return {
+      'count': self.count,
+      'sum': self.total,
+      'min': self.min,
+      'max': self.max,
+      'mean': self.mean,
+      'p50': self.percentile(50),
+      'p90': self.percentile(90),
+      'p99': self.percentile(99),
+    }
+
+
+class Span(object):
+  '''A timed call of an instrumented function, within its `parent` span.'''
+
+  __slots__ = ('name', 'parent', 'start', 'duration', 'error')
+
+  def __init__(self, name, parent=None):
+    self.name = name
+    self.parent = parent
+    self.start = time.time()
+    self.duration = None
+    self.error = None # the exception raised, if any
+
+  def __repr__(self):
+    return '<Span %s %s>' % (self.name, self.duration)
+
+
+class Registry(object):
+  '''Holds counters and histograms by name, and the most recent `traceSize`
+  spans.'''
+
+  def __init__(self, traceSize=1000):
+    self._lock = threading.Lock()
+    self.counters = {}
+    self.histograms = {}
+    self.spans = collections.deque(maxlen=traceSize)
+    self.listeners = []
+
+  def counter(self, name):
+    '''Returns the Counter `name`, created if needed.'''
+    counter = self.counters.get(name)
+    if counter is None:
+      with self._lock:
+        counter = self.counters.setdefault(name, Counter())
+    return counter
+
+  def histogram(self, name):
+    '''Returns the Histogram `name`, created if needed.'''
+    histogram = self.histograms.get(name)
+    if histogram is None:
+      with self._lock:
+        histogram = self.histograms.setdefault(name, Histogram())
+    return histogram
+
+  def count(self, name, n=1):
+    self.counter(name).inc(n)
+
+  def observe(self, name, value):
+    self.histogram(name).observe(value)
+
+  def record(self, span):
+    '''Keeps finished `span`, and passes it to the listeners.'''
+    self.spans.append(span)
+    for listener in list(self.listeners):
+      listener(span)
+
+  def addListener(self, fn):
+    '''Calls `fn(span)` with every span finished while tracing.'''
+    self.listeners.append(fn)
+
+  def removeListener(self, fn):
+    self.listeners.remove(fn)
+
+  def snapshot(self):
+    '''Returns the current values of all counters and histograms.'''
+    with self._lock:
+      counters = self.counters.items()
+      histograms = self.histograms.items()
+    return {
+      'counters': dict([(n, c.value) for n, c in counters]),
+      'histograms': dict([(n, h.snapshot()) for n, h in histograms]),
+    }
+
+  def reset(self):
+    '''Drops all counters, histograms and spans.'''
+    with self._lock:
+      self.counters = {}
+      self.histograms = {}
+      self.spans.clear()
+
+
+registry = Registry()
+
+
+def count(name, n=1):
+  '''Adds `n` to counter `name` of the registry.'''
+  registry.count(name, n)
+
+
+# timing
+
+_local = threading.local()
+
+def _stack():
+  '''Returns the spans this thread is in, innermost last.'''
+  try:
+    return _local.stack
+  except AttributeError:
+    stack = _local.stack = []
+    return stack
+
+
+def current():
+  '''Returns the innermost span this thread is in (or None).'''
+  stack = _stack()
+  return stack[-1] if stack else None
+
+
+def _finish(span, error=None):
+  span.duration = time.time() - span.start
+  span.error = error
+  registry.observe(span.name, span.duration)
+  if error is not None:
+    registry.count(span.name + '.errors')
+  if tracing:
+    registry.record(span)
+
+
+def _timed(fn, name):
+  '''Returns `fn`, timed as `name`.'''
+  def timed(*args, **kwargs):
+    if not enabled:
+      return fn(*args, **kwargs)
+
+    stack = _stack()
+    for span in stack:
+      if span.name == name:
+        return fn(*args, **kwargs) # nested: the outer call is timed.
+
+    span = Span(name, stack[-1] if stack else None)
+    stack.append(span)
+    try:
+      result = fn(*args, **kwargs)
+    except StopIteration: # the end of an iterator, not an error.
+      stack.pop()
+      raise
+    except:
+      stack.pop()
+      _finish(span, sys.exc_info()[1])
+      raise
+
+    stack.pop()
+    _finish(span)
+    return result
+
+  timed.__name__ = fn.__name__
+  timed.__doc__ = fn.__doc__
+  return timed
+
+
+# instrumentation points
+
+_points = [] # (target, attribute, name) to instrument while enabled
+_installed = [] # (target, attribute, own, original) instrumented now
+_defaults = [False]
+
+
+def _install(target, attribute, name):
+  own = attribute in getattr(target, '__dict__', {})
+
+  # wrap functions, keeping classmethods and staticmethods what they are.
+  original = getattr(target, attribute)
+  if isinstance(target, type):
+    for klass in target.__mro__:
+      if attribute in klass.__dict__:
+        original = klass.__dict__[attribute]
+        break
+
+  saved = target.__dict__[attribute] if own else None
+  if isinstance(original, classmethod):
+    wrapper = classmethod(_timed(original.__get__(None, target).im_func, name))
+  elif isinstance(original, staticmethod):
+    wrapper = staticmethod(_timed(original.__get__(None, target), name))
+  else:
+    wrapper = _timed(original, name)
+
+  setattr(target, attribute, wrapper)
+  _installed.append((target, attribute, own, saved))
+
+
+def _uninstall(target, attribute, own, original):
+  if own:
+    setattr(target, attribute, original)
+  else:
+    delattr(target, attribute)
+
+
+def instrument(target, attribute, name):
+  '''Times calls of `target.attribute` as `name` while enabled. `target` is
+  a module (of the function), a class (of the method) or any object.'''
+  for point in _points:
+    if point[0] is target and point[1] == attribute:
+      return # already instrumented.
+
+  _points.append((target, attribute, name))
+  if enabled:
+    _install(target, attribute, name)
+
+
+def instrumentDatastore(datastore, prefix='datastore'):
+  '''Times the operations of `datastore` (the object) as
+  '<prefix>.<operation>'.'''
+  operations = ['get', 'put', 'delete', 'contains', 'query', 'get_many', \
+    'put_many', 'delete_many', 'compare_and_swap']
+  for operation in operations:
+    if hasattr(datastore, operation):
+      instrument(datastore, operation, '%s.%s' % (prefix, operation))
+
+
+def _instrumentDefaults():
+  import repo, model, merge, query
+  from util import serial
+
+  for method in ['get', 'get_many', 'put', 'put_many', 'merge', \
+      'merge_many', 'query', 'delete', 'delete_many']:
+    instrument(repo.Repo, method, 'repo.' + method)
+  for method in ['commit', 'computedHash', 'from_version']:
+    instrument(model.Model, method, 'model.' + method)
+  instrument(merge, 'merge', 'merge.merge')
+  instrument(serial, 'clean', 'serial.clean')
+  instrument(query.InstanceIterator, 'next', 'query.instance')
+
+
+def enable(trace=False):
+  '''Starts collecting metrics (and spans, if `trace`) into the registry.'''
+  global enabled, tracing
+  if not _defaults[0]:
+    _defaults[0] = True
+    _instrumentDefaults()
+
+  tracing = trace
+  if not enabled:
+    for point in _points:
+      _install(*point)
+    enabled = True
+
+
+def disable():
+  '''Stops collecting, and restores the instrumented functions.'''
+  global enabled, tracing
+  enabled = tracing = False
+  while _installed:
+    _uninstall(*_installed.pop())
@@ -3,7 +3,6 @@ import datetime
 import hashlib
 import uuid
 import nanotime
-import copy
 
 from datastore.core import Key
 
@@ -43,13 +42,20 @@ class Version(object):
   the object snapshot. Versions are used as snapshot 'containers,' including
   all of the data of the particular object snapshot.
 
-  The current implementation does not use incremental changes, as the entire
-  version history of each object is not tracked.
+  Repos only keep the current version of each object. Their history can be
+  kept in a HistoryStore (see dronestore.history), which stores the payloads
+  shared between versions only once.
+
+  Versions are compact: header fields are stored natively, and attribute
+  payloads of versions built with `from_data` are only decoded when accessed.
   '''
   BLANK_HASH = '0000000000000000000000000000000000000000'
   REP_FIELDS = ['key', 'hash', 'parent', 'created', 'committed', 'attributes', \
     'type']
 
+  __slots__ = ('_key', '_hash', '_parent', '_created', '_committed', '_type', \
+    '_attributes', '_decoder', '_decoded')
+
   def __init__(self, keyOrRepresentation):
     serialRep = None
     key = None
@@ -72,58 +78,130 @@ class Version(object):
       serialRep['attributes'] = {}
       serialRep['type'] = ''
 
+    self._load(serialRep)
+
+  def _load(self, data, decoder=None):
+    '''Loads the fields of this version from `data` (a serial representation
+    or raw dict). Attribute payloads are passed through `decoder` on access.
+    '''
     for req in self.REP_FIELDS:
-      if req not in serialRep:
+      if req not in data:
         raise ValueError('serial representation does not include %s' % req)
 
-    if serialRep['created'] > serialRep['committed']:
+    if data['created'] > data['committed']:
       raise ValueError('serial representation implies created after committed')
-    if serialRep['created'] < 0:
+    if data['created'] < 0:
       raise ValueError('serial representation implies created before 0')
 
-    self._serialRep = serialRep
+    self._key = data['key']
+    self._hash = data['hash']
+    self._parent = data['parent']
+    self._created = data['created']
+    self._committed = data['committed']
+    self._type = data['type']
+    self._attributes = data['attributes']
+    self._decoder = decoder
+    self._decoded = None
+
+  @classmethod
+  def from_data(cls, data, decoder=serial.clean):
+    '''Constructs a version from raw `data` (e.g. read from a datastore).
+
+    Header fields are read right away. Each attribute payload is decoded with
+    `decoder` on its first access, so unused attributes cost nothing. Data
+    known to be clean (e.g. written by a Repo) can pass `decoder=None`.
+    '''
+    version = cls.__new__(cls)
+    version._load(data, decoder)
+    return version
 
   @property
   def key(self):
-    return Key(self._serialRep['key'])
+    return Key(self._key)
 
   @property
   def hash(self):
-    return self._serialRep['hash']
+    return self._hash
 
   @property
   def type(self):
-    return self._serialRep['type']
+    return self._type
 
   @property
   def isBlank(self):
-    return self.hash == self.BLANK_HASH
+    return self._hash == self.BLANK_HASH
 
   def shortHash(self, length=6):
-    return self.hash[0:length]
+    return self._hash[0:length]
 
   @property
   def committed(self):
-    return nanotime.nanotime(self._serialRep['committed'])
+    return nanotime.nanotime(self._committed)
 
   @property
   def created(self):
-    return nanotime.nanotime(self._serialRep['created'])
+    return nanotime.nanotime(self._created)
 
   @property
   def parent(self):
-    return self._serialRep['parent']
+    return self._parent
 
   @property
   def serialRepresentation(self):
-    return self._serialRep
+    '''A SerialRepresentation of this version, built on demand.'''
+    return serial.SerialRepresentation(self.data(), trusted=True)
+
+  def data(self):
+    '''Returns the contents of this version as a (serializable) dict.'''
+    attributes = self._attributes
+    if self._decoder is not None:
+      attributes = dict([(n, self.attribute(n)) for n in self._attributes])
+
+    return {
+      'key': self._key,
+      'hash': self._hash,
+      'parent': self._parent,
+      'created': self._created,
+      'committed': self._committed,
+      'attributes': attributes,
+      'type': self._type,
+    }
+
+  def header(self):
+    '''Returns the fields of this version, except the attributes, as a dict.'''
+    return {
+      'key': self._key,
+      'hash': self._hash,
+      'parent': self._parent,
+      'created': self._created,
+      'committed': self._committed,
+      'type': self._type,
+    }
+
+  def attributeNames(self):
+    '''Returns the names of the attributes stored in this version.'''
+    return list(self._attributes)
 
   def attribute(self, name):
+    if self._decoder is None:
+      try:
+        return self._attributes[name]
+      except KeyError:
+        raise KeyError('No attribute %s in version' % name)
+
+    if self._decoded is None:
+      self._decoded = {}
+    elif name in self._decoded:
+      return self._decoded[name]
+
     try:
-      return self._serialRep['attributes'][name]
+      payload = self._attributes[name]
     except KeyError:
       raise KeyError('No attribute %s in version' % name)
 
+    payload = self._decoded[name] = self._decoder(payload)
+    return payload
+
   def attributeValue(self, name):
     return self.attributeMetaData(name, 'value')
 
@@ -133,21 +211,27 @@ class Version(object):
       return attr[meta]
     except KeyError:
       errstr = 'No attribute metadata \'%s\' in this version. %s'
-      raise KeyError(errstr % (meta, self._serialRep.data()))
+      raise KeyError(errstr % (meta, self.data()))
 
   def __getitem__(self, name):
     return self.attribute(name)
 
+  def __getstate__(self):
+    return self.data()
+
+  def __setstate__(self, data):
+    self._load(data)
+
   def __eq__(self, other):
     if isinstance(other, Version):
-      return self.hash == other.hash and self.key == other.key
+      return self._hash == other._hash and self._key == other._key
     raise TypeError('other is not of type %s' % Version)
 
   def __ne__(self, other):
     return not self.__eq__(other)
 
   def __hash__(self):
-    return fasthash.hash(self.hash)
+    return fasthash.hash(self._hash)
 
   def __str__(self):
     return '<%s %s version %s>' % (self.type, self.key, self.hash)
@@ -203,17 +287,41 @@ def _initialize_attributes(cls, name, bases, attrs):
       cls._attributes[attr_name] = attr
       attr._attr_config(cls, attr_name)
 
+  # a stable attribute order, for hashing.
+  cls._sortedAttributes = tuple(sorted(cls._attributes.items()))
+
+
+def _payload_accessor(name):
+  '''Returns a function returning the `name` payload of a version, or None.'''
+  def accessor(version):
+    if version._decoder is None:
+      return version._attributes.get(name)
+    if name not in version._attributes:
+      return None
+    return version.attribute(name)
+  return accessor
+
+
+def _merge_plan(cls):
+  '''Returns the merge plan of model `cls`: a tuple of (attribute name, merge
+  strategy, payload accessor), in attribute order. merge.merge walks it
+  instead of looking each attribute up on every merge.'''
+  return tuple([(attr.name, attr.mergeStrategy, _payload_accessor(attr.name)) \
+    for name, attr in cls._sortedAttributes])
+
 
 REGISTERED_MODELS = {}
 
 class ModelMeta(type):
   '''This is the meta class for Model.
-  It sets up model attributes and registers the object.
+  It sets up model attributes, compiles its merge plan, and registers the
+  object.
   '''
   def __init__(cls, name, bases, attrs):
     super(ModelMeta, cls).__init__(name, bases, attrs)
 
     _initialize_attributes(cls, name, bases, attrs)
+    cls._mergePlan = _merge_plan(cls)
 
     dstype = attrs.get('__dstype__', None)
     if not dstype:
@@ -231,9 +339,16 @@ class Model(object):
   __metaclass__ = ModelMeta
   __dstype__ = 'Model'
 
+  # How version hashes are computed. 'digest' composes the cached per-attribute
+  # digests, 'legacy' reproduces the hashes of dronestore <= 0.2.8.
+  __hashmode__ = 'digest'
+
   def __init__(self, keyNameOrVersion, parentKey=None):
     '''Initializes the model by reconstructing from version or blank state.'''
 
+    self._digests = {} # attribute digests of the current values
+    self._commitDigests = {} # attribute digests of the current version
+
     if isinstance(keyNameOrVersion, Version):
       self._initialize_version(keyNameOrVersion)
 
@@ -272,14 +387,19 @@ class Model(object):
     if version.type != self.__class__.__dstype__:
       raise ValueError('Type name provided does not match.')
 
+    # restore the raw data as stored, so the instance matches its version.
     for attr in self.attributes().values():
       try:
-        value = copy.copy(version.attributeValue(attr.name))
+        rawData = version.attribute(attr.name)
+        if 'value' not in rawData:
+          raise KeyError('No attribute metadata \'value\' in this version.')
       except KeyError:
         value = attr.default_value()
         if not value and attr.required:
           raise
-      attr.__set__(self, value)
+        attr.__set__(self, value)
+      else:
+        attr.setRawData(self, rawData)
 
 
     self._key = version.key
@@ -351,17 +471,22 @@ class Model(object):
 
 
   def computedHash(self):
-    buf = '%s,%s,' % (self._key, self.__dstype__)
-    for attr_name, attr in self.attributes().iteritems():
-      buf += '%s=%s,' % (attr_name, attr.rawData(self))
+    '''Returns the hash of the current attribute values of this instance.'''
+    if self.__hashmode__ == 'legacy':
+      buf = '%s,%s,' % (self._key, self.__dstype__)
+      for attr_name, attr in self.attributes().iteritems():
+        buf += '%s=%s,' % (attr_name, attr.rawData(self))
+      return hashlib.sha1(buf).hexdigest()
+
+    digests = [attr.digest(self) for name, attr in self._sortedAttributes]
+    buf = '%s,%s,%s' % (self._key, self.__dstype__, ''.join(digests))
     return hashlib.sha1(buf).hexdigest()
 
   def commit(self):
     '''Committing a version creates a snapshot of the current changes.'''
 
-    # this is actually broken for collection attributes:
-    # if not self.isDirty():
-    #   return # nothing to commit
+    if not self.isDirty():
+      return # nothing to commit
 
     self.validate()
 
@@ -381,19 +506,30 @@ class Model(object):
     if sr['created'] == 0: # from blank version
       sr['created'] = sr['committed']
 
-    for attr_name, attr in self.attributes().iteritems():
-      sr['attributes'][attr_name] = serial.clean(attr.rawData(self))
+    # unchanged attributes share the (immutable) data of the previous version.
+    digests = {}
+    for attr_name, attr in self._attributes.iteritems():
+      digest = digests[attr_name] = attr.digest(self)
+      if self._commitDigests.get(attr_name) == digest:
+        data = self._version.attribute(attr_name)
+      else:
+        data = serial.clean(attr.rawData(self))
+      sr['attributes'][attr_name] = data
 
     self._version = Version(sr)
+    self._commitDigests = digests
 
     self._isPersisted = True
     self._isDirty = False
 
-  def merge(self, other):
+  def merge(self, other, ancestor=None):
+    '''Merges `other` (a version or instance) into this instance. Given the
+    `ancestor` version common to both, strategies that can use it only merge
+    the attributes changed since (see merge.merge).'''
     if isinstance(other, Version):
-      merge.merge(self, other)
+      merge.merge(self, other, ancestor)
     elif isinstance(other, Model):
-      merge.merge(self, other.version)
+      merge.merge(self, other.version, ancestor)
     else:
       raise TypeError('Expected instance of %s or %s' % \
         (Version, self.__class__))
@@ -431,3 +567,91 @@ class Model(object):
   @classmethod
   def from_version(cls, version):
     return cls.modelNamed(version.type)(version)
+
+
+
+class InstanceView(object):
+  '''A lightweight, read-only view of a version as an instance of its model.
+
+  Views skip building a Model: attributes are decoded from the version only
+  when read. If `fields` is given, only those attributes can be read.
+  '''
+
+  __slots__ = ('_model', '_version', '_fields')
+
+  def __init__(self, version, fields=None):
+    model = Model.modelNamed(version.type)
+    if fields is not None:
+      fields = frozenset(fields)
+      for field in fields:
+        if field not in model._attributes:
+          raise ValueError('%s has no attribute %s' % (model.__name__, field))
+
+    self._model = model
+    self._version = version
+    self._fields = fields
+
+  @property
+  def model(self):
+    '''The Model class of the viewed instance.'''
+    return self._model
+
+  @property
+  def fields(self):
+    '''The attributes this view can read (None for all).'''
+    return self._fields
+
+  @property
+  def key(self):
+    return self._version.key
+
+  @property
+  def version(self):
+    return self._version
+
+  @property
+  def created(self):
+    return self._version.created
+
+  @property
+  def committed(self):
+    return self._version.committed
+
+  def attributeValues(self):
+    '''Returns the (readable) attribute values of this view.'''
+    names = self._fields if self._fields is not None else self._model._attributes
+    return dict([(name, getattr(self, name)) for name in names])
+
+  def instance(self):
+    '''Returns a full Model instance of the viewed version.'''
+    return self._model(self._version)
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name) # e.g. slots not set yet.
+
+    attr = self._model._attributes.get(name)
+    if attr is None or (self._fields is not None and name not in self._fields):
+      raise AttributeError('%s view has no attribute %s' % \
+        (self._model.__name__, name))
+
+    try:
+      value = self._version.attribute(name)['value']
+    except KeyError:
+      return attr.default_value()
+
+    # versions are immutable: do not hand out their containers.
+    if isinstance(value, (list, dict)):
+      value = serial.clean(value)
+    return attr.loads(value)
+
+  def __eq__(self, other):
+    if not isinstance(other, InstanceView):
+      return False
+    return self._version == other._version and self._fields == other._fields
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __repr__(self):
+    return '<%s view of %s>' % (self._model.__name__, self._version.key)
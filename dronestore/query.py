@@ -1,8 +1,10 @@
 
+import operator
+
 from datastore.core.query import Query as DatastoreQuery
-from datastore.core.query import Filter, Order
+from datastore.core.query import Filter, Order, Cursor
 
-from model import Key, Version, Model
+from model import Key, Version, Model, InstanceView
 from util import serial
 
 
@@ -15,14 +17,17 @@ def _object_getattr(obj, field):
   if hasattr(obj, field):
     value = getattr(obj, field)
 
+  # if not, perhaps it is an attributeValue (Version)
+  elif hasattr(obj, 'attributeValue'):
+    try:
+      value = obj.attributeValue(field)
+    except KeyError:
+      pass
+
   # if not, perhaps it is an item (raw dicts, etc)
   elif field in obj:
     value = obj[field]
 
-  # if not, perhaps it is an attributeValue (Version)
-  elif hasattr(obj, 'attributeValue'):
-    value = obj.attributeValue(field)
-
   # if not, perhaps it is an attribute (SerialRepresentations)
   elif 'attributes' in obj and field in obj['attributes']:
     value = obj['attributes'][field]['value']
@@ -32,10 +37,135 @@ def _object_getattr(obj, field):
 
 
 
+# Compiled evaluation. `_object_getattr` probes every object for the shape of
+# its data. Instead, queries compile each field into an accessor specialised
+# for the class of the objects (Model, Version, SerialRepresentation, dict),
+# once per class, and evaluate filters and orders with those accessors.
+
+_MISSING = object()
+
+def _dict_getter(field):
+  def get(obj):
+    value = obj.get(field, _MISSING)
+    if value is not _MISSING:
+      return value
+    try:
+      return obj['attributes'][field]['value']
+    except (KeyError, TypeError):
+      return None
+  return get
+
+def _version_getter(field):
+  def get(version):
+    try:
+      return version.attribute(field)['value']
+    except KeyError:
+      return None
+  return get
+
+def _compile_getter(cls, field):
+  '''Returns a function equivalent to `_object_getattr(obj, field)` for
+  objects of class `cls`.'''
+  if hasattr(cls, field):
+    return operator.attrgetter(field)
+  if issubclass(cls, Version):
+    return _version_getter(field)
+  if issubclass(cls, dict):
+    return _dict_getter(field)
+  if issubclass(cls, serial.SerialRepresentation):
+    get = _dict_getter(field)
+    return lambda obj: get(obj.data())
+  return lambda obj: _object_getattr(obj, field)
+
+
+class _FieldGetter(object):
+  '''Returns the value of `field` in objects, with an accessor compiled once
+  per object class.'''
+
+  __slots__ = ('field', '_getters')
+
+  def __init__(self, field):
+    self.field = field
+    self._getters = {}
+
+  def getter(self, cls):
+    try:
+      return self._getters[cls]
+    except KeyError:
+      getter = self._getters[cls] = _compile_getter(cls, self.field)
+      return getter
+
+  def __call__(self, obj):
+    return self.getter(obj.__class__)(obj)
+
+
+def _compile_predicate(cls, filters):
+  '''Returns a function that tests objects of class `cls` against `filters`,
+  with the semantics of Filter.__call__.'''
+  tests = [(_compile_getter(cls, f.field), Filter._conditional_cmp[f.op], \
+    f.value, f.value.__class__) for f in filters]
+
+  def predicate(obj):
+    for get, compare, value, vclass in tests:
+      objValue = get(obj)
+      if not isinstance(objValue, vclass):
+        objValue = vclass(objValue)
+      if not compare(objValue, value):
+        return False
+    return True
+  return predicate
+
+
+def _compilable(query):
+  '''Whether `query` uses our data model and plain filters and orders.'''
+  return query.object_getattr is _object_getattr and \
+    all(type(f) is Filter for f in query.filters) and \
+    all(type(o) is Order for o in query.orders)
+
+
+def filtered(query, iterable):
+  '''Returns the elements of `iterable` that pass the filters of `query`.'''
+  if not query.filters:
+    return iterable
+  if not _compilable(query):
+    return Filter.filter(query.filters, iterable)
+  return _filter_gen(query.filters, iterable)
+
+def _filter_gen(filters, iterable):
+  predicates = {}
+  lastClass = predicate = None
+  for obj in iterable:
+    if obj.__class__ is not lastClass:
+      lastClass = obj.__class__
+      predicate = predicates.get(lastClass)
+      if predicate is None:
+        predicate = predicates[lastClass] = \
+          _compile_predicate(lastClass, filters)
+    if predicate(obj):
+      yield obj
+
+
+def ordered(query, iterable):
+  '''Returns a list of the elements of `iterable`, sorted by the orders of
+  `query`. Ties keep their relative order.'''
+  if not query.orders:
+    return list(iterable)
+  if not _compilable(query):
+    return Order.sorted(iterable, query.orders)
+
+  # stable sorts, from the least significant order to the most.
+  items = list(iterable)
+  for order in reversed(query.orders):
+    items.sort(key=_FieldGetter(order.field), reverse=order.isDescending())
+  return items
 
 class Query(DatastoreQuery):
+  '''A dronestore query. Given `fields` (attribute names), it is a projection
+  query: results are read-only views (see InstanceView) of those attributes.
+  '''
 
   def __init__(self, key, *args, **kwargs):
+    fields = kwargs.pop('fields', None)
 
     if hasattr(key, '__dstype__'):
       key = Key(key.__dstype__)
@@ -44,6 +174,7 @@ class Query(DatastoreQuery):
       key = Key(key)
 
     super(Query, self).__init__(key, *args, **kwargs)
+    self.fields = list(fields) if fields is not None else None
 
   def model(self):
     '''Returns the Model class associated to this query.'''
@@ -51,6 +182,44 @@ class Query(DatastoreQuery):
 
   object_getattr = staticmethod(_object_getattr)
 
+  def copy(self):
+    '''Returns a copy of this query.'''
+    other = Query(self.key, limit=self.limit, offset=self.offset, \
+      fields=self.fields)
+    if self.object_getattr is not Query.object_getattr:
+      other.object_getattr = self.object_getattr
+    other.filters = self.filters
+    other.orders = self.orders
+    return other
+
+  def dict(self):
+    '''Returns a dictionary representing this query.'''
+    d = super(Query, self).dict()
+    if self.fields is not None:
+      d['fields'] = list(self.fields)
+    return d
+
+  @classmethod
+  def from_dict(cls, dictionary):
+    '''Constructs a query from a dictionary.'''
+    query = super(Query, cls).from_dict(dictionary)
+    if 'fields' in dictionary:
+      query.fields = list(dictionary['fields'])
+    return query
+
+  def __call__(self, iterable):
+    '''Applies this query on an iterable of objects (see DatastoreQuery).
+    Filters and orders are compiled for the objects' classes (see `filtered`
+    and `ordered`), rather than probing every object.'''
+    iterable = filtered(self, iterable)
+    if self.orders:
+      iterable = ordered(self, iterable)
+
+    cursor = Cursor(self, iterable)
+    cursor.apply_offset()
+    cursor.apply_limit()
+    return cursor
+
 
 
 def allinstances(cls, droneOrDatastore):
@@ -69,8 +238,17 @@ class InstanceIterator(object):
   return instances, not raw version data.
   '''
 
-  def __init__(self, iterable):
+  def __init__(self, iterable, trusted=False, fields=None, views=False):
+    '''Wraps `iterable`. If `trusted`, raw dicts are known to be clean (e.g.
+    they were written by a Repo) and are not cleaned again.
+
+    If `views` or `fields` are given, yields read-only InstanceViews (of only
+    `fields`, if given) instead of Model instances.
+    '''
     self.iter = iter(iterable)
+    self.decoder = None if trusted else serial.clean
+    self.fields = fields
+    self.views = views or fields is not None
 
   def __iter__(self):
     return self
@@ -87,15 +265,18 @@ class InstanceIterator(object):
 
     # if it is a dictionary, assume raw serial representation
     if isinstance(next, dict):
-      next = serial.SerialRepresentation(next)
+      next = Version.from_data(next, decoder=self.decoder)
 
     # if it is a serialRepresentation, turn it into a Version
     if isinstance(next, serial.SerialRepresentation):
       next = Version(next)
 
-    # if it is a Version, turn it into a Model
+    # if it is a Version, turn it into a Model (or a view)
     if isinstance(next, Version):
-      next = Model.from_version(next)
+      if self.views:
+        next = InstanceView(next, self.fields)
+      else:
+        next = Model.from_version(next)
 
     # return whatever it is we have!
     return next
@@ -1,24 +1,117 @@
 
-from model import Key, Version, Model
-from query import Query, InstanceIterator
+import threading
+import multiprocessing
+
+from functools import partial
+from itertools import imap, islice
+
+from model import Key, Version, Model, UnregisteredModelError
+from util import fasthash
+from util.locks import KeyLocks
+from query import Query, InstanceIterator, filtered
+from index import IndexSet
+from sync import MerkleTree
+from delta import apply_delta, DeltaError
 from datastore.core import Datastore, DictDatastore
-from .util.serial import SerialRepresentation
+from datastore.core.query import Query as DatastoreQuery
+from datastore.core.query import Cursor
+
+def _unique(items):
+  '''Yields the distinct elements of `items`, in order of first appearance.'''
+  seen = set()
+  for item in items:
+    if item not in seen:
+      seen.add(item)
+      yield item
+
+
+class MergeConflictError(Exception):
+  '''Raised when a compare-and-swap merge keeps losing to other writers.'''
+  pass
+
+
+def _mergePartition(items):
+  '''Merges, in a worker process (see Repo.merge_all), the new versions of the
+  keys of one partition. `items` are (current version data or None, [(new
+  version data, ancestor data or None)]) per key. Returns the data of the
+  changed results.'''
+  results = []
+  for current, news in items:
+    instance = None
+    if current is not None:
+      instance = Model.from_version(Version.from_data(current, decoder=None))
+
+    changed = False
+    for data, ancestor in news:
+      version = Version.from_data(data, decoder=None)
+      if instance is None: # brand new version.
+        instance = Model.from_version(version)
+        changed = True
+        continue
+
+      if ancestor is not None:
+        ancestor = Version.from_data(ancestor, decoder=None)
+      curr_hash = instance.version.hash
+      instance.merge(version, ancestor)
+      changed = changed or instance.version.hash != curr_hash
+
+    if changed:
+      results.append(instance.version.data())
+  return results
+
+
 
 class Repo(object):
   '''Repo represents the logical unit of storage in dronestore.
-  Each repo consists of a datastore (or set of datastores) and an id.
+  Each repo consists of a datastore (or set of datastores, see
+  dronestore.shard) and an id.
+
+  By default, versions are stored as dicts. Given a `codec` (see
+  dronestore.codec), they are stored as encoded strings instead.
+
+  Queries on indexed attributes (see dronestore.index) are answered from
+  in-memory indexes, which the repo maintains as it writes.
+
+  Given a `cache` (see dronestore.cache), gets read through it. Given a
+  `history` (see dronestore.history), every version written is recorded.
+
+  Writes and merges lock the keys they touch, so concurrent merges of a key
+  (from several threads) do not lose updates, while writers of different
+  keys proceed in parallel. With `cas`, merges also only store their result
+  if the stored version is still the one merged into (compare-and-swap),
+  re-merging otherwise: this protects against other processes or repos
+  writing to the same datastore. Datastores providing an atomic
+  `compare_and_swap(key, old, new)` (returning whether it swapped) are
+  relied on; for others, the check is atomic only within this repo.
   '''
 
-  #FIXME(jbenet): remove DictDatastore as a default?
-  def __init__(self, repoid, store=DictDatastore()):
-    '''Initializes drone with given id and datastore.'''
+  # number of versions fetched per round trip when reading index results.
+  INDEX_BATCH_SIZE = 100
+
+  # times a compare-and-swap merge is attempted before giving up.
+  CAS_ATTEMPTS = 10
+
+  def __init__(self, repoid, store=None, codec=None, cache=None,
+               history=None, cas=False):
+    '''Initializes drone with given id and datastore (by default, a new
+    DictDatastore).'''
     if not isinstance(repoid, Key):
       repoid = Key(repoid)
+    if store is None:
+      store = DictDatastore()
     if not isinstance(store, Datastore):
       raise ValueError('store must be an instance of %s' % Datastore)
 
     self._repoid = repoid
     self._store = store
+    self._codec = codec
+    self._cache = cache
+    self._history = history
+    self._cas = cas
+    self._keyLocks = KeyLocks()
+    self._stateLock = threading.RLock() # guards indexes and merkle tree
+    self._indexes = IndexSet()
+    self._merkle = MerkleTree(lock=self._stateLock)
 
   # deprecated
   @property
@@ -47,68 +140,647 @@ class Repo(object):
     raise TypeError('expected input of type %s or %s' % (Version, Model))
 
 
+  @classmethod
+  def _cleanKey(cls, key):
+    '''Ensures input is a Key.'''
+    if not isinstance(key, Key):
+      raise ValueError('key must be of type %s' % Key)
+    return key
+
+  def _encodeVersion(self, version):
+    '''Converts a version into the value to store in the datastore.'''
+    if self._codec is None:
+      return version.data()
+    return self._codec.encode(version.data())
+
+  def _versionFromData(self, data):
+    '''Converts a value stored in the datastore into a version.'''
+    if self._codec is None:
+      # the data was cleaned when we stored it, so it is trusted as is.
+      return Version.from_data(data, decoder=None)
+    return self._codec.version(data)
+
+  def _instanceFromData(self, data):
+    '''Converts raw datastore data into an instance (or None).'''
+    if data is None:
+      return data
+
+    # handle the data. if any conversion fails, propagate the exception up.
+    return Model.from_version(self._versionFromData(data))
+
+  def _hashFromData(self, data):
+    '''Returns the version hash of a value stored in the datastore.'''
+    if self._codec is None:
+      return data['hash']
+    return self._codec.decode_header(data)['hash']
+
+  def _cachedInstance(self, key, data, shared=True):
+    '''Converts raw datastore data into an instance (or None), through the
+    cache. Unless `shared`, cached instances are not handed out.'''
+    if data is None:
+      self._cache.invalidate(key)
+      return None
+
+    hash = self._hashFromData(data)
+    value = self._cache.get(hash)
+    if value is None:
+      value = self._cacheFill(key, hash, data)
+    return self._cacheInstance(value, shared)
+
+  def _cacheFill(self, key, hash, data):
+    '''Decodes `data` and caches the result, which it returns.'''
+    version = self._versionFromData(data)
+    if self._cache.mode == 'model':
+      value = Model.from_version(version)
+    else:
+      value = version
+    self._cache.put(key, hash, value, data)
+    return value
+
+  def _cacheInstance(self, value, shared):
+    '''Returns an instance for the cached `value`.'''
+    if isinstance(value, Version):
+      return Model.from_version(value)
+    return value if shared else Model.from_version(value.version)
+
+  def _cachedGet(self, key, shared=True):
+    '''Retrieves the entity addressed by `key` through the cache.'''
+    if self._cache.validate:
+      return self._cachedInstance(key, self._store.get(key), shared)
+
+    # trust the cached version of `key`, if there is one.
+    hash = self._cache.hashOf(key)
+    if hash is None:
+      return self._cachedInstance(key, self._store.get(key), shared)
+
+    value = self._cache.get(hash)
+    if value is None: # expired or stale. (the miss is already counted)
+      data = self._store.get(key)
+      if data is None:
+        self._cache.invalidate(key)
+        return None
+      value = self._cacheFill(key, self._hashFromData(data), data)
+    return self._cacheInstance(value, shared)
+
+
+  def _storeGetMany(self, keys):
+    '''Returns the datastore values for `keys`, in order, in one round trip
+    if the underlying datastore supports `get_many`.'''
+    if hasattr(self._store, 'get_many'):
+      return list(self._store.get_many(keys))
+    return [self._store.get(key) for key in keys]
+
+  def _storePutMany(self, items):
+    '''Stores `(key, value)` pairs, using `put_many` if supported.'''
+    if hasattr(self._store, 'put_many'):
+      self._store.put_many(items)
+    else:
+      for key, value in items:
+        self._store.put(key, value)
+
+  def _storeDeleteMany(self, keys):
+    '''Deletes `keys`, using `delete_many` if supported.'''
+    if hasattr(self._store, 'delete_many'):
+      self._store.delete_many(keys)
+    else:
+      for key in keys:
+        self._store.delete(key)
+
+  def _write(self, versions):
+    '''Stores `versions` (with distinct keys) and updates the indexes.'''
+    if len(versions) == 1:
+      version = versions[0]
+      self._store.put(version.key, self._encodeVersion(version))
+    else:
+      self._storePutMany([(v.key, self._encodeVersion(v)) for v in versions])
+
+    self._written(versions)
+
+  def _written(self, versions):
+    '''Records `versions`, just stored, in the history, indexes and tree.'''
+    if self._history is not None:
+      self._history.put_many(versions)
+
+    with self._stateLock:
+      for version in versions:
+        self._indexes.put(version)
+        self._merkle.put(version.key, version.hash)
+    if self._cache is not None:
+      for version in versions:
+        self._cache.invalidate(version.key)
+
+  def _swap(self, version, old):
+    '''Stores `version` only if the stored value of its key is still `old`
+    (None if absent), comparing hashes. Returns whether it was stored.'''
+    new = self._encodeVersion(version)
+    if hasattr(self._store, 'compare_and_swap'):
+      if not self._store.compare_and_swap(version.key, old, new):
+        return False
+    else:
+      current = self._store.get(version.key)
+      if (current is None) != (old is None) or (current is not None and \
+          self._hashFromData(current) != self._hashFromData(old)):
+        return False
+      self._store.put(version.key, new)
+
+    self._written([version])
+    return True
+
+  def _remove(self, keys):
+    '''Deletes `keys` (distinct) and removes them from the indexes.'''
+    if len(keys) == 1:
+      self._store.delete(keys[0])
+    else:
+      self._storeDeleteMany(keys)
+
+    with self._stateLock:
+      for key in keys:
+        self._indexes.delete(key)
+        self._merkle.delete(key)
+    if self._cache is not None:
+      for key in keys:
+        self._cache.invalidate(key)
+
+
   def put(self, versionOrEntity):
     '''Stores the current version of `entity` in the datastore.'''
     version = self._cleanVersion(versionOrEntity)
-    self._store.put(version.key, version.serialRepresentation.data())
+    with self._keyLocks.locked([version.key]):
+      self._write([version])
     return versionOrEntity
 
 
+  def put_many(self, versionsOrEntities):
+    '''Stores the current versions of all `versionsOrEntities`.
+
+    All inputs are validated before anything is written. If several inputs
+    share a key, the last one wins (as with successive calls to `put`).
+    Returns the inputs, in order.
+    '''
+    versionsOrEntities = list(versionsOrEntities)
+    versions = map(self._cleanVersion, versionsOrEntities)
+
+    # group by key, preserving the order in which keys were first seen.
+    keys = []
+    latest = {}
+    for version in versions:
+      key = version.key
+      if key not in latest:
+        keys.append(key)
+      latest[key] = version
+
+    with self._keyLocks.locked(keys):
+      self._write([latest[k] for k in keys])
+    return versionsOrEntities
+
+
   def get(self, key):
     '''Retrieves the current entity addressed by `key`'''
-    if not isinstance(key, Key):
-      raise ValueError('key must be of type %s' % Key)
+    key = self._cleanKey(key)
+    if self._cache is not None:
+      return self._cachedGet(key)
 
     # lookup the key in the datastore
-    data = self._store.get(key)
-    if data is None:
-      return data
+    return self._instanceFromData(self._store.get(key))
 
-    # handle the data. if any conversion fails, propagate the exception up.
-    serialRep = SerialRepresentation(data)
-    version = Version(serialRep)
-    return Model.from_version(version)
 
+  def get_many(self, keys):
+    '''Retrieves the current entities addressed by `keys`.
+
+    Duplicate keys are only looked up once. Returns a list of instances in the
+    order of `keys`, with None for keys not found.
+    '''
+    keys = map(self._cleanKey, keys)
+    unique = list(_unique(keys))
+
+    datas = self._storeGetMany(unique)
+    if self._cache is None:
+      instances = dict(zip(unique, map(self._instanceFromData, datas)))
+    else:
+      instances = dict([(k, self._cachedInstance(k, d)) \
+        for k, d in zip(unique, datas)])
+    return [instances[key] for key in keys]
+
+
+  def merge(self, newVersionOrEntity, ancestor=None):
+    '''Merges a new version of an instance with the current one in the store.
+
+    The common ancestor of both versions, if given or found in the history of
+    this repo, lets strategies skip attributes unchanged since (see
+    merge.merge).
 
-  def merge(self, newVersionOrEntity):
-    '''Merges a new version of an instance with the current one in the store.'''
+    The key is locked while merging. With compare-and-swap (`cas`), a merge
+    whose result cannot be stored because the key changed meanwhile is
+    retried, up to CAS_ATTEMPTS times, before raising MergeConflictError.
+    '''
 
     # get the new version
     new_version = self._cleanVersion(newVersionOrEntity)
+    key = new_version.key
+
+    with self._keyLocks.locked([key]):
+      if not self._cas:
+        return self._merge(new_version, ancestor)
+
+      for attempt in xrange(0, self.CAS_ATTEMPTS):
+        curr_instance = self._casMerge(new_version, ancestor)
+        if curr_instance is not None:
+          return curr_instance
 
+    raise MergeConflictError('%s changed during %d merge attempts' % \
+      (key, self.CAS_ATTEMPTS))
+
+  def _merge(self, new_version, ancestor):
     # get the instance
     key = new_version.key
-    curr_instance = self.get(key) #THINKME(jbenet): try contains first?
+    if self._cache is None:
+      curr_instance = self.get(key) #THINKME(jbenet): try contains first?
+    else: # merging changes the instance: do not merge into a shared one.
+      curr_instance = self._cachedGet(key, shared=False)
 
     # brand new version. just store it.
     if curr_instance is None:
       self.put(new_version)
       return Model.from_version(new_version)
 
+    if ancestor is None:
+      ancestor = self._ancestor(curr_instance.version, new_version)
+    if self._history is not None:
+      self._history.put(new_version)
+
     # NOTE: semantically, we must merge into the current instance in the repo
     # so that merge strategies favor the incumbent version.
-    curr_instance.merge(new_version)
+    curr_instance.merge(new_version, ancestor)
 
     # store it back
     self.put(curr_instance)
     return curr_instance
 
+  def _casMerge(self, new_version, ancestor):
+    '''Attempts a compare-and-swap merge. Returns the resulting instance, or
+    None if the stored version changed before the result could be stored.'''
+    key = new_version.key
+    data = self._store.get(key)
+    if self._cache is None:
+      curr_instance = self._instanceFromData(data)
+    else:
+      curr_instance = self._cachedInstance(key, data, shared=False)
+
+    if curr_instance is None:
+      if not self._swap(new_version, None):
+        return None
+      return Model.from_version(new_version)
+
+    if ancestor is None:
+      ancestor = self._ancestor(curr_instance.version, new_version)
+    if self._history is not None:
+      self._history.put(new_version)
+
+    curr_hash = curr_instance.version.hash
+    curr_instance.merge(new_version, ancestor)
+    if curr_instance.version.hash == curr_hash:
+      return curr_instance # nothing to store.
+
+    if not self._swap(curr_instance.version, data):
+      return None
+    return curr_instance
+
+
+  def merge_many(self, newVersionsOrEntities):
+    '''Merges new versions of instances with the current ones in the store.
+
+    Current instances are fetched in one batch, all merges happen in memory,
+    and the results are written back in one batch. Versions sharing a key are
+    merged in input order into the same instance. Returns a list with the
+    resulting instance for each input, in order.
+    '''
+    new_versions = map(self._cleanVersion, newVersionsOrEntities)
+    keys = [version.key for version in new_versions]
+    with self._keyLocks.locked(keys):
+      instances = self._mergeTargets(keys)
+      return self._mergeInto(instances, new_versions)
+
+  def merge_deltas(self, deltas):
+    '''Merges new versions sent as deltas (see dronestore.delta).
+
+    Deltas are applied to the current versions in the store, and merged like
+    `merge_many` does. Returns the keys of the deltas that could not be
+    applied (their base is not the current version here): these versions
+    must be transferred in full.
+    '''
+    deltas = list(deltas)
+    keys = [Key(d['key']) for d in deltas]
+    with self._keyLocks.locked(keys):
+      instances = self._mergeTargets(keys)
+
+      new_versions, unknown = [], []
+      for delta in deltas:
+        current = instances[Key(delta['key'])]
+        try:
+          new_versions.append(apply_delta(delta, current and current.version))
+        except DeltaError:
+          unknown.append(delta['key'])
+
+      self._mergeInto(instances, new_versions)
+    return unknown
+
+  def merge_all(self, newVersionsOrEntities, processes=None, batchSize=1000):
+    '''Merges an iterable of new versions (e.g. a dump from another repo),
+    using a pool of `processes` worker processes (default: one per cpu).
+
+    Versions are read in batches of `batchSize` per process. Each batch is
+    partitioned by key hash, so all versions of a key are merged by a single
+    worker, in input order. The current versions (and ancestors) are read in
+    this process, and each partition's results are written back in one batch
+    once its worker returns. The keys of a partition stay locked from reading
+    until writing. Returns the number of keys changed.
+
+    With a history, each merge of a key uses the common ancestor with the
+    result of the previous one: keys with several versions in a batch are
+    then merged in this process, as merge_many does.
+
+    Workers rebuild instances by type name, so the models must be defined at
+    import time (the pool forks after they are registered).
+    '''
+    if processes is None:
+      processes = multiprocessing.cpu_count()
+
+    versions = imap(self._cleanVersion, newVersionsOrEntities)
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    pending = [] # (keys, result getter) of the partitions being merged
+    changed = 0
+    try:
+      while True:
+        batch = list(islice(versions, batchSize * processes))
+        if not batch:
+          break
+
+        for byKey in self._mergePartitions(batch, processes):
+          # never wait for keys while holding those of other partitions.
+          keys = byKey.keys()
+          if not self._keyLocks.acquireMany(keys, blocking=not pending):
+            changed += self._writePartitions(pending)
+            self._keyLocks.acquireMany(keys)
+          try:
+            changed += self._mergeSerially(byKey)
+            task = byKey and self._mergeTask(byKey)
+          except:
+            self._keyLocks.releaseMany(keys)
+            raise
+          if not task:
+            self._keyLocks.releaseMany(keys)
+            continue
+
+          if pool is None:
+            pending.append((keys, partial(_mergePartition, task)))
+            changed += self._writePartitions(pending)
+          else:
+            result = pool.apply_async(_mergePartition, (task,))
+            pending.append((keys, result.get))
+        changed += self._writePartitions(pending)
+    except:
+      if pool is not None:
+        pool.terminate()
+        pool.join()
+      raise
+    finally:
+      for keys, result in pending:
+        self._keyLocks.releaseMany(keys)
+
+    if pool is not None:
+      pool.close()
+      pool.join()
+    return changed
+
+  def _mergePartitions(self, new_versions, partitions):
+    '''Groups `new_versions` by key, and the keys by partition (key hash).
+    Returns the non-empty partitions, as dicts of {key : [versions]}.'''
+    byPartition = [{} for i in xrange(0, partitions)]
+    for version in new_versions:
+      key = version.key
+      byKey = byPartition[fasthash.hash(str(key)) % partitions]
+      byKey.setdefault(key, []).append(version)
+    return filter(None, byPartition)
+
+  def _mergeSerially(self, byKey):
+    '''Merges, in this process, the keys of a partition with several versions
+    (if there is a history: see merge_all), and removes them from `byKey`.
+    Returns the number of keys changed.'''
+    if self._history is None:
+      return 0
+    keys = [key for key, versions in byKey.iteritems() if len(versions) > 1]
+    if not keys:
+      return 0
+
+    instances = self._mergeTargets(keys)
+    hashes = dict([(k, i and i.version.hash) for k, i in instances.iteritems()])
+    self._mergeInto(instances, [v for key in keys for v in byKey.pop(key)])
+    return len([k for k in keys if instances[k].version.hash != hashes[k]])
+
+  def _mergeTask(self, byKey):
+    '''Reads the current versions (and ancestors) of the keys of a partition.
+    Returns the items of _mergePartition.'''
+    keys = byKey.keys()
+    currents = [self._versionFromData(d) if d is not None else None \
+      for d in self._storeGetMany(keys)]
+
+    # remote versions become part of our history, for later merges.
+    if self._history is not None:
+      self._history.put_many([v for key in keys for v in byKey[key]])
+
+    items = []
+    for key, current in zip(keys, currents):
+      news = []
+      for version in byKey[key]:
+        ancestor = current and self._ancestor(current, version)
+        news.append((version.data(), ancestor and ancestor.data()))
+      items.append((current and current.data(), news))
+    return items
+
+  def _writePartitions(self, pending):
+    '''Writes the results of the `pending` partitions of merge_all, in order,
+    releasing the keys of each once written. Returns the number of keys
+    changed.'''
+    changed = 0
+    while pending:
+      keys, result = pending[0]
+      datas = result()
+      if datas:
+        self._write([Version.from_data(d, decoder=None) for d in datas])
+        changed += len(datas)
+      pending.pop(0)
+      self._keyLocks.releaseMany(keys)
+    return changed
+
+  def _mergeTargets(self, keys):
+    '''Fetches (unshared) current instances of `keys`, in one batch. Returns
+    a dict of {key : instance or None}.'''
+    unique = list(_unique(keys))
+    datas = self._storeGetMany(unique)
+    if self._cache is None:
+      return dict(zip(unique, map(self._instanceFromData, datas)))
+    return dict([(k, self._cachedInstance(k, d, shared=False)) \
+      for k, d in zip(unique, datas)])
+
+  def _mergeInto(self, instances, new_versions):
+    '''Merges `new_versions` into `instances` (see `_mergeTargets`), writes
+    back the changed ones in one batch, and returns the resulting instance
+    for each new version.'''
+    keys = [version.key for version in new_versions]
+    changed = []
+
+    # remote versions become part of our history, for later merges.
+    if self._history is not None:
+      self._history.put_many(new_versions)
+    for version in new_versions:
+      key = version.key
+      curr_instance = instances[key]
+
+      # brand new version. just store it.
+      if curr_instance is None:
+        instances[key] = Model.from_version(version)
+        changed.append(key)
+        continue
+
+      # see `merge`: merge into the incumbent instance.
+      curr_hash = curr_instance.version.hash
+      ancestor = self._ancestor(curr_instance.version, version)
+      curr_instance.merge(version, ancestor)
+      if curr_instance.version.hash != curr_hash:
+        changed.append(key)
+        # as `merge` does when writing it: later versions of this key find
+        # their ancestor through this result.
+        if self._history is not None:
+          self._history.put(curr_instance.version)
+
+    changed = list(_unique(changed))
+    if changed:
+      self._write([instances[k].version for k in changed])
+
+    return [instances[key] for key in keys]
+
+
+  def _ancestor(self, local, remote):
+    '''Returns the common ancestor of two versions, if the history has it.'''
+    if self._history is None:
+      return None
+    return self._history.ancestor(local, remote)
+
 
   def contains(self, key):
     '''Returns whether the datastore contains the entity addressed by `key`.'''
-    if not isinstance(key, Key):
-      raise ValueError('key must be of type %s' % Key)
-
+    key = self._cleanKey(key)
     return self._store.contains(key)
 
 
   def delete(self, key):
     '''Deletes the entity addressed by `key` from the datastore.'''
-    if not isinstance(key, Key):
-      raise ValueError('key must be of type %s' % Key)
+    key = self._cleanKey(key)
+    with self._keyLocks.locked([key]):
+      self._remove([key])
+
+
+  def delete_many(self, keys):
+    '''Deletes the entities addressed by `keys` from the datastore.'''
+    keys = list(_unique(map(self._cleanKey, keys)))
+    with self._keyLocks.locked(keys):
+      self._remove(keys)
+
+  def query(self, query, views=False):
+    '''Queries the datastore for objects matching `query`.
+
+    Yields Model instances or, for projection queries (see Query) or if
+    `views`, read-only InstanceViews, which only decode the attributes read.
+    '''
+    fields = getattr(query, 'fields', None)
+
+    versions = self._indexQuery(query)
+    if versions is not None:
+      return InstanceIterator(versions, fields=fields, views=views)
+
+    if self._codec is None:
+      return InstanceIterator(self._store.query(query), trusted=True, \
+        fields=fields, views=views)
+
+    # the datastore cannot look into encoded versions, so decode them all
+    # and apply the query here.
+    encoded = self._store.query(DatastoreQuery(query.key))
+    return InstanceIterator(query(imap(self._versionFromData, encoded)), \
+      fields=fields, views=views)
+
+  def _scan(self, collection):
+    '''Yields all the versions stored in `collection` (a key path).'''
+    stored = self._store.query(DatastoreQuery(collection))
+    return imap(self._versionFromData, stored)
+
+  def history(self, key, limit=None):
+    '''Yields the versions of the entity addressed by `key`, from the current
+    one back, as far as the history of this repo goes.'''
+    if self._history is None:
+      raise ValueError('repo %s keeps no history' % self.repoid)
+
+    data = self._store.get(self._cleanKey(key))
+    if data is None:
+      return iter([])
+    return self._history.history(self._versionFromData(data), limit)
+
+  def collectHistory(self, collections):
+    '''Garbage-collects the history of the versions not reachable from the
+    current versions in `collections` (key paths). The history must not be
+    shared with other repos or collections. See HistoryStore.gc.'''
+    roots = []
+    for collection in collections:
+      roots.extend([v.hash for v in self._scan(Key(collection))])
+    return self._history.gc(roots)
+
+  def merkleTree(self, collections):
+    '''Returns the Merkle tree of the (key, version hash) pairs stored in this
+    repo (see dronestore.sync), built for `collections` (key paths). The
+    tree holds the repo's state lock while read, so it can be read during
+    writes.'''
+    for collection in collections:
+      # scan under the lock: writes made meanwhile must not be missed.
+      with self._stateLock:
+        if not self._merkle.isBuilt(collection):
+          versions = self._scan(Key(collection))
+          self._merkle.build(collection, ((v.key, v.hash) for v in versions))
+    return self._merkle
+
+  def _fetch(self, keys):
+    '''Yields the stored versions of `keys` (strings), skipping missing ones.
+    Versions are fetched lazily, INDEX_BATCH_SIZE at a time.'''
+    keys = iter(keys)
+    while True:
+      batch = map(Key, islice(keys, self.INDEX_BATCH_SIZE))
+      if not batch:
+        break
+      for data in self._storeGetMany(batch):
+        if data is not None:
+          yield self._versionFromData(data)
+
+  def _indexQuery(self, query):
+    '''Answers `query` from the attribute indexes. Returns an iterable of
+    matching versions, or None if the indexes cannot help.'''
+    with self._stateLock: # the plan's keys are a copy, read after.
+      if not self._indexes.isBuilt(query.key):
+        try:
+          dstype = Model.modelNamed(query.key.name).__dstype__
+        except UnregisteredModelError:
+          return None
+        if not IndexSet.indexedAttributes(dstype):
+          return None
+        self._indexes.build(query.key, dstype, self._scan(query.key))
+
+      plan = self._indexes.plan(query)
+    if plan is None:
+      return None
 
-    self._store.delete(key)
+    keys, ordered = plan
+    if not ordered:
+      return query(self._fetch(keys))
 
-  def query(self, query):
-    '''Queries the datastore for objects matching `query`.'''
-    return InstanceIterator(self._store.query(query))
+    # candidates are already in order: filter, skip and limit as they stream.
+    cursor = Cursor(query, filtered(query, self._fetch(keys)))
+    cursor.apply_offset()
+    cursor.apply_limit()
+    return cursor
@@ -0,0 +1,371 @@
+'''
+A persistent, log-structured local datastore::
+
+    store = SegmentDatastore('/var/repo/data')
+    repo = Repo('/repo', store)
+
+Values are appended to segment files in `root`. A new segment is started
+once the current one reaches `segmentSize` bytes; older segments are never
+written again. An in-memory index maps each key to the location of its
+latest value, which is read from a memory map of its segment (no seeks or
+read calls).
+
+Compaction rewrites the live values of the older segments into one, and
+drops the superseded values. A deletion is kept while an older segment holds
+a value of its key: the compacted segment replaces the newest of the older
+segments before the others are removed, and a crash in between must not
+bring deleted values back. Compaction runs in the background once
+superseded bytes make up `compactRatio` of the older segments, or on demand
+(`compact`). Writes and reads proceed meanwhile.
+
+On close, a snapshot of the index is saved, so the next startup only scans
+what was written after it. Without a usable snapshot (e.g. after a crash),
+the segments are scanned in full. A record torn by a crash is discarded.
+
+Queries return the values stored under a key path (e.g. all the versions of
+a Model, as Repo.query asks), read lazily in key order.
+'''
+
+import os
+import zlib
+import mmap
+import struct
+import threading
+import cPickle as pickle
+
+from datastore.core import Datastore, Key
+
+
+_HEADER = struct.Struct('>BIII') # flag, key length, value length, crc32
+_PUT_STRING, _PUT_OBJECT, _DELETE = 1, 2, 3
+
+SNAPSHOT = 'index.snapshot'
+
+
+def _segmentName(id):
+  return 'segment-%08d.log' % id
+
+
+class _Segment(object):
+  '''A segment file, appended to while it is the active one, read through a
+  memory map.'''
+
+  def __init__(self, path, id):
+    self.id = id
+    self.path = os.path.join(path, _segmentName(id))
+    self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644)
+    self.size = os.fstat(self._fd).st_size
+    self._map = None
+
+  def append(self, data, sync=False):
+    '''Appends `data`. Returns the offset it was written at.'''
+    offset = self.size
+    os.write(self._fd, data)
+    self.size += len(data)
+    if sync:
+      os.fsync(self._fd)
+    return offset
+
+  def truncate(self, size):
+    os.ftruncate(self._fd, size)
+    self.size = size
+    self._map = None
+
+  def read(self, offset, length):
+    view = self._map
+    if view is None or offset + length > len(view):
+      view = self._map = mmap.mmap(self._fd, self.size, access=mmap.ACCESS_READ)
+    return view[offset:offset + length]
+
+  def records(self, start=0):
+    '''Yields the (offset, flag, key, value offset, value length) records
+    from `start`, up to the first incomplete or corrupt one.'''
+    offset = start
+    while offset + _HEADER.size <= self.size:
+      flag, keyLength, valueLength, crc = \
+        _HEADER.unpack(self.read(offset, _HEADER.size))
+      body = offset + _HEADER.size
+      end = body + keyLength + valueLength
+      if flag not in (_PUT_STRING, _PUT_OBJECT, _DELETE) or end > self.size:
+        return
+
+      data = self.read(body, keyLength + valueLength)
+      if zlib.crc32(data) & 0xffffffff != crc:
+        return
+      yield offset, flag, data[:keyLength], body + keyLength, valueLength
+      offset = end
+
+  def close(self):
+    self._map = None
+    os.close(self._fd)
+
+
+def _record(flag, name, payload):
+  data = name + payload
+  crc = zlib.crc32(data) & 0xffffffff
+  return _HEADER.pack(flag, len(name), len(payload), crc) + data
+
+
+class SegmentDatastore(Datastore):
+  '''Stores values in append-only segment files under directory `root`.'''
+
+  def __init__(self, root, segmentSize=64 * 1024 * 1024, compactRatio=0.5,
+               sync=False):
+    self.root = root
+    self.segmentSize = segmentSize
+    self.compactRatio = compactRatio
+    self.sync = sync
+
+    self._lock = threading.RLock()
+    self._index = {} # key -> (segment id, offset, length, flag)
+    self._collections = {} # key path -> set of keys
+    self._garbage = {} # segment id -> superseded bytes
+    self._segments = {} # segment id -> _Segment
+    self._compactor = None
+    self._compactLock = threading.Lock()
+
+    if not os.path.isdir(root):
+      os.makedirs(root)
+    self._load()
+
+  # loading
+
+  def _load(self):
+    ids = sorted([int(name[8:16]) for name in os.listdir(self.root) \
+      if name.startswith('segment-') and name.endswith('.log')])
+    for id in ids:
+      self._segments[id] = _Segment(self.root, id)
+    if not ids:
+      ids = [1]
+      self._segments[1] = _Segment(self.root, 1)
+    self._active = self._segments[ids[-1]]
+
+    sizes = self._loadSnapshot()
+    self.scanned = 0 # records read at startup
+    for id in ids:
+      segment = self._segments[id]
+      end = sizes.get(id, 0)
+      for offset, flag, name, valueOffset, length in segment.records(end):
+        self._apply(name, (id, valueOffset, length, flag))
+        end = valueOffset + length
+        if flag == _DELETE: # as in _write.
+          self._collect(id, end - offset)
+        self.scanned += 1
+      if end < segment.size: # torn record: drop it.
+        segment.truncate(end)
+
+  def _loadSnapshot(self):
+    '''Loads the index snapshot, if usable. Returns the size of each segment
+    it covers ({} if none).'''
+    path = os.path.join(self.root, SNAPSHOT)
+    try:
+      with open(path, 'rb') as f:
+        snapshot = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+      return {}
+
+    for id, size in snapshot['sizes'].iteritems():
+      if id not in self._segments or self._segments[id].size < size:
+        return {} # stale: scan everything.
+
+    self._index = snapshot['index']
+    self._garbage = snapshot['garbage']
+    for name in self._index:
+      self._collections.setdefault(str(Key(name).path), set()).add(name)
+    return snapshot['sizes']
+
+  def _removeSnapshot(self):
+    path = os.path.join(self.root, SNAPSHOT)
+    if os.path.exists(path):
+      os.unlink(path)
+
+  def snapshot(self):
+    '''Saves a snapshot of the index, for a fast startup.'''
+    with self._lock:
+      snapshot = {
+        'sizes': dict([(id, s.size) for id, s in self._segments.iteritems()]),
+        'index': dict(self._index),
+        'garbage': dict(self._garbage),
+      }
+
+    path = os.path.join(self.root, SNAPSHOT)
+    with open(path + '.tmp', 'wb') as f:
+      pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+  # index
+
+  def _apply(self, name, location):
+    '''Points key `name` to `location`, that of its latest record.'''
+    old = self._index.pop(name, None)
+    if old is not None:
+      self._collect(old[0], _HEADER.size + len(name) + old[2])
+
+    collection = str(Key(name).path)
+    if location[3] == _DELETE:
+      keys = self._collections.get(collection)
+      if keys is not None:
+        keys.discard(name)
+        if not keys:
+          del self._collections[collection]
+      return
+
+    self._index[name] = location
+    self._collections.setdefault(collection, set()).add(name)
+
+  def _collect(self, id, size):
+    '''Accounts for `size` superseded bytes in segment `id`.'''
+    self._garbage[id] = self._garbage.get(id, 0) + size
+
+  def _read(self, location):
+    id, offset, length, flag = location
+    data = self._segments[id].read(offset, length)
+    return data if flag == _PUT_STRING else pickle.loads(data)
+
+  # datastore interface
+
+  def get(self, key):
+    with self._lock:
+      location = self._index.get(str(key))
+      if location is None:
+        return None
+      return self._read(location)
+
+  def contains(self, key):
+    return str(key) in self._index
+
+  def put(self, key, value):
+    if isinstance(value, str):
+      flag, payload = _PUT_STRING, value
+    else:
+      flag, payload = _PUT_OBJECT, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    self._write(str(key), flag, payload)
+
+  def delete(self, key):
+    name = str(key)
+    if name in self._index:
+      self._write(name, _DELETE, '')
+
+  def _write(self, name, flag, payload):
+    record = _record(flag, name, payload)
+    with self._lock:
+      offset = self._active.append(record, self.sync)
+      location = (self._active.id, offset + _HEADER.size + len(name), \
+        len(payload), flag)
+      self._apply(name, location)
+      if flag == _DELETE: # the tombstone itself is garbage, once compacted.
+        self._collect(self._active.id, len(record))
+
+      if self._active.size >= self.segmentSize:
+        self._rotate()
+
+  def query(self, query):
+    '''Returns the values stored under key path `query.key`, read lazily in
+    key order, with the query applied.'''
+    with self._lock:
+      names = sorted(self._collections.get(str(query.key), ()))
+
+    def values():
+      for name in names:
+        value = self.get(name)
+        if value is not None:
+          yield value
+    return query(values())
+
+  def __len__(self):
+    return len(self._index)
+
+  # segments and compaction
+
+  def _rotate(self):
+    '''Starts a new active segment; compacts the others if worth it.'''
+    id = self._active.id + 1
+    self._active = self._segments[id] = _Segment(self.root, id)
+
+    sealed = [s for s in self._segments.itervalues() if s.id != id]
+    total = sum([s.size for s in sealed])
+    garbage = sum([self._garbage.get(s.id, 0) for s in sealed])
+    if total and float(garbage) / total >= self.compactRatio and \
+        (self._compactor is None or not self._compactor.is_alive()):
+      self._compactor = threading.Thread(target=self.compact)
+      self._compactor.daemon = True
+      self._compactor.start()
+
+  def compact(self):
+    '''Rewrites the live values of all segments but the active one into a
+    single segment. Returns the number of bytes reclaimed.'''
+    with self._compactLock:
+      return self._compact()
+
+  def _compact(self):
+    with self._lock:
+      if len(self._segments) < 2:
+        return 0
+      sealed = sorted([id for id in self._segments if id != self._active.id])
+      live = [(name, loc) for name, loc in self._index.iteritems() \
+        if loc[0] in sealed]
+      indexed = set(self._index)
+      before = sum([self._segments[id].size for id in sealed])
+
+    # deleted keys with values left in the sealed segments: their deletions
+    # are kept, in case a crash leaves some of these segments behind.
+    deleted = set()
+    for id in sealed:
+      for offset, flag, name, _, _ in self._segments[id].records():
+        if flag != _DELETE and name not in indexed:
+          deleted.add(name)
+
+    # write the live values to a new file (the segments are immutable).
+    target = sealed[-1]
+    temp = os.path.join(self.root, 'compact.tmp')
+    moved = {}
+    tombstones = 0
+    with open(temp, 'wb') as f:
+      offset = 0
+      for name, (id, valueOffset, length, flag) in sorted(live):
+        payload = self._segments[id].read(valueOffset, length)
+        record = _record(flag, name, payload)
+        f.write(record)
+        moved[name] = (target, offset + _HEADER.size + len(name), length, flag)
+        offset += len(record)
+      for name in sorted(deleted):
+        record = _record(_DELETE, name, '')
+        f.write(record)
+        offset += len(record)
+        tombstones += len(record)
+      f.flush()
+      os.fsync(f.fileno())
+
+    with self._lock:
+      # an outdated snapshot would point into rewritten segments.
+      self._removeSnapshot()
+      for id in sealed:
+        self._segments.pop(id).close()
+        self._garbage.pop(id, None)
+      self._collect(target, tombstones)
+      os.rename(temp, os.path.join(self.root, _segmentName(target)))
+      for id in sealed[:-1]:
+        os.unlink(os.path.join(self.root, _segmentName(id)))
+      self._segments[target] = _Segment(self.root, target)
+
+      # keep the locations of the keys written meanwhile.
+      for name, location in moved.iteritems():
+        current = self._index.get(name)
+        if current is not None and current[0] in sealed:
+          self._index[name] = location
+        else:
+          self._collect(target, _HEADER.size + len(name) + location[2])
+      return before - self._segments[target].size
+
+  def close(self):
+    '''Waits for compaction, saves an index snapshot and closes the files.'''
+    compactor = self._compactor
+    if compactor is not None:
+      compactor.join()
+    self.snapshot()
+    with self._lock:
+      for segment in self._segments.itervalues():
+        segment.close()
+      self._segments = {}
@@ -0,0 +1,213 @@
+'''
+Sharding: one logical datastore spread over several, by key::
+
+    store = ShardedDatastore({'a': storeA, 'b': storeB, 'c': storeC})
+    repo = Repo('/repo', store)
+
+Keys are assigned to shards with consistent hashing (util.fasthash, i.e.
+murmur3): each shard owns `replicas` points on a hash ring, and a key belongs
+to the shard owning the first point at or after its hash. Shards are named,
+so assignments do not depend on their order.
+
+Queries are sent to every shard (scatter-gather). Each shard returns at most
+offset + limit results, in the query's order; these are merged in order
+before the offset and limit are applied.
+
+Resharding (adding, removing or replacing shards) only migrates the keys
+whose owner changes, which for an added shard are about 1/N of them.
+'''
+
+import bisect
+
+from itertools import chain
+
+from util import fasthash
+from query import ordered
+from datastore.core import Datastore, Key
+from datastore.core.query import Query as DatastoreQuery
+
+
+class HashRing(object):
+  '''A consistent hash ring over shard `names`.'''
+
+  def __init__(self, names, replicas=100):
+    if not names:
+      raise ValueError('a hash ring needs at least one shard')
+
+    self.names = sorted(names)
+    self.replicas = replicas
+    points = []
+    for name in self.names:
+      for i in xrange(0, replicas):
+        points.append((fasthash.hash('%s#%d' % (name, i)), name))
+    points.sort()
+    self._hashes = [h for h, name in points]
+    self._names = [name for h, name in points]
+
+  def owner(self, key):
+    '''Returns the name of the shard owning `key`.'''
+    i = bisect.bisect_left(self._hashes, fasthash.hash(str(key)))
+    return self._names[i % len(self._names)]
+
+
+def _version_key(value):
+  return Key(value['key'])
+
+
+class ShardedDatastore(Datastore):
+  '''Spreads keys over the datastores `shards` (a dict of {name : datastore},
+  or a list, named by position).
+
+  Resharding needs the key of each stored value: `keyOf(value)` returns it.
+  By default, values are taken to be version data (as stored by a Repo
+  without a codec); with a codec, pass e.g.::
+
+    keyOf=lambda value: Key(codec.decode_header(value)['key'])
+
+  Given an `executor` (see dronestore.asyncrepo), shards are queried
+  concurrently.
+  '''
+
+  def __init__(self, shards, replicas=100, keyOf=_version_key, executor=None):
+    self.replicas = replicas
+    self.keyOf = keyOf
+    self.executor = executor
+    self._setShards(shards)
+
+  @staticmethod
+  def _named(shards):
+    if isinstance(shards, dict):
+      return dict(shards)
+    return dict([(str(i), s) for i, s in enumerate(shards)])
+
+  def _setShards(self, shards):
+    shards = self._named(shards)
+    for shard in shards.itervalues():
+      if not isinstance(shard, Datastore):
+        raise TypeError('shards must be of type %s' % Datastore)
+    self._ring = HashRing(shards.keys(), self.replicas)
+    self._shards = shards
+
+  @property
+  def shards(self):
+    '''The {name : datastore} of the shards.'''
+    return dict(self._shards)
+
+  def shardOf(self, key):
+    '''Returns the name of the shard of `key`.'''
+    return self._ring.owner(key)
+
+  def _shard(self, key):
+    return self._shards[self._ring.owner(key)]
+
+  def _group(self, keys):
+    '''Returns {shard name : [indices of keys in `keys`]}.'''
+    groups = {}
+    for i, key in enumerate(keys):
+      groups.setdefault(self._ring.owner(key), []).append(i)
+    return groups
+
+  # datastore interface
+
+  def get(self, key):
+    return self._shard(key).get(key)
+
+  def put(self, key, value):
+    self._shard(key).put(key, value)
+
+  def delete(self, key):
+    self._shard(key).delete(key)
+
+  def contains(self, key):
+    return self._shard(key).contains(key)
+
+  def get_many(self, keys):
+    '''Returns the values of `keys`, with one bulk get per shard.'''
+    keys = list(keys)
+    values = [None] * len(keys)
+    for name, indices in self._group(keys).iteritems():
+      shard = self._shards[name]
+      group = [keys[i] for i in indices]
+      if hasattr(shard, 'get_many'):
+        found = shard.get_many(group)
+      else:
+        found = map(shard.get, group)
+      for i, value in zip(indices, found):
+        values[i] = value
+    return values
+
+  def put_many(self, items):
+    items = list(items)
+    for name, indices in self._group([k for k, v in items]).iteritems():
+      shard = self._shards[name]
+      group = [items[i] for i in indices]
+      if hasattr(shard, 'put_many'):
+        shard.put_many(group)
+      else:
+        for key, value in group:
+          shard.put(key, value)
+
+  def delete_many(self, keys):
+    keys = list(keys)
+    for name, indices in self._group(keys).iteritems():
+      shard = self._shards[name]
+      group = [keys[i] for i in indices]
+      if hasattr(shard, 'delete_many'):
+        shard.delete_many(group)
+      else:
+        map(shard.delete, group)
+
+  def query(self, query):
+    '''Queries every shard, and merges their results (see module doc).'''
+    scattered = query.copy()
+    scattered.offset = 0
+    if query.limit is not None:
+      scattered.limit = query.offset + query.limit
+
+    shards = [self._shards[name] for name in self._ring.names]
+    if self.executor is None:
+      results = [shard.query(scattered) for shard in shards]
+    else:
+      futures = [self.executor.submit(lambda s: list(s.query(scattered)), \
+        shard) for shard in shards]
+      results = [future.result() for future in futures]
+
+    # each shard's results are in order: merge them, then offset and limit.
+    merged = ordered(query, chain(*results)) if query.orders \
+      else chain(*results)
+
+    gathered = query.copy()
+    gathered.filters = []
+    gathered.orders = []
+    return gathered(merged)
+
+  # resharding
+
+  def reshard(self, shards, collections):
+    '''Moves to the datastores `shards` (as in the constructor; shards that
+    keep their name must keep their datastore). Migrates the keys of
+    `collections` (key paths) whose owner changes: they are copied to their
+    new shard, the new shards take over, and the copies left behind are
+    deleted. Writes must be paused meanwhile. Returns the number of keys
+    moved.'''
+    shards = self._named(shards)
+    for name, shard in shards.iteritems():
+      if name in self._shards and self._shards[name] is not shard:
+        raise ValueError('shard %s must keep its datastore' % name)
+
+    ring = HashRing(shards.keys(), self.replicas)
+    moved = [] # (old shard, key)
+    for name, shard in self._shards.iteritems():
+      for collection in collections:
+        values = list(shard.query(DatastoreQuery(Key(str(collection)))))
+        for value in values:
+          key = self.keyOf(value)
+          owner = ring.owner(key)
+          if owner != name:
+            shards[owner].put(key, value)
+            moved.append((shard, key))
+
+    self._setShards(shards)
+    for shard, key in moved:
+      shard.delete(key)
+    return len(moved)
@@ -0,0 +1,355 @@
+'''
+Anti-entropy sync between Repos, using Merkle trees.
+
+Each Repo keeps a Merkle tree over the (key, version hash) pairs it stores,
+one per collection (key path, i.e. model type). Within a collection, keys are
+grouped into buckets by the prefix of their sha1 digest. Two repos compare
+their roots, descend only into differing subtrees (one round trip per tree
+level), and then exchange and merge only the versions that differ::
+
+    peer = LocalTransport(SyncEndpoint(remoteRepo))
+    sync(localRepo, peer, [PersonM, Company])
+
+The remote side is reached through a Transport, which only needs to deliver
+method calls to a SyncEndpoint. LocalTransport does so in process.
+'''
+
+import hashlib
+import threading
+import cPickle as pickle
+
+from model import Key, Version
+
+import delta
+
+
+HEX_DIGITS = '0123456789abcdef'
+EMPTY_DIGEST = ''
+
+
+class SyncError(Exception):
+  pass
+
+
+
+class MerkleTree(object):
+  '''A Merkle tree over (key, version hash) pairs, per collection.
+
+  Leaves are buckets of keys sharing the first `depth` hex digits of their
+  sha1 digest; inner nodes are the prefixes of those. A node is addressed by
+  its prefix ('' is the root). Digests are computed on demand and cached
+  until a key beneath them changes.
+
+  All operations hold `lock` (a re-entrant lock), so a tree can be read while
+  others write to it. Repos pass the lock guarding their other state.
+  '''
+
+  def __init__(self, depth=2, lock=None):
+    self.depth = depth
+    self.lock = lock or threading.RLock()
+    self._buckets = {} # collection -> {prefix : {key : hash}}
+    self._digests = {} # collection -> {prefix : digest}
+
+  @classmethod
+  def collectionOf(cls, key):
+    return str(key.path)
+
+  def bucketOf(self, key):
+    '''Returns the prefix of the bucket of `key`.'''
+    return hashlib.sha1(str(key)).hexdigest()[:self.depth]
+
+  def isBuilt(self, collection):
+    return str(collection) in self._buckets
+
+  def build(self, collection, items):
+    '''(Re)builds the tree of `collection` from (key, hash) `items`.'''
+    collection = str(collection)
+    with self.lock:
+      self._buckets[collection] = {}
+      self._digests[collection] = {}
+      for key, hash in items:
+        self.put(key, hash)
+
+  def _invalidate(self, collection, bucket):
+    digests = self._digests[collection]
+    for i in xrange(0, len(bucket) + 1):
+      digests.pop(bucket[:i], None)
+
+  def put(self, key, hash):
+    '''Records that `key` is at version `hash`.'''
+    collection = self.collectionOf(key)
+    bucket = self.bucketOf(key)
+    with self.lock:
+      buckets = self._buckets.get(collection)
+      if buckets is None:
+        return # not built (yet).
+
+      buckets.setdefault(bucket, {})[str(key)] = hash
+      self._invalidate(collection, bucket)
+
+  def delete(self, key):
+    '''Records that `key` is gone.'''
+    collection = self.collectionOf(key)
+    bucket = self.bucketOf(key)
+    with self.lock:
+      buckets = self._buckets.get(collection)
+      if buckets is None:
+        return
+
+      hashes = buckets.get(bucket, {})
+      if hashes.pop(str(key), None) is not None:
+        if not hashes:
+          del buckets[bucket]
+        self._invalidate(collection, bucket)
+
+  def leaf(self, collection, prefix):
+    '''Returns the {key : hash} of the keys in bucket `prefix`.'''
+    with self.lock:
+      return dict(self._buckets[str(collection)].get(prefix, {}))
+
+  def digest(self, collection, prefix=''):
+    '''Returns the digest of node `prefix` (EMPTY_DIGEST if it has no keys).'''
+    with self.lock: # or a digest computed before a change would be cached.
+      return self._digest(str(collection), prefix)
+
+  def _digest(self, collection, prefix):
+    digests = self._digests[collection]
+    try:
+      return digests[prefix]
+    except KeyError:
+      pass
+
+    if len(prefix) == self.depth:
+      hashes = self._buckets[collection].get(prefix)
+      if hashes:
+        buf = ''.join(['%s=%s,' % item for item in sorted(hashes.iteritems())])
+        digest = hashlib.sha1(buf).hexdigest()
+      else:
+        digest = EMPTY_DIGEST
+    else:
+      children = self._children(collection, prefix)
+      if children:
+        buf = ''.join(['%s=%s,' % item for item in sorted(children.iteritems())])
+        digest = hashlib.sha1(buf).hexdigest()
+      else:
+        digest = EMPTY_DIGEST
+
+    digests[prefix] = digest
+    return digest
+
+  def children(self, collection, prefix):
+    '''Returns the {prefix : digest} of the non-empty children of `prefix`.'''
+    if len(prefix) >= self.depth:
+      raise ValueError('%s is a leaf' % prefix)
+    with self.lock:
+      return self._children(str(collection), prefix)
+
+  def _children(self, collection, prefix):
+    children = {}
+    for digit in HEX_DIGITS:
+      digest = self._digest(collection, prefix + digit)
+      if digest != EMPTY_DIGEST:
+        children[prefix + digit] = digest
+    return children
+
+
+
+class SyncEndpoint(object):
+  '''The remote side of a sync: answers tree and version requests about a
+  repo. Transports deliver calls to an endpoint's methods, whose arguments
+  and results are plain (serializable) values.'''
+
+  METHODS = ['roots', 'children', 'leaves', 'versions', 'merge', 'deltas', \
+    'mergeDeltas']
+
+  def __init__(self, repo):
+    self.repo = repo
+
+  def roots(self, collections):
+    '''Returns the tree depth and the root digest of each collection.'''
+    tree = self.repo.merkleTree(collections)
+    return tree.depth, dict([(c, tree.digest(c)) for c in collections])
+
+  def children(self, collection, prefixes):
+    '''Returns the children digests of each of the inner nodes `prefixes`.'''
+    tree = self.repo.merkleTree([collection])
+    return dict([(p, tree.children(collection, p)) for p in prefixes])
+
+  def leaves(self, collection, prefixes):
+    '''Returns the key hashes of each of the buckets `prefixes`.'''
+    tree = self.repo.merkleTree([collection])
+    return dict([(p, tree.leaf(collection, p)) for p in prefixes])
+
+  def versions(self, keys):
+    '''Returns the data of the current versions of `keys`.'''
+    instances = self.repo.get_many(map(Key, keys))
+    return [i.version.data() for i in instances if i is not None]
+
+  def merge(self, datas):
+    '''Merges versions (as data) into the repo.'''
+    self.repo.merge_many([Version.from_data(d) for d in datas])
+
+  def deltas(self, bases):
+    '''Returns deltas of the current versions of the keys in `bases`, a dict
+    of {key : [base hash, base attribute digests] or None}.'''
+    keys = sorted(bases)
+    instances = self.repo.get_many(map(Key, keys))
+    return [delta.make_delta(i.version, *(bases[k] or [])) \
+      for k, i in zip(keys, instances) if i is not None]
+
+  def mergeDeltas(self, deltas):
+    '''Merges versions (as deltas) into the repo. Returns the keys of the
+    deltas that need a full transfer.'''
+    return self.repo.merge_deltas(deltas)
+
+
+
+class Transport(object):
+  '''Delivers calls to a (remote) SyncEndpoint.'''
+
+  def call(self, method, *args):
+    '''Calls `method` of the remote endpoint with `args`, returns its result.'''
+    raise NotImplementedError
+
+
+class LocalTransport(Transport):
+  '''A Transport to an endpoint in this process. Calls and results are
+  serialized, as they would be on the wire, and counted.'''
+
+  def __init__(self, endpoint):
+    self.endpoint = endpoint
+    self.calls = 0
+    self.bytes = 0
+
+  def _wire(self, value):
+    blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    self.bytes += len(blob)
+    return pickle.loads(blob)
+
+  def call(self, method, *args):
+    if method not in SyncEndpoint.METHODS:
+      raise SyncError('no such sync method: %s' % method)
+    self.calls += 1
+    args = self._wire(args)
+    return self._wire(getattr(self.endpoint, method)(*args))
+
+
+
+def _collection(modelOrCollection):
+  if hasattr(modelOrCollection, '__dstype__'):
+    return str(Key(modelOrCollection.__dstype__))
+  return str(Key(str(modelOrCollection)))
+
+
+def diff(repo, transport, collections):
+  '''Compares `repo` with the remote end of `transport`. Returns the keys
+  whose versions differ as a dict of {key : remote hash} (for keys the remote
+  has), and a list of the keys only `repo` has.'''
+  collections = map(_collection, collections)
+  tree = repo.merkleTree(collections)
+
+  depth, roots = transport.call('roots', collections)
+  if depth != tree.depth:
+    raise SyncError('merkle tree depths differ: %d != %d' % (tree.depth, depth))
+
+  pull, push = {}, []
+  for collection in collections:
+    if roots[collection] == tree.digest(collection):
+      continue # identical.
+
+    # descend level by level into the differing inner nodes.
+    prefixes = ['']
+    for level in xrange(0, depth):
+      remote = transport.call('children', collection, prefixes)
+      differing = []
+      for prefix in prefixes:
+        local = tree.children(collection, prefix)
+        for child in set(local) | set(remote[prefix]):
+          if local.get(child) != remote[prefix].get(child):
+            differing.append(child)
+      prefixes = sorted(differing)
+      if not prefixes:
+        break
+
+    if not prefixes:
+      continue
+
+    # compare the differing buckets key by key.
+    remote = transport.call('leaves', collection, prefixes)
+    for prefix in prefixes:
+      local = tree.leaf(collection, prefix)
+      for key, hash in remote[prefix].iteritems():
+        if local.get(key) != hash:
+          pull[key] = hash
+      push.extend([key for key in local if key not in remote[prefix]])
+
+  return pull, push
+
+
+def sync(repo, transport, collections, deltas=True):
+  '''Reconciles `repo` and the remote end of `transport` in `collections`
+  (Models or key paths). Differing versions are fetched and merged locally,
+  and the results are merged remotely, so both sides converge. Returns the
+  number of keys exchanged.
+
+  With `deltas`, versions travel as deltas (see dronestore.delta) relative to
+  the version the other side has, so unchanged attributes are not sent.
+  '''
+  pull, push = diff(repo, transport, collections)
+  if not deltas:
+    _syncVersions(repo, transport, pull, push)
+  else:
+    _syncDeltas(repo, transport, pull, push)
+  return len(pull) + len(push)
+
+
+def _syncVersions(repo, transport, pull, push):
+  if pull:
+    datas = transport.call('versions', sorted(pull))
+    repo.merge_many([Version.from_data(d) for d in datas])
+
+  # send back what the remote does not have yet: merge results and new keys.
+  keys = map(Key, sorted(pull) + push)
+  instances = [i for i in repo.get_many(keys) \
+    if i is not None and i.version.hash != pull.get(str(i.key))]
+  if instances:
+    transport.call('merge', [i.version.data() for i in instances])
+
+
+def _syncDeltas(repo, transport, pull, push):
+  remote = {} # key -> remote version
+  if pull:
+    # ask for deltas relative to our current versions.
+    keys = sorted(pull)
+    local = dict([(k, i.version) for k, i in \
+      zip(keys, repo.get_many(map(Key, keys))) if i is not None])
+    bases = dict([(k, None) for k in keys])
+    for k, version in local.iteritems():
+      bases[k] = [version.hash, delta.digests(version)]
+
+    unknown = []
+    for d in transport.call('deltas', bases):
+      try:
+        remote[d['key']] = delta.apply_delta(d, local.get(d['key']))
+      except delta.DeltaError: # digests disagree: transfer in full.
+        unknown.append(d['key'])
+    if unknown:
+      for d in transport.call('deltas', dict.fromkeys(unknown)):
+        remote[d['key']] = delta.apply_delta(d)
+
+    repo.merge_many(remote.values())
+
+  # send back what the remote does not have yet, relative to what it has.
+  keys = map(Key, sorted(pull) + push)
+  instances = [i for i in repo.get_many(keys) \
+    if i is not None and i.version.hash != pull.get(str(i.key))]
+  if not instances:
+    return
+
+  deltas = [delta.delta_from(i.version, remote.get(str(i.key))) \
+    for i in instances]
+  unknown = set(transport.call('mergeDeltas', deltas))
+  if unknown:
+    transport.call('merge', [i.version.data() for i in instances \
+      if str(i.key) in unknown])
+
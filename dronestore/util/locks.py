@@ -0,0 +1,83 @@
+import threading
+
+from contextlib import contextmanager
+
+import fasthash
+
+
+class KeyLocks(object):
+  '''Re-entrant locks per key, created on demand and dropped once released.
+
+  The table of locks is split in `stripes`, each guarded by its own mutex, so
+  threads locking different keys never wait on each other's locks, and only
+  briefly share a stripe's mutex.
+  '''
+
+  def __init__(self, stripes=64):
+    self._stripes = [(threading.Lock(), {}) for i in xrange(0, stripes)]
+
+  def _stripe(self, name):
+    return self._stripes[fasthash.hash(name) % len(self._stripes)]
+
+  def acquire(self, key, blocking=True):
+    '''Acquires the lock of `key`. Unless `blocking`, gives up if another
+    thread holds it. Returns whether it was acquired.'''
+    name = str(key)
+    mutex, locks = self._stripe(name)
+    with mutex:
+      entry = locks.get(name)
+      if entry is None:
+        entry = locks[name] = [threading.RLock(), 0]
+      entry[1] += 1
+    if entry[0].acquire(blocking):
+      return True
+
+    with mutex:
+      entry[1] -= 1
+      if not entry[1]:
+        del locks[name]
+    return False
+
+  def release(self, key):
+    name = str(key)
+    mutex, locks = self._stripe(name)
+    with mutex:
+      entry = locks[name]
+      entry[0].release()
+      entry[1] -= 1
+      if not entry[1]:
+        del locks[name]
+
+  def acquireMany(self, keys, blocking=True):
+    '''Acquires the locks of all `keys`, in a global (sorted) order. Unless
+    `blocking`, gives up (holding none of them) if one is held by another
+    thread. Returns whether they were acquired.'''
+    acquired = []
+    for name in sorted(set(map(str, keys))):
+      if not self.acquire(name, blocking):
+        self.releaseMany(acquired)
+        return False
+      acquired.append(name)
+    return True
+
+  def releaseMany(self, keys):
+    for name in sorted(set(map(str, keys)), reverse=True):
+      self.release(name)
+
+  def __len__(self):
+    '''Returns the number of keys currently locked (or waited on).'''
+    return sum([len(locks) for mutex, locks in self._stripes])
+
+  @contextmanager
+  def locked(self, keys):
+    '''Holds the locks of all `keys`, acquired in a global (sorted) order.'''
+    names = sorted(set(map(str, keys)))
+    acquired = []
+    try:
+      for name in names:
+        self.acquire(name)
+        acquired.append(name)
+      yield
+    finally:
+      for name in reversed(acquired):
+        self.release(name)
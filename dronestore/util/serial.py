@@ -1,40 +1,118 @@
 
+import json
 import nanotime
 import datetime
 
+from itertools import imap
+
+
+# types that are already clean, and are kept as they are.
+ATOMIC_TYPES = frozenset([int, long, float, str, unicode, bool, type(None), \
+  datetime.datetime])
+
+
+def _clean_atomic(value):
+  return value
+
+def _clean_dict(value):
+  # fast path: flat dicts of clean values are copied at C speed.
+  if ATOMIC_TYPES.issuperset(imap(type, value.itervalues())) and \
+     ATOMIC_TYPES.issuperset(imap(type, value)):
+    return dict(value)
+  return dict([(clean(k), clean(v)) for k, v in value.iteritems()])
+
+def _clean_list(value):
+  if ATOMIC_TYPES.issuperset(imap(type, value)):
+    return list(value)
+  return [clean(v) for v in value]
+
+def _clean_nanotime(value):
+  return value.nanoseconds()
+
+
+# cleaning functions, by exact type. see _cleaner.
+_cleaners = dict.fromkeys(ATOMIC_TYPES, _clean_atomic)
+_cleaners.update({
+  dict: _clean_dict,
+  list: _clean_list,
+  tuple: _clean_list,
+  nanotime.nanotime: _clean_nanotime,
+})
+
+def _cleaner(cls):
+  '''Finds (and remembers) the cleaning function for instances of `cls`.'''
+  if issubclass(cls, dict):
+    cleaner = _clean_dict
+  elif issubclass(cls, (list, tuple)):
+    cleaner = _clean_list
+  elif issubclass(cls, (int, long, float, str, unicode, bool)):
+    cleaner = _clean_atomic
+  elif issubclass(cls, nanotime.nanotime):
+    cleaner = _clean_nanotime
+  elif issubclass(cls, datetime.datetime):
+    cleaner = _clean_atomic
+  else: # catch all... turn it into a string!
+    cleaner = str
+
+  _cleaners[cls] = cleaner
+  return cleaner
+
+
 def clean(value):
-  '''Cleans up a value for insertion into a SerialRepresentation'''
+  '''Cleans up a value for insertion into a SerialRepresentation.
 
+  Containers are always copied (into plain dicts and lists), so the result
+  never aliases `value`.
+  '''
+  try:
+    return _cleaners[type(value)](value)
+  except KeyError:
+    return _cleaner(type(value))(value)
+
+
+def _json_default(value):
+  if isinstance(value, datetime.datetime):
+    return {'__datetime__': value.isoformat()}
+  raise TypeError('%r is not JSON serializable' % value)
+
+def _from_json(value):
+  '''Restores the python types JSON loses: strs and datetimes.'''
   if isinstance(value, dict):
-    value = dict([(clean(k), clean(v)) for k, v in value.items()])
-  elif isinstance(value, list) or isinstance(value, tuple):
-    value = [clean(v) for v in value]
-  elif isinstance(value, int) or isinstance(value, long):
-    pass
-  elif isinstance(value, float):
-    pass
-  elif isinstance(value, str):
-    pass
-  elif isinstance(value, unicode):
-    pass
-  elif isinstance(value, bool):
-    pass
-  elif isinstance(value, nanotime.nanotime):
-    value = value.nanoseconds()
-  elif isinstance(value, datetime.datetime):
-    pass
-  elif value is None:
-    pass
-  else: # catch all... turn it into a string!
-    value = str(value)
+    if len(value) == 1 and '__datetime__' in value:
+      iso = value['__datetime__']
+      fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in iso else '%Y-%m-%dT%H:%M:%S'
+      return datetime.datetime.strptime(iso, fmt)
+    return dict([(_from_json(k), _from_json(v)) for k, v in value.iteritems()])
+  if isinstance(value, list):
+    return [_from_json(v) for v in value]
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
   return value
 
+def json_dumps(value):
+  '''Returns clean `value` as a JSON string.'''
+  return json.dumps(value, separators=(',', ':'), default=_json_default)
+
+def json_loads(string):
+  '''Returns the clean value of JSON `string`. Strings are decoded as (utf-8)
+  strs, as JSON does not distinguish them from unicode.'''
+  return _from_json(json.loads(string))
+
+
 
 class SerialRepresentation(object):
 
-  def __init__(self, data=None):
+  def __init__(self, data=None, trusted=False):
+    '''Initializes the representation with `data`.
+
+    If `trusted`, `data` is known to be clean already (e.g. it was read back
+    from our own datastore) and is used as is, without cleaning or copying.
+    '''
     # internal representation is a dict.
-    self._data = clean(data) if data else {}
+    if trusted:
+      self._data = data if data is not None else {}
+    else:
+      self._data = clean(data) if data else {}
     self._dirty = True
 
 
@@ -78,5 +156,8 @@ class SerialRepresentation(object):
     return str(self.json())
 
 
+  def json(self):
+    return json_dumps(self._data)
+
   def data(self):
     return self._data
@@ -0,0 +1,280 @@
+'''
+A write-ahead log in front of a (slow) datastore::
+
+    store = LogDatastore(FileSystemDatastore(root), '/var/repo/wal.log')
+    repo = Repo('/repo', store)
+
+Writes are appended to the log, and acknowledged once it is synced to disk.
+Writes from concurrent callers arriving while the log is being synced are
+grouped and synced together (group commit): a flush happens when
+`flushSize` records are waiting, or `flushInterval` seconds after the first
+one arrived. With `sync=False`, writes are acknowledged right away, and are
+durable after the next flush.
+
+Logged writes are applied to the child datastore in checkpoints, once the
+log grows past `checkpointSize` bytes (and when closing). Repeated writes of
+a key are applied once. Until then, they are kept in memory: get and contains
+see them. Queries are answered by the child datastore, so `query` checkpoints
+first when writes are pending: it costs the child writes, and truncating and
+syncing the log. Avoid mixing frequent queries with writes.
+
+On startup, the writes left in the log (e.g. after a crash) are replayed
+into the child datastore. A record torn by a crash while being written is
+ignored, as it was never acknowledged.
+'''
+
+import os
+import time
+import zlib
+import struct
+import threading
+import cPickle as pickle
+
+from datastore.core import Key
+from datastore.core.basic import ShimDatastore
+
+
+_HEADER = struct.Struct('>II') # record length, crc32
+_DELETED = object() # pending delete
+
+
+def encode_record(op, key, value=None):
+  '''Returns the log record of operation `op` ('put' or 'delete').'''
+  payload = pickle.dumps((op, str(key), value), pickle.HIGHEST_PROTOCOL)
+  return _HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def read_records(log):
+  '''Yields the (op, key, value) records of file `log`, up to the first
+  incomplete or corrupt one.'''
+  while True:
+    header = log.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+      return
+
+    length, crc = _HEADER.unpack(header)
+    payload = log.read(length)
+    if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+      return
+    op, key, value = pickle.loads(payload)
+    yield op, Key(key), value
+
+
+class LogDatastore(ShimDatastore):
+  '''Logs writes to the file at `path` before applying them to `datastore`.'''
+
+  def __init__(self, datastore, path, flushInterval=0.002, flushSize=1000,
+               checkpointSize=64 * 1024 * 1024, sync=True):
+    super(LogDatastore, self).__init__(datastore)
+    self.path = path
+    self.flushInterval = flushInterval
+    self.flushSize = flushSize
+    self.checkpointSize = checkpointSize
+    self.sync = sync
+
+    self._lock = threading.Lock()
+    self._changed = threading.Condition(self._lock)
+    self._flushLock = threading.Lock() # one flush or checkpoint at a time
+    self._buffer = [] # (sequence, key, value, record) not written to the log
+    self._pending = {} # key -> (sequence, value or _DELETED), not applied
+    self._logged = {} # key -> (sequence, value) of the last write in the log
+    self._sequence = 0 # of the last write
+    self._durable = 0 # sequence of the last write synced to the log
+    self._error = None
+    self._closed = False
+    self.flushes = 0 # log syncs so far
+
+    self.replayed = self._replay()
+    self._log = open(path, 'ab')
+    self._logSize = self._log.tell()
+
+    self._flusher = threading.Thread(target=self._flushLoop)
+    self._flusher.daemon = True
+    self._flusher.start()
+
+  def _replay(self):
+    '''Applies the records of an existing log. Returns how many there were.'''
+    if not os.path.exists(self.path):
+      return 0
+
+    count = 0
+    with open(self.path, 'rb') as log:
+      for op, key, value in read_records(log):
+        if op == 'put':
+          self.child_datastore.put(key, value)
+        else:
+          self.child_datastore.delete(key)
+        count += 1
+
+    # everything is applied now. start afresh.
+    with open(self.path, 'wb') as log:
+      os.fsync(log.fileno())
+    return count
+
+  # writes
+
+  def _append(self, records):
+    '''Appends (key, value) `records` to the log. Waits until they are
+    durable, if `sync`.'''
+    with self._lock:
+      if self._closed:
+        raise ValueError('%s is closed' % self)
+
+      for key, value in records:
+        self._sequence += 1
+        if value is _DELETED:
+          record = encode_record('delete', key)
+        else:
+          record = encode_record('put', key, value)
+        self._buffer.append((self._sequence, key, value, record))
+        self._pending[key] = (self._sequence, value)
+      self._changed.notify_all()
+
+      sequence = self._sequence
+      while self.sync and self._durable < sequence and self._error is None:
+        self._changed.wait()
+      if self._error is not None:
+        raise IOError('write-ahead log failed: %s' % self._error)
+
+  def put(self, key, value):
+    '''Logs the write of `value` under `key`.'''
+    self._append([(key, value)])
+
+  def put_many(self, items):
+    '''Logs the writes of (key, value) `items`, synced together.'''
+    self._append(list(items))
+
+  def delete(self, key):
+    '''Logs the removal of `key`.'''
+    self._append([(key, _DELETED)])
+
+  def delete_many(self, keys):
+    self._append([(key, _DELETED) for key in keys])
+
+  # reads
+
+  def get(self, key):
+    with self._lock:
+      pending = self._pending.get(key)
+    if pending is None:
+      return self.child_datastore.get(key)
+    return None if pending[1] is _DELETED else pending[1]
+
+  def contains(self, key):
+    with self._lock:
+      pending = self._pending.get(key)
+    if pending is None:
+      return self.child_datastore.contains(key)
+    return pending[1] is not _DELETED
+
+  def query(self, query):
+    '''Queries the child datastore, once the pending writes are applied.
+    Checkpoints if there are any (see the module docs for the cost).'''
+    with self._lock:
+      pending = bool(self._pending)
+    if pending:
+      self.checkpoint()
+    return self.child_datastore.query(query)
+
+  # flushing
+
+  def _flushLoop(self):
+    while True:
+      with self._lock:
+        while not self._buffer and not self._closed:
+          self._changed.wait()
+        if self._closed:
+          return
+
+        # give concurrent writers a chance to join this group.
+        deadline = time.time() + self.flushInterval
+        while len(self._buffer) < self.flushSize and not self._closed:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            break
+          self._changed.wait(remaining)
+
+      try:
+        self.flush()
+        if self._logSize >= self.checkpointSize:
+          self.checkpoint()
+      except Exception, e:
+        with self._lock:
+          self._error = e
+          self._changed.notify_all()
+        return
+
+  def flush(self):
+    '''Writes the buffered records to the log, and syncs it.'''
+    with self._flushLock:
+      self._flush()
+
+  def _flush(self):
+    with self._lock:
+      records, self._buffer = self._buffer, []
+      sequence = self._sequence
+    if not records:
+      return
+
+    data = ''.join(record for _, _, _, record in records)
+    self._log.write(data)
+    self._log.flush()
+    os.fsync(self._log.fileno())
+    self._logSize += len(data)
+    self.flushes += 1
+
+    with self._lock:
+      self._durable = sequence
+      for sequence, key, value, _ in records:
+        self._logged[key] = (sequence, value)
+      self._changed.notify_all()
+
+  def checkpoint(self):
+    '''Applies the logged writes to the child datastore, and empties the
+    log.'''
+    with self._flushLock:
+      self._flush()
+      # the last logged write of each key, even if a newer one (not logged
+      # yet) is pending: the log is truncated below.
+      with self._lock:
+        items, self._logged = self._logged.items(), {}
+
+      try:
+        for key, (sequence, value) in items:
+          if value is _DELETED:
+            self.child_datastore.delete(key)
+          else:
+            self.child_datastore.put(key, value)
+      except:
+        with self._lock:
+          self._logged.update(items)
+        raise
+
+      with self._lock:
+        for key, (sequence, value) in items:
+          if self._pending.get(key, (None,))[0] == sequence:
+            del self._pending[key]
+
+      # all the records in the log are applied.
+      self._log.truncate(0)
+      self._log.seek(0)
+      os.fsync(self._log.fileno())
+      self._logSize = 0
+
+  def close(self):
+    '''Applies all writes and closes the log.'''
+    if self._closed:
+      return
+    self.checkpoint()
+    with self._lock:
+      self._closed = True
+      self._changed.notify_all()
+    self._flusher.join()
+    self._log.close()
+
+  def __len__(self):
+    '''Returns the number of writes not yet applied to the child datastore.'''
+    return len(self._pending)
+
+  def __str__(self):
+    return '<%s %s>' % (self.__class__.__name__, self.path)
@@ -0,0 +1,135 @@
+import time
+import threading
+import unittest
+
+import datastore.core
+from dronestore import Key, Repo, Query
+from dronestore.asyncrepo import AsyncRepo, ThreadExecutor
+
+from test_merge import PersonM
+
+
+class SlowDatastore(datastore.DictDatastore):
+  '''DictDatastore that takes `delay` seconds per operation, recording the
+  most operations on one key in flight at once.'''
+
+  def __init__(self, delay=0.01):
+    super(SlowDatastore, self).__init__()
+    self.delay = delay
+    self.lock = threading.Lock()
+    self.active = {}
+    self.overlaps = 0
+
+  def _slow(self, key, op, *args):
+    name = str(key)
+    with self.lock:
+      self.active[name] = self.active.get(name, 0) + 1
+      self.overlaps = max(self.overlaps, self.active[name])
+    try:
+      time.sleep(self.delay)
+      return op(self, key, *args)
+    finally:
+      with self.lock:
+        self.active[name] -= 1
+
+  def get(self, key):
+    return self._slow(key, datastore.DictDatastore.get)
+
+  def put(self, key, value):
+    return self._slow(key, datastore.DictDatastore.put, value)
+
+
+def person(i, **attrs):
+  p = PersonM('person%d' % i)
+  for name, value in attrs.items():
+    setattr(p, name, value)
+  p.commit()
+  return p
+
+
+class TestAsyncRepo(unittest.TestCase):
+
+  def setUp(self):
+    self.store = SlowDatastore()
+    self.repo = Repo('/RepoA/', self.store)
+    self.arepo = AsyncRepo(self.repo, workers=8)
+
+  def tearDown(self):
+    self.arepo.shutdown()
+
+  def test_concurrent(self):
+    people = [person(i) for i in range(0, 8)]
+    for p in people:
+      self.repo.put(p)
+
+    start = time.time()
+    futures = [self.arepo.get(p.key) for p in people]
+    self.assertEqual([f.result() for f in futures], people)
+    self.assertTrue(time.time() - start < 4 * self.store.delay)
+
+  def test_per_key(self):
+    base = person(0, first='first')
+    self.repo.put(base)
+
+    # concurrent merges of one key: one at a time, none lost.
+    versions = []
+    for i in range(0, 10):
+      p = PersonM(base.version)
+      p.age = i
+      p.commit()
+      versions.append(p)
+
+    futures = [self.arepo.merge(p) for p in versions]
+    get = self.arepo.get(base.key) # sees the merges submitted before.
+    for future in futures:
+      future.result()
+    self.assertEqual(get.result().age, 9)
+    self.assertEqual(self.store.overlaps, 1)
+
+  def test_errors(self):
+    future = self.arepo.get('/not/a/key')
+    self.assertRaises(ValueError, future.result)
+    self.assertTrue(isinstance(future.exception(), ValueError))
+
+    # later operations on the key are not affected.
+    self.assertEqual(self.arepo.get(Key('/PersonM:person0')).result(), None)
+
+  def test_query(self):
+    for i in range(0, 25):
+      self.repo.put(person(i, age=i))
+
+    query = Query(PersonM).filter('age', '<', 10)
+    results = self.arepo.query(query).result()
+    self.assertEqual(sorted([p.age for p in results]), range(0, 10))
+
+    cursor = self.arepo.iterate(Query(PersonM), batchSize=10)
+    batches = [cursor.next().result() for i in range(0, 4)]
+    self.assertEqual(map(len, batches), [10, 10, 5, 0])
+
+    ages = [p.age for p in self.arepo.iterate(Query(PersonM), batchSize=7)]
+    self.assertEqual(sorted(ages), range(0, 25))
+
+  def test_max_pending(self):
+    executor = ThreadExecutor(4)
+    arepo = AsyncRepo(self.repo, executor, maxPending=2)
+
+    running = [0]
+    most = [0]
+    lock = threading.Lock()
+    def op():
+      with lock:
+        running[0] += 1
+        most[0] = max(most[0], running[0])
+      time.sleep(0.01)
+      with lock:
+        running[0] -= 1
+
+    futures = [arepo._submit(['k%d' % i], op) for i in range(0, 10)]
+    for future in futures:
+      future.result()
+    self.assertEqual(most[0], 2)
+    executor.shutdown()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -206,5 +206,76 @@ class AttributeTests(unittest.TestCase):
     test({1213:3214}, {'1213':'3214'})
     test(None)
 
+  def test_tracked(self):
+
+    class Tracked(Model):
+      tags = ListAttribute(default=[], strategy=merge.LatestStrategy)
+      meta = DictAttribute(default={}, value_type=list)
+
+    def assertChanged(instance, fn):
+      instance.commit()
+      self.assertFalse(instance.isDirty())
+      version = instance.version
+      fn()
+      self.assertTrue(instance.isDirty())
+      instance.commit()
+      self.assertNotEqual(instance.version, version)
+      self.assertEqual(instance.version.hash, instance.computedHash())
+
+    t = Tracked('a')
+    t.commit()
+    self.assertTrue(isinstance(t.tags, TrackedList))
+    self.assertTrue(t.tags is t.tags)
+
+    # defaults and assigned values are copied, not shared.
+    tags = ['a']
+    t.tags = tags
+    self.assertFalse(t.tags is tags)
+    self.assertFalse(Tracked('b').tags is Tracked('c').tags)
+
+    assertChanged(t, lambda: t.tags.append('b'))
+    assertChanged(t, lambda: t.tags.extend(['c', 'd']))
+    assertChanged(t, lambda: t.tags.insert(0, 'e'))
+    assertChanged(t, lambda: t.tags.remove('e'))
+    assertChanged(t, lambda: t.tags.pop())
+    assertChanged(t, lambda: t.tags.reverse())
+    assertChanged(t, lambda: t.tags.sort())
+    assertChanged(t, lambda: t.tags.__setitem__(0, 'f'))
+    assertChanged(t, lambda: t.tags.__delitem__(0))
+    assertChanged(t, lambda: t.tags.__setslice__(0, 0, ['g', 'h']))
+    assertChanged(t, lambda: t.tags.__delslice__(0, 1))
+    assertChanged(t, lambda: t.tags.__iadd__(['i']))
+    self.assertEqual(t.tags, ['h', 'b', 'c', 'i'])
+    self.assertEqual(t.version.attributeValue('tags'), ['h', 'b', 'c', 'i'])
+
+    assertChanged(t, lambda: t.meta.__setitem__('a', ['1']))
+    assertChanged(t, lambda: t.meta['a'].append('2'))
+    assertChanged(t, lambda: t.meta.update(b=['3']))
+    assertChanged(t, lambda: t.meta['b'].pop())
+    assertChanged(t, lambda: t.meta.setdefault('c', []))
+    assertChanged(t, lambda: t.meta.pop('c'))
+    assertChanged(t, lambda: t.meta.__delitem__('b'))
+    assertChanged(t, lambda: t.meta.clear())
+
+    # in-place changes update the merge strategy state.
+    updated = t.version.attribute('tags')['updated']
+    assertChanged(t, lambda: t.tags.append('j'))
+    self.assertTrue(t.version.attribute('tags')['updated'] > updated)
+
+    # versions hold plain copies, unaffected by later changes.
+    version = t.version
+    self.assertEqual(type(version.attributeValue('tags')), list)
+    t.tags.append('k')
+    self.assertEqual(version.attributeValue('tags'), ['h', 'b', 'c', 'i', 'j'])
+
+    # reloaded instances are clean, and track their own copies.
+    t.commit()
+    t2 = Tracked(t.version)
+    self.assertFalse(t2.isDirty())
+    self.assertEqual(t2.computedHash(), t.version.hash)
+    assertChanged(t2, lambda: t2.tags.append('l'))
+    self.assertEqual(t.tags, ['h', 'b', 'c', 'i', 'j', 'k'])
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,163 @@
+import random
+import unittest
+
+from dronestore import Model
+from dronestore.attribute import StringAttribute, IntegerAttribute, \
+  FloatAttribute
+from dronestore.merge import LatestStrategy, MaxStrategy, MergeStrategy
+from dronestore import batch
+
+
+class Account(Model):
+  name = StringAttribute()
+  owner = StringAttribute(strategy=LatestStrategy)
+  city = StringAttribute(strategy=LatestStrategy)
+  balance = IntegerAttribute(default=0, strategy=MaxStrategy)
+
+
+class NumberAttribute(FloatAttribute):
+  data_type = (int, long, float) # kept as given.
+
+class Score(Model):
+  score = NumberAttribute(strategy=MaxStrategy)
+
+
+class FirstStrategy(MergeStrategy):
+  def merge(self, local_version, remote_version):
+    return None # always keep local.
+
+class Ledger(Model):
+  name = StringAttribute()
+  entry = StringAttribute(strategy=FirstStrategy)
+
+
+def change(instance, rand):
+  for attr in ['name', 'owner', 'city']:
+    if rand.random() < 0.4:
+      setattr(instance, attr, rand.choice(['herp', 'derp', 'lerp']))
+  if rand.random() < 0.4:
+    instance.balance = rand.randint(0, 100)
+  instance.commit()
+
+
+def pairs(count, seed=0):
+  rand = random.Random(seed)
+  locals, remotes = [], []
+  for i in xrange(0, count):
+    base = Account('A%d' % i)
+    base.name = 'name'
+    base.owner = 'owner'
+    base.balance = 50
+    base.commit()
+
+    first, second = Account(base.version), Account(base.version)
+    change(first, rand)
+    change(second, rand)
+    if rand.random() < 0.5:
+      first, second = second, first # remote newer, or older.
+    locals.append(first.version)
+    remotes.append(second.version)
+
+  # some identical, some unrelated pairs.
+  remotes[0] = locals[0]
+  remotes[1] = Account('A1').version
+  return locals, remotes
+
+
+def expected(model, locals, remotes):
+  results = []
+  for local, remote in zip(locals, remotes):
+    instance = model(local)
+    instance.merge(remote)
+    results.append(instance.version.hash)
+  return results
+
+
+class TestBatch(unittest.TestCase):
+
+  def assertMerged(self, model, locals, remotes):
+    merged = batch.merge_batch(model, locals, remotes)
+    self.assertEqual(len(merged), len(locals))
+    for result, local, hash in \
+        zip(merged, locals, expected(model, locals, remotes)):
+      if result is None:
+        self.assertEqual(local.hash, hash)
+      else:
+        self.assertNotEqual(local.hash, hash)
+        self.assertEqual(result.version.hash, hash)
+        self.assertEqual(result.version.parent, local.hash)
+        self.assertFalse(result.isDirty())
+    return merged
+
+  def test_vectorized(self):
+    self.assertTrue(batch.vectorizable(Account))
+    self.assertFalse(batch.vectorizable(Ledger))
+
+    locals, remotes = pairs(300)
+    merged = self.assertMerged(Account, locals, remotes)
+    self.assertEqual(merged[0], None)
+    self.assertTrue(0 < len(filter(None, merged)) < len(merged))
+
+    # instances work too.
+    instances = [Account(v) for v in locals]
+    merged2 = batch.merge_batch(Account, instances, remotes)
+    self.assertEqual([m and m.version.hash for m in merged], \
+      [m and m.version.hash for m in merged2])
+
+  def test_mixed_values(self):
+    # ints and floats (beyond float precision), missing and negative values.
+    values = [(float(2 ** 53), 2 ** 53 + 1), (2 ** 53 + 1, float(2 ** 53)), \
+      (None, -5), (-5, None), (-3, -5), (-5, -3), (1.5, 2), (3, 2.5), \
+      (2 ** 64, 2 ** 64 + 1)]
+    locals, remotes = [], []
+    for i, (local, remote) in enumerate(values):
+      for value, versions in [(local, locals), (remote, remotes)]:
+        s = Score('S%d' % i)
+        s.score = value
+        s.commit()
+        versions.append(s.version)
+
+    # each pair alone (homogeneous columns), then all together.
+    for i in range(0, len(values)):
+      self.assertMerged(Score, locals[i:i + 1], remotes[i:i + 1])
+    merged = self.assertMerged(Score, locals, remotes)
+    self.assertEqual([m and m.score for m in merged], \
+      [2 ** 53 + 1, None, -5, None, None, -3, 2, None, 2 ** 64 + 1])
+
+    numpy, batch.numpy = batch.numpy, None
+    try:
+      fallback = batch.merge_batch(Score, locals, remotes)
+    finally:
+      batch.numpy = numpy
+    self.assertEqual([m and m.version.hash for m in merged], \
+      [m and m.version.hash for m in fallback])
+
+  def test_fallback(self):
+    locals, remotes = pairs(50, seed=1)
+    numpy, batch.numpy = batch.numpy, None
+    try:
+      self.assertFalse(batch.vectorizable(Account))
+      self.assertMerged(Account, locals, remotes)
+    finally:
+      batch.numpy = numpy
+
+    a, b = Ledger('A'), Ledger('A')
+    a.entry = 'a'
+    a.commit()
+    b.name = 'b'
+    b.entry = 'b'
+    b.commit()
+    merged = self.assertMerged(Ledger, [a.version], [b.version])
+    self.assertEqual(merged[0].entry, 'a')
+    self.assertEqual(merged[0].name, 'b')
+
+  def test_errors(self):
+    locals, remotes = pairs(3)
+    self.assertRaises(ValueError, batch.merge_batch, Account, locals, \
+      remotes[:2])
+    self.assertRaises(ValueError, batch.merge_batch, Account, \
+      [Account('B').version], remotes[:1])
+
+
+if __name__ == '__main__':
+  unittest.main()
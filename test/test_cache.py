@@ -0,0 +1,159 @@
+
+import time
+import unittest
+
+import datastore.core
+from dronestore import Key, Repo, VersionCache, BinaryCodec
+from dronestore.cache import data_size, _LRUDict
+
+from test_merge import PersonM
+
+
+class CountingDatastore(datastore.DictDatastore):
+  '''DictDatastore that counts gets.'''
+
+  def __init__(self):
+    super(CountingDatastore, self).__init__()
+    self.gets = 0
+
+  def get(self, key):
+    self.gets += 1
+    return super(CountingDatastore, self).get(key)
+
+
+def person(name, age=30):
+  p = PersonM(name)
+  p.first = 'first' + name
+  p.age = age
+  p.commit()
+  return p
+
+
+class TestCache(unittest.TestCase):
+
+  def subtest_cache(self, codec):
+    store = datastore.DictDatastore()
+    cache = VersionCache(size=5)
+    repo = Repo('/RepoA/', store, codec=codec, cache=cache)
+
+    p = person('A')
+    repo.put(p)
+    a1 = repo.get(p.key)
+    a2 = repo.get(p.key)
+    self.assertEqual(a1, p)
+    self.assertEqual(a2, p)
+    self.assertFalse(a1 is a2) # versions are cached, instances are not.
+    stats = cache.stats()
+    self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    # writes through the repo invalidate.
+    a1.age = 40
+    a1.commit()
+    repo.merge(a1)
+    self.assertEqual(cache.stats()['invalidations'], 1)
+    self.assertEqual(repo.get(p.key).age, 40)
+    self.assertEqual(repo.get_many([p.key])[0].age, 40)
+
+    # writes behind the repo's back are caught by validation.
+    other = Repo('/RepoB/', store, codec=codec)
+    a1.age = 50
+    a1.commit()
+    other.merge(a1)
+    self.assertEqual(repo.get(p.key).age, 50)
+
+    repo.delete(p.key)
+    self.assertEqual(repo.get(p.key), None)
+    self.assertEqual(len(cache), 0)
+
+    # lru eviction.
+    people = [person('P%d' % i) for i in range(0, 8)]
+    repo.put_many(people)
+    repo.get_many([q.key for q in people])
+    self.assertEqual(len(cache), 5)
+    self.assertEqual(cache.stats()['evictions'], 3)
+    hits = cache.stats()['hits']
+    repo.get(people[7].key)
+    repo.get(people[0].key)
+    self.assertEqual(cache.stats()['hits'], hits + 1)
+
+  def test_cache(self):
+    self.subtest_cache(None)
+    self.subtest_cache(BinaryCodec())
+
+  def test_bounds(self):
+    people = [person('P%d' % i) for i in range(0, 5)]
+    size = data_size(people[0].version.data())
+
+    cache = VersionCache(maxbytes=size * 3)
+    repo = Repo('/RepoA/', datastore.DictDatastore(), cache=cache)
+    repo.put_many(people)
+    repo.get_many([q.key for q in people])
+    self.assertEqual(len(cache), 3)
+    self.assertTrue(cache.stats()['bytes'] <= size * 3)
+
+    p = person('A')
+    cache = VersionCache(ttl=0.01)
+    repo = Repo('/RepoA/', datastore.DictDatastore(), cache=cache)
+    repo.put(p)
+    repo.get(p.key)
+    repo.get(p.key)
+    time.sleep(0.02)
+    repo.get(p.key)
+    stats = cache.stats()
+    self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+    self.assertEqual(stats['expirations'], 1)
+
+    self.assertRaises(ValueError, VersionCache, mode='bogus')
+
+  def test_lru_dict(self):
+    d = _LRUDict()
+    for key in 'abcd':
+      d[key] = key.upper()
+    d['b'] = 'B2' # keeps its place.
+    d['a'] = d.pop('a') # most recent.
+    self.assertEqual(len(d), 4)
+    self.assertTrue('c' in d)
+    self.assertEqual(d.pop('missing'), None)
+    self.assertEqual(d.popitem(last=False), ('b', 'B2'))
+    self.assertEqual(d.popitem(), ('a', 'A'))
+    self.assertEqual([d.popitem(last=False) for i in range(0, 2)], \
+      [('c', 'C'), ('d', 'D')])
+    self.assertRaises(KeyError, d.popitem)
+    d['e'] = 'E'
+    d.clear()
+    self.assertEqual(len(d), 0)
+
+  def test_model_mode(self):
+    store = CountingDatastore()
+    cache = VersionCache(mode='model')
+    repo = Repo('/RepoA/', store, cache=cache)
+
+    p = person('A')
+    repo.put(p)
+    a1 = repo.get(p.key)
+    self.assertTrue(repo.get(p.key) is a1) # shared
+
+    # changed instances are not handed out again.
+    a1.age = 31
+    a2 = repo.get(p.key)
+    self.assertFalse(a2 is a1)
+    self.assertEqual(a2.age, 30)
+    self.assertEqual(cache.stats()['stale'], 1)
+
+    # merging does not touch the shared instance.
+    a1.commit()
+    repo.merge(a1)
+    self.assertEqual(a2.age, 30)
+    self.assertEqual(repo.get(p.key).age, 31)
+
+    # without validation, hits do not read the datastore.
+    cache = VersionCache(validate=False)
+    repo = Repo('/RepoA/', store, cache=cache)
+    repo.get(p.key)
+    store.gets = 0
+    self.assertEqual(repo.get(p.key).age, 31)
+    self.assertEqual(store.gets, 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
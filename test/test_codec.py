@@ -0,0 +1,117 @@
+import datetime
+import unittest
+
+import datastore.core
+from dronestore import Key, Version, Repo, Query
+from dronestore.codec import *
+from dronestore.util import serial
+
+from .util import RandomGen
+from test_merge import PersonM
+
+
+class CodecTests(unittest.TestCase):
+
+  def person(self, name='A', last='Derp'):
+    p = PersonM(name)
+    p.first = 'Herp'
+    p.last = last
+    p.age = 30
+    p.commit()
+    return p
+
+  def subtest_codec(self, codec, exact=True):
+    p = self.person(last=u'D\xe9rp' if exact else 'Derp')
+    data = p.version.data()
+
+    blob = codec.encode(data)
+    self.assertTrue(isinstance(blob, str))
+    self.assertEqual(codec.decode(blob), data)
+
+    header = codec.decode_header(blob)
+    self.assertFalse('attributes' in header)
+    for field in ['key', 'hash', 'parent', 'created', 'committed', 'type']:
+      self.assertEqual(header[field], data[field])
+
+    version = codec.version(blob)
+    self.assertEqual(version, p.version)
+    self.assertEqual(version.data(), data)
+    self.assertEqual(PersonM(version), p)
+    if exact:
+      self.assertEqual(PersonM(version).computedHash(), p.version.hash)
+
+    for i in range(0, 10):
+      value = RandomGen.randomDict()
+      data['attributes']['first'] = {'value': value}
+      self.assertEqual(codec.decode(codec.encode(data)), data)
+
+  def test_json(self):
+    self.subtest_codec(JSONCodec(), exact=False)
+    sr = serial.SerialRepresentation({'a': [1, 'b']})
+    self.assertEqual(str(sr), '{"a":[1,"b"]}')
+
+    dt = datetime.datetime(2011, 7, 12, 13, 19, 29, 151455)
+    self.assertEqual(serial.json_loads(serial.json_dumps([dt])), [dt])
+
+  def test_bson(self):
+    self.subtest_codec(BSONCodec(), exact=False)
+
+  def test_binary(self):
+    codec = BinaryCodec()
+    self.subtest_codec(codec)
+
+    # values round trip with their exact types.
+    values = [None, True, False, 0, -1, 2 ** 63 - 1, -2 ** 63, 2 ** 80, 5L, \
+      1.5, 'str', u'\xfcnicode', datetime.datetime(2011, 7, 12, 13, 19, 29, 5),
+      [], {}, [1, [2, {'a': [None]}]], {'a': {'b': u'c'}}]
+    for value in values:
+      decoded = decode_value(encode_value(value))
+      self.assertEqual(decoded, value)
+      self.assertEqual(repr(decoded), repr(value))
+    self.assertEqual(decode_value(encode_value((1, 2))), [1, 2])
+
+    # hashes and times are fixed width.
+    p = self.person()
+    data = p.version.data()
+    data['attributes'] = {}
+    blob = codec.encode(data)
+    self.assertEqual(len(blob), 4 + 20 + 20 + 8 + 8 + 4 + 10 + 2 + 7 + 4)
+
+    # attributes are only decoded when accessed.
+    blob = codec.encode(self.person().version.data())
+    version = codec.version(blob)
+    self.assertEqual(version._decoded, None)
+    self.assertEqual(version.attributeValue('first'), 'Herp')
+    self.assertEqual(version._decoded.keys(), ['first'])
+
+    data['hash'] = 'a'
+    self.assertRaises(CodecError, codec.encode, data)
+    self.assertRaises(CodecError, codec.decode, 'nope')
+
+  def test_repo(self):
+    for codec in [JSONCodec(), BSONCodec(), BinaryCodec()]:
+      store = datastore.core.DictDatastore()
+      repo = Repo('/repo', store, codec=codec)
+
+      a = self.person('A')
+      b = self.person('B')
+      repo.put(a)
+      repo.put_many([b])
+      self.assertTrue(isinstance(store.get(a.key), str))
+      self.assertEqual(repo.get(a.key), a)
+      self.assertEqual(repo.get_many([a.key, b.key]), [a, b])
+
+      a2 = PersonM(a.version)
+      a2.first = 'Derp'
+      a2.commit()
+      self.assertEqual(repo.merge(a2).first, 'Derp')
+      self.assertEqual(repo.get(a.key).first, 'Derp')
+
+      results = list(repo.query(Query(PersonM).filter('first', '=', 'Derp')))
+      self.assertEqual(results, [repo.get(a.key)])
+      results = list(repo.query(Query(PersonM).order('-key')))
+      self.assertEqual([r.key for r in results], [b.key, a.key])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,115 @@
+
+import unittest
+
+import datastore.core
+from dronestore import Key, Model, Repo, BinaryCodec
+from dronestore.attribute import StringAttribute, TextAttribute, DictAttribute
+from dronestore.merge import LatestStrategy
+from dronestore.delta import DeltaError, digests, make_delta, delta_from, \
+  apply_delta
+from dronestore.sync import SyncEndpoint, LocalTransport, sync
+
+
+class Document(Model):
+  title = StringAttribute(strategy=LatestStrategy)
+  body = TextAttribute(strategy=LatestStrategy)
+  meta = DictAttribute(default={}, strategy=LatestStrategy)
+
+
+def document(i):
+  d = Document('doc%d' % i)
+  d.title = 'title%d' % i
+  d.body = 'lorem ipsum %d ' % i * 500
+  d.meta = {'tags': 'a,b,c', 'index': str(i)}
+  d.commit()
+  return d
+
+
+class TestDelta(unittest.TestCase):
+
+  def test_delta(self):
+    d = document(1)
+    v1 = d.version
+    d.title = 'changed'
+    d.commit()
+    v2 = d.version
+
+    delta = delta_from(v2, v1)
+    self.assertEqual(delta['base'], v1.hash)
+    self.assertEqual(delta['changed'].keys(), ['title'])
+    self.assertEqual(delta['digests'], digests(v2))
+    self.assertEqual(apply_delta(delta, v1).data(), v2.data())
+
+    # wrong or missing base.
+    self.assertRaises(DeltaError, apply_delta, delta)
+    self.assertRaises(DeltaError, apply_delta, delta, v2)
+    other = document(1)
+    other.body = 'other'
+    other.commit()
+    forged = make_delta(v2, other.version.hash, digests(v1))
+    self.assertRaises(DeltaError, apply_delta, forged, other.version)
+
+    # full deltas need no base.
+    full = make_delta(v2)
+    self.assertEqual(full['base'], None)
+    self.assertEqual(sorted(full['changed']), ['body', 'meta', 'title'])
+    self.assertEqual(apply_delta(full).data(), v2.data())
+
+  def test_merge_deltas(self):
+    repo = Repo('/RepoA/', datastore.DictDatastore())
+    d = document(1)
+    v1 = d.version
+    repo.put(d)
+
+    d.title = 'changed'
+    d.commit()
+    self.assertEqual(repo.merge_deltas([delta_from(d.version, v1)]), [])
+    self.assertEqual(repo.get(d.key).title, 'changed')
+
+    # the base is no longer current: needs a full transfer.
+    d.meta['tags'] = 'd'
+    d.commit()
+    self.assertEqual(repo.merge_deltas([delta_from(d.version, v1)]), \
+      [str(d.key)])
+    self.assertEqual(repo.merge_deltas([make_delta(d.version)]), [])
+    self.assertEqual(repo.get(d.key), d)
+
+    # new keys.
+    e = document(2)
+    self.assertEqual(repo.merge_deltas([make_delta(e.version)]), [])
+    self.assertEqual(repo.get(e.key), e)
+
+  def subtest_sync(self, deltas, codec=None):
+    local = Repo('/RepoA/', datastore.DictDatastore(), codec=codec)
+    remote = Repo('/RepoB/', datastore.DictDatastore(), codec=codec)
+    transport = LocalTransport(SyncEndpoint(remote))
+
+    docs = [document(i) for i in range(0, 50)]
+    local.put_many(docs)
+    remote.put_many(docs)
+    for d in docs[:10]:
+      d.title = 'local'
+      d.commit()
+      local.put(d)
+    for d in docs[5:15]:
+      d = remote.get(d.key)
+      d.meta['tags'] = 'remote'
+      d.commit()
+      remote.put(d)
+
+    transport.bytes = 0
+    self.assertEqual(sync(local, transport, [Document], deltas=deltas), 15)
+    for d in docs[:15]:
+      self.assertEqual(local.get(d.key), remote.get(d.key))
+    self.assertEqual(local.get(docs[7].key).title, 'local')
+    self.assertEqual(local.get(docs[7].key).meta['tags'], 'remote')
+    return transport.bytes
+
+  def test_sync(self):
+    full = self.subtest_sync(False)
+    self.assertTrue(self.subtest_sync(True) * 4 < full)
+    self.subtest_sync(True, BinaryCodec())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,117 @@
+
+import unittest
+
+import datastore.core
+from dronestore import Key, Repo, HistoryStore, Model, StringAttribute
+from dronestore.merge import LatestObjectStrategy
+from dronestore.history import address
+from datastore.core.query import Query as DatastoreQuery
+
+from test_delta import Document, document
+
+
+class Note(Model):
+  text = StringAttribute(strategy=LatestObjectStrategy)
+  tag = StringAttribute(strategy=LatestObjectStrategy)
+
+
+def count(store, path):
+  return len(list(store.query(DatastoreQuery(Key(path)))))
+
+
+class TestHistory(unittest.TestCase):
+
+  def test_history(self):
+    hstore = datastore.DictDatastore()
+    history = HistoryStore(hstore)
+    repo = Repo('/RepoA/', datastore.DictDatastore(), history=history)
+
+    d = document(1)
+    repo.put(d)
+    versions = [d.version]
+    for i in range(0, 10):
+      d.title = 'title%d' % i
+      d.commit()
+      repo.put(d)
+      versions.append(d.version)
+
+    # 11 versions, but body and meta are stored once.
+    self.assertEqual(count(hstore, '/history/version'), 11)
+    self.assertEqual(count(hstore, '/history/payload'), 11 + 2)
+    self.assertEqual(history.put(d.version), False)
+
+    walked = list(repo.history(d.key))
+    self.assertEqual([v.hash for v in walked], \
+      [v.hash for v in reversed(versions)])
+    self.assertEqual(walked[0].data(), d.version.data())
+    self.assertEqual(walked[-1].data(), versions[0].data())
+    self.assertEqual(len(list(repo.history(d.key, limit=3))), 3)
+    self.assertEqual(list(repo.history(Key('/Document:none'))), [])
+    self.assertEqual(history.get('bogus'), None)
+    self.assertTrue(history.contains(versions[3].hash))
+
+    # reverting to an earlier version.
+    repo.put(versions[2])
+    self.assertEqual(len(list(repo.history(d.key))), 3)
+
+    # collect what is no longer reachable from the current version.
+    self.assertEqual(repo.collectHistory(['/Document']), (8, 8))
+    self.assertEqual(repo.collectHistory(['/Document']), (0, 0))
+    self.assertEqual(count(hstore, '/history/version'), 3)
+    self.assertEqual(history.get(versions[2].hash).data(), \
+      versions[2].data())
+
+    repo.delete(d.key)
+    self.assertEqual(history.gc([]), (3, 5))
+    self.assertEqual(count(hstore, '/history/payload'), 0)
+
+    self.assertRaises(ValueError, Repo('/RepoB/', hstore).history, d.key)
+
+  def test_revert(self):
+    history = HistoryStore(datastore.DictDatastore())
+    repo = Repo('/RepoA/', datastore.DictDatastore(), history=history)
+
+    # A -> B -> A again (same contents, so same hash).
+    n = Note('n')
+    n.text, n.tag = 'a', 'x'
+    n.commit()
+    repo.put(n)
+    a = n.version
+    n.text = 'b'
+    n.commit()
+    repo.put(n)
+    b = n.version
+    n.text = 'a'
+    n.commit()
+    repo.put(n)
+    self.assertEqual(n.version.hash, a.hash)
+    self.assertEqual(n.version.parent, b.hash)
+
+    walked = list(repo.history(n.key))
+    self.assertEqual([v.hash for v in walked], [a.hash, b.hash, a.hash])
+    self.assertEqual([v.parent for v in walked], \
+      [b.hash, a.hash, a.parent])
+    self.assertEqual(history.get(a.hash).parent, a.parent)
+
+    # a remote edit of B merges against B, not against the first A.
+    r = Note(b)
+    r.tag = 'y'
+    r.commit()
+    self.assertEqual(history.ancestor(n.version, r.version).hash, b.hash)
+    merged = repo.merge(r)
+    self.assertEqual([merged.text, merged.tag], ['a', 'y'])
+
+    # only the remote version is unreachable: A, B and A again are kept.
+    self.assertEqual(repo.collectHistory(['/Note']), (1, 0))
+    self.assertEqual([v.hash for v in repo.history(n.key)], \
+      [merged.version.hash, a.hash, b.hash, a.hash])
+
+  def test_address(self):
+    self.assertEqual(address({'a': 1, 'b': [1, 2]}), \
+      address(dict([('b', [1, 2]), ('a', 1)])))
+    self.assertNotEqual(address({'a': 1}), address({'a': 1.0}))
+    self.assertNotEqual(address({'a': 'x'}), address({'a': u'x'}))
+
+
+if __name__ == '__main__':
+  unittest.main()
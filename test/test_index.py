@@ -0,0 +1,172 @@
+
+import random
+import unittest
+
+import datastore.core
+from dronestore import Model, Repo, Query
+from dronestore.attribute import StringAttribute, IntegerAttribute
+from dronestore.index import AttributeIndex, IndexSet
+
+
+class IndexedPerson(Model):
+  name = StringAttribute(indexed=True)
+  age = IntegerAttribute(indexed=True, default=0)
+  city = StringAttribute()
+
+
+class ScanCountingDatastore(datastore.DictDatastore):
+  '''DictDatastore that counts the queries (collection scans) it answers.'''
+
+  def __init__(self):
+    super(ScanCountingDatastore, self).__init__()
+    self.scans = 0
+
+  def query(self, query):
+    self.scans += 1
+    return super(ScanCountingDatastore, self).query(query)
+
+
+def person(i, age, city='nyc'):
+  p = IndexedPerson('person%d' % i)
+  p.name = 'name%d' % (i % 7)
+  p.age = age
+  p.city = city
+  p.commit()
+  return p
+
+
+class TestIndex(unittest.TestCase):
+
+  def test_attribute_index(self):
+    index = AttributeIndex('age')
+    for i, value in enumerate([5, 3, 9, 3, 7]):
+      index.insert('/k%d' % i, value)
+
+    self.assertEqual(len(index), 5)
+    self.assertEqual(index.keys(), ['/k1', '/k3', '/k0', '/k4', '/k2'])
+    self.assertEqual(index.keys('=', 3), ['/k1', '/k3'])
+    self.assertEqual(index.keys('<', 5), ['/k1', '/k3'])
+    self.assertEqual(index.keys('<=', 5), ['/k1', '/k3', '/k0'])
+    self.assertEqual(index.keys('>', 7), ['/k2'])
+    self.assertEqual(index.keys('>=', 7), ['/k4', '/k2'])
+    self.assertRaises(ValueError, index.keys, '!=', 7)
+
+    index.insert('/k1', 8) # moves
+    self.assertEqual(index.keys('=', 3), ['/k3'])
+    index.remove('/k3')
+    index.remove('/k3')
+    self.assertEqual(index.keys(), ['/k0', '/k4', '/k1', '/k2'])
+    self.assertFalse('/k3' in index)
+
+    self.assertTrue(index.compatible(4))
+    self.assertFalse(index.compatible('4'))
+    self.assertFalse(index.compatible(4.0))
+
+  def subtest_queries(self, repo, scanned):
+    store = repo._store
+
+    def check(query):
+      store.scans = 0
+      results = list(repo.query(query))
+      self.assertEqual(store.scans, 0)
+
+      expected = list(scanned.query(query))
+      if query.orders:
+        # ties may come in any order; compare the ordered values.
+        field = query.orders[0].field
+        self.assertEqual([getattr(p, field) for p in results], \
+          [getattr(p, field) for p in expected])
+      else:
+        results.sort(key=lambda p: p.key)
+        expected.sort(key=lambda p: p.key)
+        self.assertEqual(results, expected)
+      return results
+
+    for age in [0, 10, 33, 99, 100]:
+      check(Query(IndexedPerson).filter('age', '=', age))
+      check(Query(IndexedPerson).filter('age', '<', age))
+      check(Query(IndexedPerson).filter('age', '>=', age).order('-age'))
+      check(Query(IndexedPerson).filter('age', '>', age).order('name'))
+      check(Query(IndexedPerson, limit=5, offset=2).filter('age', '<=', age) \
+        .order('age'))
+
+    for name in ['name0', 'name3', 'name9']:
+      check(Query(IndexedPerson).filter('name', '=', name))
+      check(Query(IndexedPerson).filter('name', '=', name) \
+        .filter('age', '>', 50).filter('city', '=', 'sf'))
+
+    check(Query(IndexedPerson).order('-age'))
+    check(Query(IndexedPerson, limit=3).order('name'))
+
+    # unindexed queries still work (scanning).
+    query = Query(IndexedPerson).filter('city', '=', 'sf').order('city')
+    self.assertEqual(len(list(repo.query(query))), \
+      len(list(scanned.query(query))))
+    self.assertEqual(store.scans, 1)
+
+  def test_queries(self):
+    repo = Repo('/RepoA/', ScanCountingDatastore())
+    scanned = Repo('/RepoB/', datastore.DictDatastore())
+
+    people = [person(i, random.randint(0, 100), random.choice(['nyc', 'sf'])) \
+      for i in range(0, 200)]
+    repo.put_many(people[:100])
+    scanned.put_many(people[:100])
+
+    # first query builds the indexes from the datastore.
+    list(repo.query(Query(IndexedPerson).filter('age', '=', 3)))
+    self.assertTrue(repo._indexes.isBuilt(IndexedPerson.key))
+
+    # then writes maintain them.
+    for p in people[100:150]:
+      repo.put(p)
+      scanned.put(p)
+    repo.put_many(people[150:])
+    scanned.put_many(people[150:])
+    self.subtest_queries(repo, scanned)
+
+    for p in people[:20]:
+      p.age = random.randint(0, 100)
+      p.commit()
+      repo.merge(p)
+      scanned.merge(p)
+    for p in people[20:40]:
+      p.name = 'renamed'
+      p.commit()
+    repo.merge_many(people[20:40])
+    scanned.merge_many(people[20:40])
+    self.subtest_queries(repo, scanned)
+
+    repo.delete(people[50].key)
+    scanned.delete(people[50].key)
+    repo.delete_many([p.key for p in people[60:90]])
+    scanned.delete_many([p.key for p in people[60:90]])
+    self.subtest_queries(repo, scanned)
+
+  def test_plan(self):
+    indexes = IndexSet()
+    indexes.build(IndexedPerson.key, IndexedPerson.__dstype__, [])
+    self.assertEqual(IndexSet.indexedAttributes('IndexedPerson'), \
+      ['age', 'name'])
+    self.assertEqual(IndexSet.indexedAttributes('Unregistered'), [])
+
+    p = person(1, 30)
+    indexes.put(p.version)
+    q = Query(IndexedPerson).filter('age', '>', 10).filter('name', '=', 'name1')
+    self.assertEqual(indexes.plan(q), (['/IndexedPerson:person1'], True))
+    q = Query(IndexedPerson).filter('age', '>', 10).order('name')
+    self.assertEqual(indexes.plan(q), (['/IndexedPerson:person1'], False))
+
+    self.assertEqual(indexes.plan(Query(IndexedPerson).order('city')), None)
+    self.assertEqual(indexes.plan(Query(IndexedPerson) \
+      .filter('age', '!=', 3)), None)
+    self.assertEqual(indexes.plan(Query(IndexedPerson) \
+      .filter('age', '=', '30')), None)
+
+    indexes.delete(p.key)
+    self.assertEqual(indexes.plan(Query(IndexedPerson).order('age')), \
+      ([], True))
+
+
+if __name__ == '__main__':
+  unittest.main()
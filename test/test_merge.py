@@ -325,5 +325,162 @@ class MergeTests(unittest.TestCase):
     self.assertEqual(a1.version.hash, a3.version.hash)
     self.assertEqual(a1.version.hash, a4.version.hash)
 
+  def test_three_way(self):
+    base = Document3('A')
+    base.title = 'title'
+    base.body = 'body'
+    base.count = 1
+    base.commit()
+    ancestor = base.version
+
+    remote = Document3(ancestor)
+    remote.body = 'remote body'
+    remote.count = 5
+    remote.commit()
+
+    local = Document3(ancestor)
+    local.title = 'local title'
+    local.count = 3
+    local.commit() # newer than remote
+
+    # two-way: the newer local object wins every LatestObject attribute.
+    twoway = Document3(local.version)
+    twoway.merge(remote)
+    self.assertEqual(twoway.body, 'body')
+
+    # three-way: the attributes only remote changed are taken.
+    threeway = Document3(local.version)
+    threeway.merge(remote, ancestor)
+    self.assertEqual(threeway.title, 'local title')
+    self.assertEqual(threeway.body, 'remote body')
+    self.assertEqual(threeway.count, 5) # MaxStrategy ignores the ancestor.
+
+    # and the other way around.
+    other = Document3(remote.version)
+    other.merge(local, ancestor)
+    self.assertEqual(other.title, 'local title')
+    self.assertEqual(other.body, 'remote body')
+
+    # nothing changed since the ancestor: no new version.
+    same = Document3(local.version)
+    same.merge(ancestor, ancestor)
+    self.assertEqual(same.version, local.version)
+
+  def test_three_way_repo(self):
+    import datastore.core
+    from dronestore import Repo, HistoryStore
+
+    history = HistoryStore(datastore.DictDatastore())
+    repo = Repo('/RepoA/', datastore.DictDatastore(), history=history)
+
+    base = Document3('A')
+    base.title = 'title'
+    base.body = 'body'
+    base.commit()
+    repo.put(base)
+
+    remote = Document3(base.version)
+    remote.body = 'remote body'
+    remote.commit()
+
+    local = repo.get(base.key)
+    local.title = 'local title'
+    local.commit()
+    repo.put(local)
+
+    self.assertEqual(history.ancestor(local.version, remote.version), \
+      base.version)
+    merged = repo.merge(remote)
+    self.assertEqual(merged.title, 'local title')
+    self.assertEqual(merged.body, 'remote body')
+
+    # the remote version is now known: merging it again changes nothing.
+    self.assertTrue(history.contains(remote.version.hash))
+    self.assertEqual(repo.merge_many([remote])[0], merged)
+
+    # an unrelated history: two-way merge.
+    self.assertEqual(history.ancestor(merged.version, Document3('B').version), \
+      None)
+
+  def test_merge_plan(self):
+    plan = PersonM._mergePlan
+    self.assertEqual([name for name, s, a in plan], \
+      sorted(PersonM.attributes()))
+    for name, strategy, accessor in plan:
+      self.assertTrue(strategy is PersonM.attributes()[name].mergeStrategy)
+
+    a = PersonM('A')
+    a.first = 'Herp'
+    a.commit()
+    self.assertEqual(plan[1][2](a.version), a.version.attribute('first'))
+    self.assertEqual(plan[1][2](Version(Key('/PersonM:A'))), None)
+
+  def test_identical_payloads(self):
+    calls = []
+    class CountingStrategy(LatestObjectStrategy):
+      def merge(self, local_version, remote_version):
+        calls.append(self.attribute.name)
+        return LatestObjectStrategy.merge(self, local_version, remote_version)
+      mergeData = MergeStrategy.mergeData
+
+    class Counted(Model):
+      same = StringAttribute(strategy=CountingStrategy)
+      other = StringAttribute(strategy=CountingStrategy)
+
+    a = Counted('A')
+    a.same = 'same'
+    a.other = 'a'
+    a.commit()
+
+    b = Counted('A')
+    b.same = 'same'
+    b.other = 'b'
+    b.commit()
+
+    a.merge(b)
+    self.assertEqual(calls, ['other'])
+    self.assertEqual(a.other, 'b')
+    self.assertEqual(a.same, 'same')
+
+  def test_merge_override(self):
+    # subclasses overriding only merge are not bypassed by mergeData.
+    class ShortestStrategy(MaxStrategy):
+      def merge(self, local_version, remote_version):
+        local = self._attribute_data(local_version)
+        remote = self._attribute_data(remote_version)
+        if len(remote['value']) < len(local['value']):
+          return remote
+        return None
+
+    class Shortest(Model):
+      name = StringAttribute(strategy=ShortestStrategy)
+
+    self.assertFalse(mergesData(ShortestStrategy))
+    self.assertTrue(mergesData(MaxStrategy))
+    self.assertTrue(mergesData(LatestObjectStrategy))
+
+    a = Shortest('A')
+    a.name = 'long name'
+    a.commit()
+    b = Shortest('A')
+    b.name = 'short'
+    b.commit()
+    a.merge(b)
+    self.assertEqual(a.name, 'short')
+
+
+class Document3(Model):
+  title = StringAttribute()
+  body = TextAttribute()
+  count = IntegerAttribute(default=0, strategy=MaxStrategy)
+
+
+class Sibling(Model):
+  a = StringAttribute()
+  b = StringAttribute()
+  n = IntegerAttribute()
+  l = ListAttribute()
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,153 @@
+import unittest
+
+import datastore.core
+from dronestore import Key, Model, Repo, Query
+from dronestore import metrics
+from dronestore.util import serial
+
+from test_merge import PersonM
+
+
+class TestMetrics(unittest.TestCase):
+
+  def setUp(self):
+    metrics.registry.reset()
+
+  def tearDown(self):
+    metrics.disable()
+    metrics.registry.reset()
+
+  def counters(self):
+    return metrics.registry.snapshot()['counters']
+
+  def histograms(self):
+    return metrics.registry.snapshot()['histograms']
+
+  def test_histogram(self):
+    h = metrics.Histogram(buckets=[1, 2, 4, 8])
+    self.assertEqual(h.percentile(50), None)
+    for value in [0.5, 1.5, 1.5, 3, 7, 20]:
+      h.observe(value)
+    self.assertEqual(h.count, 6)
+    self.assertEqual(h.counts, [1, 2, 1, 1, 1])
+    self.assertEqual(h.mean, 33.5 / 6)
+    self.assertEqual(h.percentile(0), 1)
+    self.assertEqual(h.percentile(50), 2)
+    self.assertEqual(h.percentile(80), 8)
+    self.assertEqual(h.percentile(100), 20)
+    self.assertEqual(h.snapshot()['max'], 20)
+
+  def test_disabled(self):
+    get, from_version = Repo.__dict__['get'], Model.__dict__['from_version']
+    clean = serial.clean
+
+    repo = Repo('/repo', datastore.DictDatastore())
+    person = PersonM('A')
+    person.commit()
+    repo.put(person)
+    repo.get(Key('/PersonM:A'))
+    self.assertEqual(metrics.registry.snapshot(), \
+      {'counters': {}, 'histograms': {}})
+
+    metrics.enable()
+    self.assertNotEqual(Repo.__dict__['get'], get)
+    self.assertNotEqual(serial.clean, clean)
+    metrics.disable()
+    self.assertEqual(Repo.__dict__['get'], get)
+    self.assertEqual(Model.__dict__['from_version'], from_version)
+    self.assertEqual(serial.clean, clean)
+    self.assertFalse('next' in PersonM.__dict__)
+    self.assertEqual(repo.get(Key('/PersonM:A')).key, Key('/PersonM:A'))
+
+  def test_metrics(self):
+    metrics.enable()
+    store = datastore.DictDatastore()
+    metrics.instrumentDatastore(store)
+    repo = Repo('/repo', store)
+
+    people = []
+    for i in xrange(0, 5):
+      person = PersonM('P%d' % i)
+      person.first = 'F%d' % i
+      person.commit()
+      people.append(person)
+    repo.put_many(people)
+    for person in people:
+      self.assertEqual(repo.get(person.key).key, person.key)
+
+    other = PersonM(people[0].version)
+    other.first = 'Other'
+    other.age = 10
+    other.commit()
+    repo.merge(other)
+    self.assertEqual(len(list(repo.query(Query(PersonM)))), 5)
+
+    counters, histograms = self.counters(), self.histograms()
+    self.assertEqual(histograms['repo.get']['count'], 6) # one to merge.
+    self.assertEqual(histograms['repo.put_many']['count'], 1)
+    self.assertEqual(histograms['repo.merge']['count'], 1)
+    self.assertEqual(histograms['merge.merge']['count'], 1)
+    self.assertEqual(histograms['model.commit']['count'], 7) # and the merge.
+    self.assertEqual(histograms['query.instance']['count'], 5)
+    self.assertEqual(histograms['datastore.get']['count'], 6)
+    self.assertTrue(histograms['model.computedHash']['count'] >= 6)
+    self.assertTrue(histograms['repo.get']['mean'] > 0)
+
+    self.assertEqual(counters['merge.LatestStrategy.remote'], 1)
+    self.assertEqual(counters['merge.MaxStrategy.remote'], 1)
+    self.assertEqual(counters['merge.identical'], 3)
+
+    # an older remote value is not taken.
+    older = PersonM(people[1].version)
+    older.age = 1
+    older.commit()
+    local = PersonM(people[1].version)
+    local.age = 5
+    local.commit()
+    local.merge(older)
+    self.assertEqual(self.counters()['merge.MaxStrategy.local'], 1)
+
+  def test_nested(self):
+    metrics.enable()
+    serial.clean({'a': [1, {'b': [2, {'c': 3}]}]})
+    self.assertEqual(self.histograms()['serial.clean']['count'], 1)
+
+    class Failing(object):
+      def run(self):
+        raise ValueError('failed')
+    failing = Failing()
+    metrics.instrument(failing, 'run', 'failing.run')
+    self.assertRaises(ValueError, failing.run)
+    self.assertEqual(self.counters()['failing.run.errors'], 1)
+    self.assertEqual(self.histograms()['failing.run']['count'], 1)
+    metrics.disable()
+    self.assertFalse('run' in failing.__dict__)
+
+  def test_tracing(self):
+    spans = []
+    metrics.registry.addListener(spans.append)
+    metrics.enable(trace=True)
+
+    repo = Repo('/repo', datastore.DictDatastore())
+    person = PersonM('A')
+    person.commit()
+    repo.put(person)
+    other = PersonM(person.version)
+    other.age = 3
+    other.commit()
+    del spans[:]
+
+    repo.merge(other)
+    self.assertEqual(spans[-1].name, 'repo.merge')
+    self.assertEqual(spans[-1].parent, None)
+    merged = [s for s in spans if s.name == 'merge.merge'][0]
+    self.assertEqual(merged.parent, spans[-1])
+    commit = [s for s in spans if s.name == 'model.commit'][0]
+    self.assertEqual(commit.parent, merged)
+    self.assertEqual(list(metrics.registry.spans)[-len(spans):], spans)
+    self.assertEqual(metrics.current(), None)
+    metrics.registry.removeListener(spans.append)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,3 +1,4 @@
+import pickle
 import unittest
 import hashlib
 import nanotime
@@ -26,6 +27,9 @@ class Person(Model):
 class Scientist(Person):
   field = StringAttribute()
 
+class LegacyPerson(Person):
+  __hashmode__ = 'legacy'
+
 class ComputerScientist(Scientist):
   __dstype__ = 'hacker'
 
@@ -186,6 +190,50 @@ class VersionTests(unittest.TestCase):
     Version(sr)
 
 
+  def test_from_data(self):
+
+    h1 = hashlib.sha1('derp').hexdigest()
+    h2 = hashlib.sha1('herp').hexdigest()
+    now = nanotime.now().nanoseconds()
+
+    data = {'key': '/A', 'hash': h1, 'parent': h2, 'created': now, \
+      'committed': now, 'type': 'Hurr', \
+      'attributes': {'str': {'value': 'derp'}, 'num': {'value': 5}}}
+
+    decoded = []
+    def decoder(payload):
+      decoded.append(payload)
+      return serial.clean(payload)
+
+    v = Version.from_data(data, decoder=decoder)
+    self.assertFalse(hasattr(v, '__dict__'))
+    self.assertEqual(v.key, Key('/A'))
+    self.assertEqual(v.hash, h1)
+    self.assertEqual(v.parent, h2)
+    self.assertEqual(v.committed, nanotime.nanotime(now))
+    self.assertEqual(v.type, 'Hurr')
+    self.assertEqual(decoded, [])
+
+    # payloads are decoded once, on first access.
+    self.assertEqual(v.attributeValue('str'), 'derp')
+    self.assertEqual(v.attributeValue('str'), 'derp')
+    self.assertEqual(decoded, [{'value': 'derp'}])
+    self.assertFalse(v.attribute('str') is data['attributes']['str'])
+    self.assertRaises(KeyError, v.attribute, 'fdsafda')
+
+    self.assertEqual(sorted(v.attributeNames()), ['num', 'str'])
+    self.assertEqual(v.data(), data)
+    self.assertEqual(v.serialRepresentation.data(), data)
+    self.assertEqual(v, Version(serial.SerialRepresentation(data)))
+
+    v2 = pickle.loads(pickle.dumps(v))
+    self.assertEqual(v2, v)
+    self.assertEqual(v2.data(), data)
+    self.assertEqual(pickle.loads(pickle.dumps(v, 2)).data(), data)
+
+    del data['type']
+    self.assertRaises(ValueError, Version.from_data, data)
+
   def test_model(self):
 
     h1 = hashlib.sha1('derp').hexdigest()
@@ -375,6 +423,68 @@ class ModelTests(unittest.TestCase):
     self.assertEqual(ComputerScientist.__dstype__, 'hacker')
     self.assertEqual(SystemsEngineer.__dstype__, 'SystemsEngineer')
 
+  def test_hashing(self):
+    p = Person('HerpDerp')
+    p.first = 'Herp'
+    p.commit()
+
+    # the version hash is composed of the sorted attribute digests.
+    digests = [a.digest(p) for n, a in sorted(Person.attributes().items())]
+    buf = '%s,%s,%s' % (p.key, 'Person', ''.join(digests))
+    self.assertEqual(p.version.hash, hashlib.sha1(buf).hexdigest())
+
+    for name, attr in Person.attributes().items():
+      buf = '%s=%s,' % (name, attr.rawData(p))
+      self.assertEqual(p._digests[name], hashlib.sha1(buf).digest())
+
+    # changing an attribute only invalidates its own digest.
+    version = p.version
+    p.last = 'Derp'
+    self.assertFalse('last' in p._digests)
+    self.assertEqual(len(p._digests), len(Person.attributes()) - 1)
+    p.commit()
+    self.assertEqual(p.version.hash, p.computedHash())
+    self.assertNotEqual(p.version.hash, version.hash)
+
+    # unchanged attributes are carried over from the previous version.
+    self.assertTrue(p.version.attribute('first') is version.attribute('first'))
+    self.assertFalse(p.version.attribute('last') is version.attribute('last'))
+    self.assertEqual(p.version.attributeValue('last'), 'Derp')
+
+    # a reloaded instance hashes the same.
+    self.assertEqual(Person(p.version).computedHash(), p.version.hash)
+
+  def test_clean_commit(self):
+    p = Person('HerpDerp')
+    p.first = 'Herp'
+    p.commit()
+    version = p.version
+
+    # committing a clean instance does nothing at all.
+    def fail():
+      raise AssertionError('clean commit must not validate or hash')
+    p.validate = p.computedHash = fail
+    p.commit()
+    self.assertTrue(p.version is version)
+
+    del p.validate, p.computedHash
+    p.first = 'Herp'
+    self.assertFalse(p.isDirty())
+    p.first = 'Derp'
+    self.assertTrue(p.isDirty())
+    p.commit()
+    self.assertEqual(p.version.parent, version.hash)
+
+  def test_legacy_hashing(self):
+    p = LegacyPerson('HerpDerp')
+    p.first = 'Herp'
+    p.commit()
+
+    buf = '%s,%s,' % (p.key, 'LegacyPerson')
+    for attr_name, attr in LegacyPerson.attributes().iteritems():
+      buf += '%s=%s,' % (attr_name, attr.rawData(p))
+    self.assertEqual(p.version.hash, hashlib.sha1(buf).hexdigest())
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -1,11 +1,12 @@
 import time
+import random
 import datetime
 import unittest
 import hashlib
 import nanotime
 
 from dronestore.model import Key, Version, Model
-from dronestore.query import Filter, Order, Query
+from dronestore.query import Filter, Order, Query, DatastoreQuery
 from dronestore.util import serial
 from dronestore import model
 
@@ -383,6 +384,40 @@ class TestQuery(unittest.TestCase):
     self.assertEqual(q2, eval(repr(q2)))
     self.assertEqual(q3, eval(repr(q3)))
 
+  def test_compiled(self):
+    # compiled evaluation must match the naive (probing) evaluation.
+    naive = lambda q, items: list(DatastoreQuery.__call__(q, items))
+
+    vs = []
+    for i in range(0, 30):
+      sr = serial.SerialRepresentation()
+      sr['key'] = '/Hurr:%d' % i
+      sr['hash'] = hashlib.sha1('herp%d' % i).hexdigest()
+      sr['parent'] = Version.BLANK_HASH
+      sr['created'] = i % 7
+      sr['committed'] = 10 + i % 7
+      sr['attributes'] = {'str' : {'value' : 'herp%d' % (i % 4)}, \
+        'int' : {'value' : i % 5} }
+      sr['type'] = 'Hurr'
+      vs.append(Version(sr))
+
+    shapes = [vs, [v.data() for v in vs], [v.serialRepresentation for v in vs]]
+    shapes.append([random.choice(objs) for objs in zip(*shapes)]) # mixed
+
+    queries = [
+      Query('/Hurr').filter('int', '>', 2),
+      Query('/Hurr').filter('int', '=', 3).filter('str', '!=', 'herp1'),
+      Query('/Hurr').filter('committed', '>=', 13).filter('key', '<', '/Hurr:2'),
+      Query('/Hurr').filter('missing', '=', None),
+      Query('/Hurr').order('int').order('-str'),
+      Query('/Hurr', limit=5, offset=3).filter('int', '<=', 3).order('-created'),
+      Query('/Hurr', limit=4).order('str').order('hash'),
+    ]
+
+    for items in shapes:
+      for query in queries:
+        self.assertEqual(list(query(items)), naive(query, items))
+
 
 if __name__ == '__main__':
   unittest.main()
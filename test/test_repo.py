@@ -5,11 +5,33 @@ import random
 import unittest
 
 import datastore.core
-from dronestore import Key, Model, Repo, Query
+from dronestore import Key, Version, Model, Repo, Query
 
 from test_merge import PersonM
 
 
+class BatchDictDatastore(datastore.DictDatastore):
+  '''DictDatastore with bulk operations, counting round trips.'''
+
+  def __init__(self):
+    super(BatchDictDatastore, self).__init__()
+    self.round_trips = 0
+
+  def get_many(self, keys):
+    self.round_trips += 1
+    return [self.get(key) for key in keys]
+
+  def put_many(self, items):
+    self.round_trips += 1
+    for key, value in items:
+      self.put(key, value)
+
+  def delete_many(self, keys):
+    self.round_trips += 1
+    for key in keys:
+      self.delete(key)
+
+
 class TestRepo(unittest.TestCase):
 
   def test_simple(self):
@@ -57,6 +79,367 @@ class TestRepo(unittest.TestCase):
     self.assertEqual(p2, res[0])
 
 
+  def subtest_batch(self, store):
+    repo = Repo('/RepoA/', store)
+
+    people = []
+    for i in range(0, 10):
+      p = PersonM('person%d' % i)
+      p.first = 'first%d' % i
+      p.commit()
+      people.append(p)
+
+    keys = [p.key for p in people]
+    missing = Key('/PersonM:missing')
+
+    self.assertEqual(repo.get_many(keys), [None] * 10)
+    self.assertEqual(repo.put_many(people), people)
+    self.assertEqual(repo.get_many(keys), people)
+
+    # input order, duplicates and missing keys are preserved.
+    lookup = [keys[3], missing, keys[1], keys[3]]
+    self.assertEqual(repo.get_many(lookup), \
+      [people[3], None, people[1], people[3]])
+
+    # merge a mix of changed, unchanged and brand new entities.
+    updated = []
+    for p in people[:5]:
+      p2 = PersonM(p.version)
+      p2.first = 'updated'
+      p2.commit()
+      updated.append(p2)
+
+    new = PersonM('new')
+    new.commit()
+
+    merged = repo.merge_many(updated + people[5:] + [new])
+    self.assertEqual(len(merged), 11)
+    for p, m in zip(updated, merged[:5]):
+      self.assertEqual(m.first, 'updated')
+      self.assertEqual(repo.get(p.key), m)
+    for p, m in zip(people[5:], merged[5:10]):
+      self.assertEqual(p, m)
+    self.assertEqual(merged[10], new)
+    self.assertEqual(repo.get(new.key), new)
+
+    # several versions of the same key merge into a single instance.
+    a = PersonM(people[7].version)
+    a.last = 'lastA'
+    a.commit()
+    b = PersonM(a.version)
+    b.phone = 'phoneB'
+    b.commit()
+    m1, m2 = repo.merge_many([a, b])
+    self.assertTrue(m1 is m2)
+    self.assertEqual(m1.last, 'lastA')
+    self.assertEqual(m1.phone, 'phoneB')
+    self.assertEqual(repo.get(a.key), m1)
+
+    self.assertRaises(ValueError, repo.get_many, ['/PersonM:person1'])
+    dirty = PersonM('dirty')
+    self.assertRaises(ValueError, repo.put_many, [people[0], dirty])
+    self.assertFalse(repo.contains(dirty.key))
+
+    repo.delete_many(keys[:5] + keys[:2])
+    self.assertEqual(repo.get_many(keys[:5]), [None] * 5)
+    self.assertTrue(all(repo.get_many(keys[5:])))
+
+  def test_batch(self):
+    self.subtest_batch(datastore.DictDatastore())
+
+    store = BatchDictDatastore()
+    self.subtest_batch(store)
+
+    repo = Repo('/RepoA/', store)
+    store.round_trips = 0
+    repo.get_many([Key('/PersonM:person%d' % i) for i in range(0, 10)])
+    self.assertEqual(store.round_trips, 1)
+
+  def test_merge_all(self):
+    from dronestore import BinaryCodec
+
+    people = []
+    for i in range(0, 40):
+      p = PersonM('person%d' % i)
+      p.first = 'first%d' % i
+      p.age = i
+      p.commit()
+      people.append(p)
+
+    # remote changes: some diverged, some new keys, some keys twice.
+    dump = []
+    for i in range(20, 60):
+      p = PersonM(people[i].version) if i < 40 else PersonM('person%d' % i)
+      p.last = 'remote%d' % i
+      p.age = 100 - i
+      p.commit()
+      dump.append(p.version)
+    stored = [p.version for p in people[:30]]
+    for p in people[:5]:
+      p.phone = 'local'
+      p.commit()
+    dump.extend([p.version for p in people[:10]])
+
+    def repo(codec=None):
+      repo = Repo('/RepoA/', BatchDictDatastore(), codec=codec)
+      repo.put_many(stored)
+      return repo
+
+    expected = repo()
+    expected.merge_many(dump)
+
+    for processes, codec in [(1, None), (2, None), (3, BinaryCodec())]:
+      r = repo(codec)
+      self.assertEqual(r.merge_all(iter(dump), processes, batchSize=7), 45)
+      keys = [v.key for v in dump]
+      for e, a in zip(expected.get_many(keys), r.get_many(keys)):
+        self.assertEqual(e.version.hash, a.version.hash)
+      self.assertEqual(r.merge_all(dump, processes), 0)
+      self.assertEqual(len(r._keyLocks), 0)
+
+  def siblings(self):
+    '''Returns a base version, and sibling versions of it, each changing one
+    attribute (the last two the same one).'''
+    from test_merge import Sibling
+    base = Sibling('k')
+    base.commit()
+    siblings = []
+    for attr, value in [('a', 'new'), ('b', 'new'), ('l', ['x1']), \
+        ('n', 3), ('n', 4)]:
+      s = Sibling(base.version)
+      setattr(s, attr, value)
+      s.commit()
+      siblings.append(s.version)
+    return base.version, siblings
+
+  def historyRepo(self, base):
+    from dronestore import HistoryStore
+    history = HistoryStore(datastore.DictDatastore())
+    repo = Repo('/RepoA/', datastore.DictDatastore(), history=history)
+    repo.put(base)
+    return repo
+
+  def test_merge_many_history(self):
+    base, siblings = self.siblings()
+    values = lambda i: [i.a, i.b, i.l, i.n]
+    for seq in [siblings, siblings[2:] + siblings[:2]]:
+      expected = self.historyRepo(base)
+      for version in seq:
+        expected.merge(version)
+      expected = values(expected.get(base.key))
+      self.assertEqual(expected[:3], ['new', 'new', ['x1']])
+
+      repo = self.historyRepo(base)
+      self.assertEqual(values(repo.merge_many(seq)[-1]), expected)
+      self.assertEqual(values(repo.get(base.key)), expected)
+
+  def test_merge_all_history(self):
+    from dronestore import HistoryStore
+    from test_merge import Document3
+
+    # a new key, then two diverging children of it, in one batch.
+    d = Document3('D')
+    d.title, d.body = 'title', 'body'
+    d.commit()
+    dump = [d.version]
+    for attr in ['title', 'body']:
+      c = Document3(d.version)
+      setattr(c, attr, 'changed')
+      c.commit()
+      dump.append(c.version)
+
+    def repo():
+      history = HistoryStore(datastore.DictDatastore())
+      return Repo('/RepoA/', datastore.DictDatastore(), history=history)
+
+    expected = repo()
+    expected.merge_many(dump)
+    merged = expected.get(d.key)
+    self.assertEqual([merged.title, merged.body], ['changed', 'changed'])
+
+    for processes in [1, 2]:
+      r = repo()
+      self.assertEqual(r.merge_all(dump, processes), 1)
+      self.assertEqual(r.get(d.key).version.hash, merged.version.hash)
+      self.assertEqual(len(r._keyLocks), 0)
+
+    # several siblings of a stored key, as merged one at a time.
+    base, siblings = self.siblings()
+    values = lambda i: [i.a, i.b, i.l, i.n]
+    for seq in [siblings, siblings[2:] + siblings[:2]]:
+      expected = self.historyRepo(base)
+      for version in seq:
+        expected.merge(version)
+      expected = values(expected.get(base.key))
+
+      for processes in [1, 2]:
+        r = self.historyRepo(base)
+        self.assertEqual(r.merge_all(seq, processes), 1)
+        self.assertEqual(values(r.get(base.key)), expected)
+
+  def test_locking(self):
+    import threading
+    from test_asyncrepo import SlowDatastore
+
+    store = SlowDatastore()
+    repo = Repo('/RepoA/', store)
+    base = PersonM('A')
+    base.commit()
+    repo.put(base)
+
+    # concurrent merges of a key, each changing a different attribute.
+    versions = []
+    for attr in ['first', 'last', 'phone']:
+      p = PersonM(base.version)
+      setattr(p, attr, 'changed')
+      p.commit()
+      versions.append(p)
+
+    threads = [threading.Thread(target=repo.merge, args=(v,)) \
+      for v in versions]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    merged = repo.get(base.key)
+    self.assertEqual([merged.first, merged.last, merged.phone], \
+      ['changed'] * 3)
+    self.assertEqual(store.overlaps, 1)
+    self.assertEqual(len(repo._keyLocks), 0)
+
+  def test_key_locks(self):
+    import threading
+    from dronestore.util.locks import KeyLocks
+
+    locks = KeyLocks(stripes=1) # all keys share a stripe.
+    locks.acquire('/A')
+    locks.acquire('/A') # re-entrant.
+
+    # another key is not blocked, the same key is.
+    acquired = []
+    def other(key):
+      locks.acquire(key)
+      acquired.append(key)
+      locks.release(key)
+    for key in ['/B', '/A']:
+      thread = threading.Thread(target=other, args=(key,))
+      thread.daemon = True
+      thread.start()
+      thread.join(0.1)
+    self.assertEqual(acquired, ['/B'])
+
+    # all or nothing, without waiting.
+    result = []
+    def many():
+      result.append(locks.acquireMany(['/C', '/A'], blocking=False))
+    trier = threading.Thread(target=many)
+    trier.start()
+    trier.join()
+    self.assertEqual(result, [False])
+    self.assertEqual(len(locks), 1) # /C was given back.
+
+    locks.release('/A')
+    locks.release('/A')
+    thread.join(1)
+    self.assertEqual(acquired, ['/B', '/A'])
+    self.assertEqual(len(locks), 0)
+    self.assertTrue(locks.acquireMany(['/C', '/A'], blocking=False))
+    locks.releaseMany(['/A', '/C'])
+    self.assertEqual(len(locks), 0)
+
+  def test_cas(self):
+    from dronestore.repo import MergeConflictError
+
+    class InterferingDatastore(BatchDictDatastore):
+      '''Writes a concurrent change right after the first `times` reads.'''
+      def __init__(self, times):
+        super(InterferingDatastore, self).__init__()
+        self.times = times
+
+      def get(self, key):
+        value = super(InterferingDatastore, self).get(key)
+        if self.times and value is not None:
+          self.times -= 1
+          other = PersonM(Version.from_data(value, decoder=None))
+          other.age += 1
+          other.commit()
+          self.put(key, other.version.data())
+        return value
+
+    class SwappingDatastore(InterferingDatastore):
+      swaps = 0
+      def compare_and_swap(self, key, old, new):
+        self.swaps += 1
+        current = datastore.DictDatastore.get(self, key)
+        if (current and current['hash']) != (old and old['hash']):
+          return False
+        self.put(key, new)
+        return True
+
+    for storeClass in [InterferingDatastore, SwappingDatastore]:
+      store = storeClass(0)
+      repo = Repo('/RepoA/', store, cas=True)
+      base = PersonM('A')
+      base.first = 'first'
+      base.commit()
+      self.assertEqual(repo.merge(base), base) # new key
+
+      p = PersonM(base.version)
+      p.last = 'last'
+      p.commit()
+
+      store.times = 3 # lose the first three attempts.
+      merged = repo.merge(p)
+      self.assertEqual(merged.last, 'last')
+      self.assertEqual(merged.age, 3) # the concurrent changes are kept.
+      self.assertEqual(repo.get(base.key), merged)
+
+      store.times = 2 * Repo.CAS_ATTEMPTS # (emulated swaps read too)
+      p.phone = 'phone'
+      p.commit()
+      self.assertRaises(MergeConflictError, repo.merge, p)
+
+    self.assertEqual(store.swaps, 1 + 4 + Repo.CAS_ATTEMPTS)
+
+  def test_views(self):
+    from dronestore import InstanceView, BinaryCodec
+
+    for codec in [None, BinaryCodec()]:
+      repo = Repo('/RepoA/', datastore.DictDatastore(), codec=codec)
+      for i in range(0, 10):
+        p = PersonM('person%d' % i)
+        p.first = 'first%d' % i
+        p.age = i
+        p.commit()
+        repo.put(p)
+
+      query = Query(PersonM, fields=['first', 'age']).filter('age', '>', 4) \
+        .order('-age')
+      views = list(repo.query(query))
+      self.assertEqual(len(views), 5)
+      self.assertEqual([v.age for v in views], [9, 8, 7, 6, 5])
+      self.assertEqual(views[0].first, 'first9')
+      self.assertEqual(views[0].key, Key('/PersonM:person9'))
+      self.assertEqual(views[0].attributeValues(), {'first':'first9', 'age':9})
+      self.assertRaises(AttributeError, getattr, views[0], 'last')
+      self.assertRaises(AttributeError, setattr, views[0], 'age', 3)
+
+      if codec:
+        # only the attributes read (or filtered on) were decoded.
+        self.assertEqual(sorted(views[0].version._decoded), ['age', 'first'])
+      self.assertEqual(views[0].instance(), repo.get(views[0].key))
+
+      # views of all attributes, including unset defaults.
+      views = list(repo.query(Query(PersonM).filter('age', '=', 3), True))
+      self.assertTrue(isinstance(views[0], InstanceView))
+      self.assertEqual(views[0].last, 'Lastname')
+      self.assertEqual(views[0].gender, None)
+      self.assertRaises(ValueError, InstanceView, views[0].version, ['bogus'])
+
+    self.assertEqual(query, Query.from_dict(query.dict()))
+    self.assertEqual(query.copy().fields, ['first', 'age'])
+
   def test_stress(self):
     num_repos = 5
     num_people = 10
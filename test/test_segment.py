@@ -0,0 +1,180 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import datastore.core
+from dronestore import Key, Repo, Query, BinaryCodec
+from dronestore.segment import SegmentDatastore, SNAPSHOT
+
+from test_merge import PersonM
+
+
+class TestSegmentDatastore(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def segments(self):
+    return sorted([n for n in os.listdir(self.root) if n.startswith('segment')])
+
+  def test_basic(self):
+    store = SegmentDatastore(self.root)
+    a, b, c = Key('/Foo:a'), Key('/Foo:b'), Key('/Bar:c')
+    store.put(a, {'value': 1})
+    store.put(b, 'b')
+    store.put(c, [1, 2])
+    store.put(a, {'value': 2})
+    store.delete(b)
+    store.delete(Key('/Foo:missing'))
+
+    self.assertEqual(store.get(a), {'value': 2})
+    self.assertEqual(store.get(b), None)
+    self.assertEqual(store.get(c), [1, 2])
+    self.assertTrue(store.contains(a))
+    self.assertFalse(store.contains(b))
+    self.assertEqual(len(store), 2)
+
+    query = datastore.Query(Key('/Foo'))
+    self.assertEqual(list(store.query(query)), [{'value': 2}])
+    store.put(b, {'value': 0})
+    query = datastore.Query(Key('/Foo')).order('value')
+    self.assertEqual(list(store.query(query)), [{'value': 0}, {'value': 2}])
+    self.assertEqual(list(store.query(datastore.Query(Key('/Baz')))), [])
+    store.close()
+
+  def test_restart(self):
+    store = SegmentDatastore(self.root, segmentSize=1024, compactRatio=2)
+    for i in range(0, 100):
+      store.put(Key('/Foo:%d' % (i % 30)), {'i': i})
+    store.delete(Key('/Foo:0'))
+    store.close()
+    self.assertTrue(len(self.segments()) > 1)
+
+    # with the snapshot: nothing to scan.
+    store = SegmentDatastore(self.root, segmentSize=1024, compactRatio=2)
+    self.assertEqual(store.scanned, 0)
+    self.assertEqual(store.get(Key('/Foo:29')), {'i': 89})
+    self.assertEqual(store.get(Key('/Foo:0')), None)
+    store.put(Key('/Foo:1'), 'new')
+
+    # "crash": only the writes after the snapshot are scanned.
+    store = SegmentDatastore(self.root, segmentSize=1024, compactRatio=2)
+    self.assertEqual(store.scanned, 1)
+    self.assertEqual(store.get(Key('/Foo:1')), 'new')
+    self.assertEqual(len(store), 29)
+
+    # without a snapshot, and with a torn record at the end.
+    os.unlink(os.path.join(self.root, SNAPSHOT))
+    with open(os.path.join(self.root, self.segments()[-1]), 'ab') as f:
+      f.write('\x01\x00\x00\x00\x05garb')
+    store = SegmentDatastore(self.root, segmentSize=1024, compactRatio=2)
+    self.assertEqual(store.scanned, 102)
+    self.assertEqual(store.get(Key('/Foo:1')), 'new')
+    self.assertEqual(store.get(Key('/Foo:29')), {'i': 89})
+    store.put(Key('/Foo:2'), 'after') # appends after the torn record.
+    store.close()
+    store = SegmentDatastore(self.root)
+    self.assertEqual(store.get(Key('/Foo:2')), 'after')
+    store.close()
+
+  def test_compaction(self):
+    store = SegmentDatastore(self.root, segmentSize=2048, compactRatio=2)
+    for i in range(0, 500):
+      store.put(Key('/Foo:%d' % (i % 10)), {'i': i})
+    before = len(self.segments())
+    self.assertTrue(before > 5)
+
+    reclaimed = store.compact()
+    self.assertTrue(reclaimed > 0)
+    self.assertEqual(len(self.segments()), 2)
+    self.assertEqual([store.get(Key('/Foo:%d' % i)) for i in range(0, 10)], \
+      [{'i': 490 + i} for i in range(0, 10)])
+    store.close()
+
+    store = SegmentDatastore(self.root)
+    self.assertEqual(store.get(Key('/Foo:3')), {'i': 493})
+    os.unlink(os.path.join(self.root, SNAPSHOT))
+    store = SegmentDatastore(self.root)
+    self.assertEqual(store.get(Key('/Foo:3')), {'i': 493})
+
+    # compaction in the background, as segments fill up with garbage.
+    store = SegmentDatastore(self.root, segmentSize=2048, compactRatio=0.5)
+    before, first = len(self.segments()), store._active.id
+    for i in range(0, 1000):
+      store.put(Key('/Foo:%d' % (i % 10)), {'i': i})
+    store._compactor.join()
+    created = store._active.id - first
+    self.assertTrue(created > 5)
+    self.assertTrue(len(self.segments()) < before + created)
+    self.assertEqual(store.get(Key('/Foo:9')), {'i': 999})
+    store.close()
+
+  def test_compaction_crash(self):
+    store = SegmentDatastore(self.root, segmentSize=512, compactRatio=2)
+    for i in range(0, 50):
+      store.put(Key('/Foo:%d' % (i % 10)), {'i': i})
+    for i in range(0, 5):
+      store.delete(Key('/Foo:%d' % i))
+    store.put(Key('/Foo:end'), 'x' * 512) # seals the deletions.
+    before = self.segments()
+    self.assertTrue(len(before) > 3)
+
+    # "crash" between replacing the newest sealed segment and removing the
+    # older ones.
+    unlink = os.unlink
+    def crash(path):
+      raise OSError('crash')
+    os.unlink = crash
+    try:
+      self.assertRaises(OSError, store.compact)
+    finally:
+      os.unlink = unlink
+    self.assertEqual(self.segments(), before)
+
+    store = SegmentDatastore(self.root, segmentSize=512, compactRatio=2)
+    self.assertEqual([store.get(Key('/Foo:%d' % i)) for i in range(0, 10)], \
+      [None] * 5 + [{'i': 45 + i} for i in range(0, 5)])
+    self.assertEqual(len(store), 6)
+
+    # once the older segments are gone, so are the deletions.
+    store.compact()
+    store.compact()
+    self.assertEqual(len(self.segments()), 2)
+    self.assertEqual(store._garbage.get(int(self.segments()[0][8:16]), 0), 0)
+    self.assertEqual(store.get(Key('/Foo:0')), None)
+    store.close()
+
+  def test_repo(self):
+    for codec in [None, BinaryCodec()]:
+      root = os.path.join(self.root, str(codec))
+      repo = Repo('/RepoA/', SegmentDatastore(root), codec=codec)
+      for i in range(0, 20):
+        p = PersonM('person%d' % i)
+        p.age = i
+        p.commit()
+        repo.put(p)
+
+      q = repo.get(Key('/PersonM:person5'))
+      q.first = 'changed'
+      q.commit()
+      repo.merge(q)
+      repo._store.close()
+
+      repo = Repo('/RepoA/', SegmentDatastore(root), codec=codec)
+      self.assertEqual(repo.get(Key('/PersonM:person5')).first, 'changed')
+      query = Query(PersonM).filter('age', '>=', 15)
+      self.assertEqual(sorted([p.age for p in repo.query(query)]), \
+        range(15, 20))
+      repo._store.close()
+
+  def test_default_store(self):
+    # repos no longer share a default datastore.
+    self.assertFalse(Repo('/RepoA')._store is Repo('/RepoB')._store)
+
+
+if __name__ == '__main__':
+  unittest.main()
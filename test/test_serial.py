@@ -1,10 +1,13 @@
 
 import copy
 import random
+import datetime
 import unittest
+import nanotime
 
 from .util import RandomGen
 
+from dronestore.util import serial
 from dronestore.util.serial import SerialRepresentation as SR
 
 class TestSerial(unittest.TestCase):
@@ -51,5 +54,44 @@ class TestSerial(unittest.TestCase):
     self.__subtest_conversions(RandomGen.randomDict())
     self.__subtest_conversions(RandomGen.randomDict())
 
+  def test_clean(self):
+    eq = self.assertEqual
+    clean = serial.clean
+
+    now = nanotime.now()
+    dt = datetime.datetime.now()
+    eq(clean(now), now.nanoseconds())
+    eq(clean(dt), dt)
+    eq(clean((1, 'a', None)), [1, 'a', None])
+    eq(clean({'a': (1, now)}), {'a': [1, now.nanoseconds()]})
+    eq(clean({1: {2: [3.0, True]}}), {1: {2: [3.0, True]}})
+    eq(clean(self), str(self))
+    eq(clean([self]), [str(self)])
+
+    # subclasses are cleaned like their bases, into plain containers.
+    class Tuple(tuple): pass
+    class Dict(dict): pass
+    eq(type(clean(Tuple([1]))), list)
+    eq(type(clean(Dict(a=Dict(b=1)))['a']), dict)
+
+    # containers are always copied, clean or not.
+    flat = {'a': 1, 'b': [1, 2]}
+    cleaned = clean(flat)
+    eq(cleaned, flat)
+    self.assertFalse(cleaned is flat)
+    self.assertFalse(cleaned['b'] is flat['b'])
+
+    for i in range(0, 20):
+      data = RandomGen.randomDict()
+      eq(clean(data), data)
+
+  def test_trusted(self):
+    data = {'a': [1, 2]}
+    sr = SR(data, trusted=True)
+    self.assertTrue(sr.data() is data)
+    self.assertFalse(SR(data).data() is data)
+    self.assertEqual(SR(None, trusted=True).data(), {})
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,130 @@
+import unittest
+
+import datastore.core
+from dronestore import Key, Repo, Query
+from dronestore.shard import HashRing, ShardedDatastore
+from dronestore.asyncrepo import ThreadExecutor
+
+from test_merge import PersonM
+
+
+def people(count):
+  for i in xrange(0, count):
+    person = PersonM('P%03d' % i)
+    person.first = 'F%d' % (i % 7)
+    person.age = i % 13
+    person.commit()
+    yield person
+
+
+class TestShard(unittest.TestCase):
+
+  def test_ring(self):
+    ring = HashRing(['a', 'b', 'c', 'd'])
+    keys = [Key('/PersonM:%d' % i) for i in xrange(0, 4000)]
+    counts = {}
+    for key in keys:
+      counts[ring.owner(key)] = counts.get(ring.owner(key), 0) + 1
+    self.assertEqual(sorted(counts.keys()), ['a', 'b', 'c', 'd'])
+    for count in counts.values():
+      self.assertTrue(600 < count < 1400, counts)
+
+    # independent of the order of names.
+    other = HashRing(['d', 'b', 'a', 'c'])
+    for key in keys[:100]:
+      self.assertEqual(ring.owner(key), other.owner(key))
+
+    # an added shard only takes keys from the others.
+    bigger = HashRing(['a', 'b', 'c', 'd', 'e'])
+    for key in keys:
+      self.assertTrue(bigger.owner(key) in (ring.owner(key), 'e'))
+    self.assertRaises(ValueError, HashRing, [])
+
+  def test_repo(self):
+    shards = [datastore.DictDatastore() for i in xrange(0, 3)]
+    store = ShardedDatastore(shards)
+    repo = Repo('/repo', store)
+    single = Repo('/repo', datastore.DictDatastore())
+    for person in people(60):
+      repo.put(person)
+      single.put(person)
+    self.assertTrue(all([len(s._items['/PersonM']) > 5 for s in shards]))
+
+    key = Key('/PersonM:P007')
+    self.assertEqual(store.shardOf(key), store.shardOf(str(key)))
+    self.assertEqual(repo.get(key).age, 7)
+    self.assertTrue(repo.contains(key))
+    other = PersonM(repo.get(key).version)
+    other.age = 50
+    other.commit()
+    repo.merge(other)
+    single.merge(other)
+    self.assertEqual(repo.get(key).age, 50)
+
+    keys = [Key('/PersonM:P%03d' % i) for i in (5, 40, 7, 100)]
+    found = repo.get_many(keys)
+    self.assertEqual([p and p.key for p in found], keys[:3] + [None])
+
+    def same(query):
+      results = [p.key for p in repo.query(query)]
+      self.assertEqual(results, [p.key for p in single.query(query)])
+      return results
+
+    self.assertEqual(len(same(Query(PersonM).order('key'))), 60)
+    self.assertEqual(len(same(Query(PersonM, limit=7).order('-age') \
+      .order('key'))), 7)
+    self.assertEqual(len(same(Query(PersonM, limit=5, offset=10) \
+      .order('first').order('-key'))), 5)
+    results = same(Query(PersonM, limit=4).filter('age', '>', 9).order('age') \
+      .order('key'))
+    self.assertEqual(results[0], Key('/PersonM:P010'))
+    self.assertEqual(len(list(repo.query(Query(PersonM, limit=10)))), 10)
+    self.assertEqual(len(list(repo.query(Query(PersonM, offset=55)))), 5)
+
+    # concurrent scatter.
+    executor = ThreadExecutor(3)
+    store.executor = executor
+    same(Query(PersonM, limit=6, offset=3).order('-key'))
+    executor.shutdown()
+
+    repo.delete(key)
+    self.assertFalse(repo.contains(key))
+    self.assertEqual(sum([len(s._items['/PersonM']) for s in shards]), 59)
+
+  def test_reshard(self):
+    a, b, c, d = [datastore.DictDatastore() for i in xrange(0, 4)]
+    store = ShardedDatastore({'a': a, 'b': b, 'c': c})
+    repo = Repo('/repo', store)
+    everyone = list(people(300))
+    repo.put_many(everyone)
+
+    def check():
+      for person in everyone:
+        self.assertEqual(repo.get(person.key).version.hash, person.version.hash)
+      shards = store.shards.values()
+      self.assertEqual(sum([len(s._items['/PersonM']) for s in shards]), 300)
+      for name, shard in store.shards.items():
+        for key in shard._items['/PersonM']:
+          self.assertEqual(store.shardOf(key), name)
+
+    before = dict([(p.key, store.shardOf(p.key)) for p in everyone])
+    moved = store.reshard({'a': a, 'b': b, 'c': c, 'd': d}, [Key('/PersonM')])
+    check()
+    self.assertTrue(30 < moved < 120, moved)
+    self.assertEqual(moved, len(d._items['/PersonM']))
+    self.assertEqual(moved, \
+      len([p for p in everyone if before[p.key] != store.shardOf(p.key)]))
+
+    # dropping a shard moves its keys only.
+    held = len(b._items['/PersonM'])
+    self.assertEqual(store.reshard({'a': a, 'c': c, 'd': d}, ['/PersonM']), \
+      held)
+    check()
+    self.assertFalse(b._items.get('/PersonM'))
+
+    self.assertRaises(ValueError, store.reshard, {'a': b}, ['/PersonM'])
+    self.assertRaises(TypeError, ShardedDatastore, ['a'])
+
+
+if __name__ == '__main__':
+  unittest.main()
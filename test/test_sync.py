@@ -0,0 +1,115 @@
+
+import random
+import unittest
+
+import datastore.core
+from dronestore import Key, Repo, BinaryCodec
+from dronestore.sync import MerkleTree, SyncEndpoint, LocalTransport, \
+  SyncError, diff, sync
+
+from test_merge import PersonM
+
+
+def person(i, age=30):
+  p = PersonM('person%d' % i)
+  p.first = 'first%d' % i
+  p.age = age
+  p.commit()
+  return p
+
+
+class TestSync(unittest.TestCase):
+
+  def test_merkle(self):
+    keys = [Key('/PersonM:person%d' % i) for i in range(0, 100)]
+    items = [(k, str(i)) for i, k in enumerate(keys)]
+
+    a, b = MerkleTree(), MerkleTree()
+    a.build('/PersonM', items)
+    b.build('/PersonM', reversed(items))
+    self.assertEqual(a.digest('/PersonM'), b.digest('/PersonM'))
+    self.assertEqual(a.children('/PersonM', ''), b.children('/PersonM', ''))
+
+    root = a.digest('/PersonM')
+    a.put(keys[3], 'changed')
+    self.assertNotEqual(a.digest('/PersonM'), root)
+    bucket = a.bucketOf(keys[3])
+    self.assertEqual(a.leaf('/PersonM', bucket)[str(keys[3])], 'changed')
+    self.assertNotEqual(a.children('/PersonM', bucket[0])[bucket], \
+      b.children('/PersonM', bucket[0])[bucket])
+
+    a.put(keys[3], '3')
+    self.assertEqual(a.digest('/PersonM'), root)
+    a.delete(keys[4])
+    a.delete(keys[4])
+    self.assertNotEqual(a.digest('/PersonM'), root)
+    a.put(keys[4], '4')
+    self.assertEqual(a.digest('/PersonM'), root)
+
+    a.build('/Empty', [])
+    self.assertEqual(a.digest('/Empty'), '')
+    self.assertRaises(ValueError, a.children, '/PersonM', bucket)
+
+  def subtest_sync(self, codec):
+    local = Repo('/RepoA/', datastore.DictDatastore(), codec=codec)
+    remote = Repo('/RepoB/', datastore.DictDatastore(), codec=codec)
+    transport = LocalTransport(SyncEndpoint(remote))
+
+    people = [person(i, random.randint(0, 50)) for i in range(0, 300)]
+    local.put_many(people)
+    remote.put_many(people)
+
+    # identical repos: only the roots are compared.
+    self.assertEqual(sync(local, transport, [PersonM]), 0)
+    self.assertEqual(transport.calls, 1)
+
+    # changes on both sides, new keys on both sides.
+    for p in people[:5]:
+      p.age += 100
+      p.commit()
+      local.put(p)
+    for p in people[5:10]:
+      p.first = 'changed'
+      p.commit()
+      remote.put(p)
+    local.put(person(1000))
+    remote.put(person(2000))
+    remote.delete(people[20].key) # looks like a key only local has.
+
+    pull, push = diff(local, transport, [PersonM])
+    self.assertEqual(len(pull), 11)
+    self.assertEqual(sorted(push), ['/PersonM:person1000', '/PersonM:person20'])
+
+    transport.calls = transport.bytes = 0
+    self.assertEqual(sync(local, transport, ['/PersonM']), 13)
+    self.assertEqual(transport.calls, 6) # roots, 2 levels, leaves, get, merge
+
+    tree = local.merkleTree(['/PersonM'])
+    self.assertEqual(tree.digest('/PersonM'), \
+      remote.merkleTree(['/PersonM']).digest('/PersonM'))
+    for p in people[:10]:
+      self.assertEqual(local.get(p.key), remote.get(p.key))
+    self.assertEqual(local.get(Key('/PersonM:person2000')).first, 'first2000')
+    self.assertEqual(remote.get(Key('/PersonM:person1000')).first, 'first1000')
+    self.assertEqual(remote.get(people[20].key), people[20])
+
+    # fresh repos build their trees from the datastore.
+    again = Repo('/RepoC/', local._store, codec=codec)
+    self.assertEqual(sync(again, transport, [PersonM]), 0)
+
+  def test_sync(self):
+    self.subtest_sync(None)
+    self.subtest_sync(BinaryCodec())
+
+  def test_transport(self):
+    remote = Repo('/RepoB/', datastore.DictDatastore())
+    transport = LocalTransport(SyncEndpoint(remote))
+    self.assertRaises(SyncError, transport.call, 'delete', [])
+
+    local = Repo('/RepoA/', datastore.DictDatastore())
+    local._merkle.depth = 3
+    self.assertRaises(SyncError, sync, local, transport, [PersonM])
+
+
+if __name__ == '__main__':
+  unittest.main()
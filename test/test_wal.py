@@ -0,0 +1,149 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import datastore.core
+from dronestore import Key, Repo, Query
+from dronestore.wal import LogDatastore
+
+from test_merge import PersonM
+
+
+class TestLogDatastore(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'wal.log')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_pending(self):
+    child = datastore.DictDatastore()
+    store = LogDatastore(child, self.path)
+    a, b = Key('/A'), Key('/B')
+    child.put(b, 'old')
+
+    store.put(a, 'a')
+    store.delete(b)
+    self.assertEqual(store.get(a), 'a')
+    self.assertEqual(store.get(b), None)
+    self.assertTrue(store.contains(a))
+    self.assertFalse(store.contains(b))
+    self.assertEqual(len(store), 2)
+
+    # not applied yet, but logged.
+    self.assertEqual(child.get(a), None)
+    self.assertEqual(child.get(b), 'old')
+    self.assertTrue(os.path.getsize(self.path) > 0)
+
+    store.checkpoint()
+    self.assertEqual(len(store), 0)
+    self.assertEqual(child.get(a), 'a')
+    self.assertEqual(child.get(b), None)
+    self.assertEqual(os.path.getsize(self.path), 0)
+
+    store.put(a, 'a2')
+    self.assertEqual([r for r in store.query(datastore.Query(Key('/')))], \
+      ['a2'])
+    store.close()
+    self.assertRaises(ValueError, store.put, a, 'a3')
+
+  def test_group_commit(self):
+    child = datastore.DictDatastore()
+    store = LogDatastore(child, self.path, flushInterval=0.01)
+
+    def write(t):
+      for i in range(0, 50):
+        store.put(Key('/T%d/K%d' % (t, i)), i)
+    threads = [threading.Thread(target=write, args=(t,)) for t in range(0, 8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(len(store), 400)
+    self.assertTrue(store.flushes < 400 / 4)
+    self.assertEqual(store.get(Key('/T7/K49')), 49)
+    store.close()
+    self.assertEqual(child.get(Key('/T7/K49')), 49)
+
+  def test_replay(self):
+    store = LogDatastore(datastore.DictDatastore(), self.path)
+    for i in range(0, 10):
+      store.put(Key('/K%d' % i), {'i': i})
+    store.delete(Key('/K0'))
+
+    # a record torn by a crash.
+    with open(self.path, 'ab') as log:
+      log.write('\x00\x00\x01\x00garbage')
+
+    # "crash": start over from the log alone.
+    child = datastore.DictDatastore()
+    store2 = LogDatastore(child, self.path)
+    self.assertEqual(store2.replayed, 11)
+    self.assertEqual(child.get(Key('/K0')), None)
+    self.assertEqual(child.get(Key('/K9')), {'i': 9})
+    self.assertEqual(os.path.getsize(self.path), 0)
+    store2.close()
+    store.close()
+
+  def test_checkpoint_race(self):
+    child = datastore.DictDatastore()
+    store = LogDatastore(child, self.path)
+    a = Key('/A')
+    child.put(a, 'v0')
+    store.put(a, 'v1') # acknowledged.
+
+    # a newer write lands while checkpoint is between flush and apply.
+    flush = store._flush
+    def racingFlush():
+      flush()
+      store.sync = False
+      store.put(a, 'v2')
+      store.sync = True
+    store._flush = racingFlush
+    store.checkpoint()
+    store._flush = flush
+
+    # v1 was applied before its record was truncated.
+    self.assertEqual(os.path.getsize(self.path), 0)
+    self.assertEqual(child.get(a), 'v1')
+    self.assertEqual(store.get(a), 'v2')
+    store.close()
+    self.assertEqual(child.get(a), 'v2')
+
+  def test_repo(self):
+    store = LogDatastore(datastore.DictDatastore(), self.path, sync=False)
+    repo = Repo('/RepoA/', store)
+
+    p = PersonM('A')
+    p.first = 'first'
+    p.commit()
+    repo.put(p)
+    self.assertEqual(repo.get(p.key), p)
+
+    q = PersonM(p.version)
+    q.age = 10
+    q.commit()
+    self.assertEqual(repo.merge(q).age, 10)
+    self.assertEqual(len(list(repo.query(Query(PersonM)))), 1) # applied.
+
+    q.age = 20
+    q.commit()
+    repo.merge(q)
+    store.flush()
+
+    # the log only has the last write.
+    child = datastore.DictDatastore()
+    store2 = LogDatastore(child, self.path)
+    self.assertEqual(store2.replayed, 1)
+    self.assertEqual(Repo('/RepoA/', child).get(p.key).age, 20)
+    store2.close()
+    store.close()
+
+
+if __name__ == '__main__':
+  unittest.main()